@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Offline benchmark suite for Funky Coder.
+#
+# Starts the mock LLM server from mock_llm_server.py and drives FunkyCoder through it:
+# - startup: time to import the module and to reach the first prompt of the CLI
+# - sync / stream: turn latency percentiles (and time to first token when streaming)
+# - concurrency: turns per second across many AsyncFunkyCoder sessions, and batch jobs per minute
+# - memory: traced memory growth over a long conversation
+#
+# No network access or API key is needed, so it can run in CI. Pass --baseline to compare
+# against an earlier --json report and fail on regressions.
+#
+# Usage:
+#   python benchmarks/bench_funky_coder.py --json bench.json
+#   python benchmarks/bench_funky_coder.py --baseline bench.json --tolerance 0.25
+
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+from typing import List, Dict, Any, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+# Keep litellm offline: use its bundled model cost map instead of fetching it
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+
+from mock_llm_server import start_mock_server
+
+MODEL = "openai/mock"
+SYSTEM_MESSAGE = "You are a helpful assistant that generates Python functions."
+
+# Metrics compared against a baseline; all of them are better when lower
+REGRESSION_METRICS = [
+    ("startup", "import_seconds"),
+    ("startup", "first_prompt_seconds"),
+    ("sync", "p50"),
+    ("sync", "p99"),
+    ("stream", "ttft_p50"),
+    ("stream", "p99"),
+    ("concurrency", "seconds_per_turn"),
+    ("batch", "seconds_per_job"),
+    ("memory", "bytes_per_turn"),
+]
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def summarize(values: List[float], prefix: str = "") -> Dict[str, float]:
+    return {
+        f"{prefix}p50": round(percentile(values, 0.50), 4),
+        f"{prefix}p90": round(percentile(values, 0.90), 4),
+        f"{prefix}p99": round(percentile(values, 0.99), 4),
+        f"{prefix}max": round(max(values), 4) if values else 0.0,
+    }
+
+def bench_startup(api_base: str, repeat: int) -> Dict[str, float]:
+    """Time importing funky_coder and reaching the CLI's first prompt in fresh interpreters."""
+    env = dict(os.environ)
+    import_times, prompt_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import funky_coder"], cwd=REPO_DIR, env=env, check=True)
+        import_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "funky_coder.py", "--model", MODEL, "--api-base", api_base],
+            cwd=REPO_DIR, env=env, input=">exit\n", stdout=subprocess.DEVNULL, text=True, check=True)
+        prompt_times.append(time.perf_counter() - start)
+    return {"import_seconds": round(min(import_times), 4), "first_prompt_seconds": round(min(prompt_times), 4)}
+
+def bench_turns(api_base: str, turns: int, stream: bool) -> Dict[str, float]:
+    """Run a single conversation and report turn latency percentiles."""
+    from funky_coder import FunkyCoder
+    agent = FunkyCoder("mock-key", SYSTEM_MESSAGE, model=MODEL, api_base=api_base, stream=stream, context_budget=16000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for turn in range(turns):
+            agent.prompt(f"Write function number {turn}")
+    stats = [stats for stats in agent.turn_stats if not stats.error]
+    result = summarize([stats.wall_time for stats in stats])
+    if stream:
+        result.update(summarize([stats.time_to_first_token for stats in stats if stats.time_to_first_token is not None], "ttft_"))
+    result["errors"] = turns - len(stats)
+    return result
+
+def bench_concurrency(api_base: str, sessions: int, turns: int) -> Dict[str, float]:
+    """Run many AsyncFunkyCoder sessions on one event loop and report throughput."""
+    from funky_coder import AsyncFunkyCoder
+
+    async def session(agent):
+        for turn in range(turns):
+            await agent.aprompt(f"Write function number {turn}")
+
+    async def run():
+        agents = [AsyncFunkyCoder("mock-key", SYSTEM_MESSAGE, model=MODEL, api_base=api_base, stream=True) for _ in range(sessions)]
+        start = time.perf_counter()
+        await asyncio.gather(*(session(agent) for agent in agents))
+        return agents, time.perf_counter() - start
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        agents, elapsed = asyncio.run(run())
+    completed = sum(1 for agent in agents for stats in agent.turn_stats if not stats.error)
+    return {
+        "sessions": sessions,
+        "turns": completed,
+        "seconds": round(elapsed, 4),
+        "turns_per_second": round(completed / elapsed, 2),
+        "seconds_per_turn": round(elapsed / max(completed, 1), 5),
+    }
+
+def bench_batch(api_base: str, jobs: int, concurrency: int) -> Dict[str, float]:
+    """Run a generated batch file through run_batch and report jobs per minute."""
+    from funky_coder import run_batch
+    with tempfile.TemporaryDirectory() as work_dir:
+        jobs_file = os.path.join(work_dir, "jobs.jsonl")
+        with open(jobs_file, "w") as file:
+            for job in range(jobs):
+                file.write(json.dumps({"id": f"job-{job}", "script": [f"Write function number {job}", ">code code.py", "Add tests"]}) + "\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = run_batch(jobs_file, os.path.join(work_dir, "out"), "mock-key", concurrency, {"model": MODEL, "api_base": api_base})
+    return {
+        "jobs": jobs,
+        "failed": summary["failed"],
+        "jobs_per_minute": summary["jobs_per_minute"],
+        "seconds_per_job": round(summary["seconds"] / max(jobs, 1), 5),
+    }
+
+def bench_memory(api_base: str, turns: int) -> Dict[str, Any]:
+    """Trace memory over a long conversation and report growth per turn."""
+    from funky_coder import FunkyCoder
+    agent = FunkyCoder("mock-key", SYSTEM_MESSAGE, model=MODEL, api_base=api_base, stream=False, context_budget=16000)
+    checkpoints = {}
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent.prompt("Write function number 0")
+        baseline = tracemalloc.get_traced_memory()[0]
+        for turn in range(1, turns):
+            agent.prompt(f"Refine the function, step {turn}")
+            if (turn + 1) % 25 == 0 or turn == turns - 1:
+                checkpoints[turn + 1] = tracemalloc.get_traced_memory()[0] - baseline
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "turns": turns,
+        "growth_bytes": checkpoints,
+        "bytes_per_turn": round(checkpoints[turns] / max(turns - 1, 1)),
+        "peak_bytes": peak,
+    }
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Compare a report with a baseline report.
+
+    Args:
+        report: The current results
+        baseline: Results of an earlier run
+        tolerance: Allowed relative slowdown, e.g. 0.25 for 25%
+
+    Returns:
+        A description of every metric that regressed
+    """
+    regressions = []
+    for section, metric in REGRESSION_METRICS:
+        old = baseline.get(section, {}).get(metric)
+        new = report.get(section, {}).get(metric)
+        if old and new is not None and new > old * (1 + tolerance):
+            regressions.append(f"{section}.{metric}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark Funky Coder against a local mock LLM.")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds before the first token (default: 0.05)")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="mock token rate (default: 2000)")
+    parser.add_argument("--response-tokens", type=int, default=300, help="mock tokens per response (default: 300)")
+    parser.add_argument("--turns", type=int, default=30, help="turns for the latency benchmarks (default: 30)")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent sessions (default: 50)")
+    parser.add_argument("--session-turns", type=int, default=3, help="turns per concurrent session (default: 3)")
+    parser.add_argument("--jobs", type=int, default=20, help="batch jobs (default: 20)")
+    parser.add_argument("--concurrency", type=int, default=8, help="batch concurrency (default: 8)")
+    parser.add_argument("--memory-turns", type=int, default=150, help="turns for the memory benchmark (default: 150)")
+    parser.add_argument("--startup-repeat", type=int, default=3, help="fresh interpreters per startup measurement (default: 3)")
+    parser.add_argument("--only", nargs="+", choices=["startup", "sync", "stream", "concurrency", "batch", "memory"], help="run only these benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="write the report to this file")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with an earlier report and exit non-zero on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown against the baseline (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    server, api_base = start_mock_server(latency=args.latency, tokens_per_second=args.tokens_per_second, response_tokens=args.response_tokens)
+    benchmarks = {
+        "startup": lambda: bench_startup(api_base, args.startup_repeat),
+        "sync": lambda: bench_turns(api_base, args.turns, stream=False),
+        "stream": lambda: bench_turns(api_base, args.turns, stream=True),
+        "concurrency": lambda: bench_concurrency(api_base, args.sessions, args.session_turns),
+        "batch": lambda: bench_batch(api_base, args.jobs, args.concurrency),
+        "memory": lambda: bench_memory(api_base, args.memory_turns),
+    }
+    report = {"mock": {"latency": args.latency, "tokens_per_second": args.tokens_per_second, "response_tokens": args.response_tokens}}
+    try:
+        for name, bench in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            print(f"Running {name}...", flush=True)
+            report[name] = bench()
+            print(f"  {json.dumps(report[name])}")
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report saved to {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# A local stand-in for an OpenAI-compatible chat completions endpoint, used to benchmark
+# Funky Coder without network access or an API key.
+#
+# The server answers POST /v1/chat/completions (streaming and non-streaming) with a Python
+# code block of a configurable size. Latency before the first token and the token rate are
+# configurable so benchmarks can model a real provider.
+#
+# Usage:
+#   python benchmarks/mock_llm_server.py --port 8765 --latency 0.3 --tokens-per-second 80 --response-tokens 400
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+def make_response_tokens(count: int, seed: int = 0) -> List[str]:
+    """
+    Build the pieces of a response that contains a Python function.
+
+    Args:
+        count: Approximate number of tokens in the response
+        seed: Varies the function name so responses differ between requests
+
+    Returns:
+        The response split into token-sized pieces
+    """
+    tokens = ["Here", " is", " the", " function", ":\n", "```python\n", f"def generated_{seed}", "(values", "):\n"]
+    line = 0
+    while len(tokens) < max(count - 4, 12):
+        tokens += ["    ", f"total_{line}", " =", " sum", "(values", f"[{line}:", "])", "\n"]
+        line += 1
+    tokens += ["    return", f" total_{max(line - 1, 0)}" if line else " values", "\n", "```\n"]
+    return tokens
+
+def count_prompt_tokens(messages: List[dict]) -> int:
+    """Roughly count the prompt tokens (four characters per token)."""
+    return sum(len(message.get("content") or "") // 4 + 4 for message in messages)
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """Request handler for the mock chat completions endpoint."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json({"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "funky-coder"}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.requests += 1
+            seed = self.server.requests
+        config = self.server.config
+        tokens = make_response_tokens(min(config["response_tokens"], request.get("max_tokens") or config["response_tokens"]), seed)
+        usage = {
+            "prompt_tokens": count_prompt_tokens(request.get("messages", [])),
+            "completion_tokens": len(tokens),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        time.sleep(config["latency"])
+        if request.get("stream"):
+            self.stream_response(request, tokens, usage, seed)
+        else:
+            time.sleep(len(tokens) / config["tokens_per_second"])
+            choices = [{"index": idx, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"} for idx in range(request.get("n") or 1)]
+            self.send_json({
+                "id": f"mock-{seed}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": choices,
+                "usage": usage,
+            })
+
+    def stream_response(self, request: dict, tokens: List[str], usage: dict, seed: int):
+        """Send the response as server-sent events, one token per chunk."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        delay = 1.0 / self.server.config["tokens_per_second"]
+        base = {"id": f"mock-{seed}", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "mock")}
+        try:
+            for idx, token in enumerate(tokens):
+                delta = {"content": token} if idx else {"role": "assistant", "content": token}
+                self.send_event(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+                time.sleep(delay)
+            self.send_event(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.send_event(dict(base, choices=[], usage=usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the request; stop generating like a real provider would
+            pass
+        self.close_connection = True
+
+    def send_event(self, payload: dict):
+        self.wfile.write(b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+    def send_json(self, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, latency: float = 0.2, tokens_per_second: float = 200, response_tokens: int = 300, verbose: bool = False) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start the mock server on a background thread.
+
+    Args:
+        host: Interface to listen on
+        port: Port to listen on (0 picks a free port)
+        latency: Seconds before the first token
+        tokens_per_second: Rate at which tokens are produced
+        response_tokens: Approximate number of tokens in each response
+        verbose: Log every request
+
+    Returns:
+        The running server and its OpenAI-compatible base URL
+    """
+    server = ThreadingHTTPServer((host, port), MockLLMHandler)
+    server.daemon_threads = True
+    server.config = {"latency": latency, "tokens_per_second": tokens_per_second, "response_tokens": response_tokens}
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM server for Funky Coder benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token (default: 0.2)")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="token rate (default: 200)")
+    parser.add_argument("--response-tokens", type=int, default=300, help="approximate tokens per response (default: 300)")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+    server, base_url = start_mock_server(args.host, args.port, args.latency, args.tokens_per_second, args.response_tokens, args.verbose)
+    print(f"Mock LLM listening on {base_url} (use --model openai/mock --api-base {base_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -15,13 +15,35 @@
 # - Save the final version to a Python file
 # - Simple text-based interface
 
+import time
+STARTUP_TIME = time.perf_counter()
+
 import os
 import re
-import dotenv
-from litellm import completion
-from typing import List, Dict, Any
-from dotenv import load_dotenv
+import sys
 import json
+import ast
+import math
+import heapq
+import functools
+import hashlib
+import zlib
+import sqlite3
+import uuid
+import tempfile
+import subprocess
+import queue
+import select
+import asyncio
+import threading
+import argparse
+from array import array
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator, NamedTuple, Optional, Sequence, Tuple, Union
+from dotenv import load_dotenv
 import random
 
 EXPECTED_API_KEY_NAME = "OPENAI_API_KEY"
@@ -56,6 +78,41 @@ When asked for documentation or tests, improve the existing function accordingly
             'slang': 'ripcord',
             'slang_description': "Snag the latest code block and save it like a digital mixtape. 💾'",
         },
+        'versions': {
+            'description': "List every version of the code (save one with >code <file> <version>)",
+            'slang': 'setlist',
+            'slang_description': "Peep every code drop we've jammed so far, then >ripcord <file> <version> to keep one. 🎶",
+        },
+        'stats': {
+            'description': "Show latency, token and cost stats for each turn",
+            'slang': 'scoreboard',
+            'slang_description': "Check the scoreboard: how fast we shredded, how many tokens, how many bucks. 📊",
+        },
+        'load': {
+            'description': "Load a session journal and continue it",
+            'slang': 'dropin',
+            'slang_description': "Drop back into a saved sesh right where you paddled out. 🏄",
+        },
+        'bench': {
+            'description': "Time the latest function at growing input sizes (>bench [optimize] [sizes] [: inputs built from n])",
+            'slang': 'dyno',
+            'slang_description': "Strap your function to the dyno and see how it pulls when the inputs get gnarly. 🏎️",
+        },
+        'stop': {
+            'description': "While an answer is being written: stop it and drop it (Enter or Ctrl-C work too; >stop keep keeps it)",
+            'slang': 'bail',
+            'slang_description': "Bail on a gnarly answer mid-wave; >bail keep holds onto what's already in. 🏄",
+        },
+        'lint': {
+            'description': "Check the latest code for slow patterns, without calling the model (>lint [version])",
+            'slang': 'tuneup',
+            'slang_description': "Pop the hood on your code and spot the stuff draggin' it down, no cloud call needed. 🔧",
+        },
+        'project': {
+            'description': "Plan a module of several functions and build them in parallel, with tests (>project <dir> <description>)",
+            'slang': 'crew',
+            'slang_description': "Roll deep: plan a whole module and have the crew shred every function at once. 🛹",
+        },
         'history': {
             'description': "Show conversation history",
             'slang': 'flashback',
@@ -82,6 +139,92 @@ When asked for documentation or tests, improve the existing function accordingly
             'slang_description': "If you wanna be all old school, we can do that.",
         },
     },
+    'follow_ups': {
+        'docs': {
+            'prompt': "Add documentation to the function: a description, the parameters, the return value, example usage and edge cases.",
+            'keywords': ("doc", "docs", "docstring", "docstrings", "documentation", "document", "documented"),
+        },
+        'tests': {
+            'prompt': "Add test cases for the function: basic functionality, edge cases, error cases, performance, security, concurrency and various input scenarios.",
+            'keywords': ("test", "tests", "testcase", "testcases", "unittest", "unittests", "pytest"),
+        },
+    },
+    # A follow-up must ask to add something; a request that removes or avoids it is a change to the code
+    'follow_up_additive_words': frozenset((
+        "add", "adds", "adding", "write", "generate", "create", "include", "give", "make", "provide", "need", "want",
+        "more", "some", "also", "too", "now", "please", "and", "the", "it", "for", "them", "a", "with",
+    )),
+    'follow_up_negation_words': frozenset((
+        "remove", "removes", "removing", "drop", "delete", "strip", "without", "no", "not", "don", "dont", "never",
+        "skip", "less", "fewer", "stop", "avoid", "except",
+    )),
+    'tasks': {
+        'new': "Write a new function",
+        'refine': "Change the current function",
+        'docs': "Document the function",
+        'tests': "Write tests for the function",
+    },
+    'edit_instruction': (
+        "Reply with only the changes to the latest version of the code, as search/replace blocks:\n"
+        "<<<<<<< SEARCH\n"
+        "exact lines from the current code\n"
+        "=======\n"
+        "the lines that replace them\n"
+        ">>>>>>> REPLACE\n"
+        "Use one block per change, with just enough lines in SEARCH to match a single place. "
+        "Do not repeat the unchanged code."
+    ),
+    'edit_tasks': ("refine", "docs"),
+    'optimize_prompt': (
+        "I benchmarked the latest version of the function at growing input sizes:\n\n{profile}\n\n"
+        "Make it faster and leaner where these measurements show it matters, keeping its behavior and signature. "
+        "Briefly explain what you changed and the complexity you expect."
+    ),
+    'cancelled_note': "\n\n[Stopped by the user before the answer was complete]",
+    'lint_feedback': (
+        "Automatic performance check: version {version} of the code has patterns that are known to be slow. "
+        "Fix them as part of the next answer, unless the request needs them or they do not matter at the expected input sizes.\n{issues}"
+    ),
+    'project_planner': (
+        "You are a software architect who splits a small Python project into functions. "
+        "Answer only with the plan, as JSON."
+    ),
+    'project_plan_prompt': (
+        "Plan this Python project as a set of functions:\n{description}\n\n"
+        "Group the functions into one module, or a few if the project clearly has separate parts. "
+        "Keep every function small and focused, and list the other planned functions it calls in depends_on. "
+        "Reply with a JSON block like:\n"
+        "```json\n"
+        "{{\"modules\": [{{\"name\": \"module_name\", \"functions\": [{{\"name\": \"function_name\", \"signature\": \"def function_name(arg: int) -> str\", "
+        "\"description\": \"what it does\", \"depends_on\": [\"other_function\"]}}]}}]}}\n"
+        "```"
+    ),
+    'project_plan_fix': "That plan cannot be used: {error}. Reply with the corrected JSON only.",
+    'project_function_prompt': (
+        "We are building the Python module `{module}` for this project:\n{description}\n\n"
+        "Write the function `{signature}`: {purpose}\n{dependencies}\n"
+        "Reply with two Python code blocks: first the function with the imports it needs, "
+        "then pytest tests for it that import it with `from {module} import {name}`."
+    ),
+    'project_dependencies': (
+        "\nIt can call these functions of the project, which already exist. Do not repeat them:\n"
+        "```python\n{code}\n```\n"
+    ),
+    'project_fix': "Automatic validation failed:\n{output}\nFix the function, or the tests if they are wrong, and reply with both code blocks again.",
+    'library_hint': (
+        "A similar function was written earlier for the request \"{request}\". "
+        "If it fits, use it as the starting point and adapt it to the new request:\n"
+        "```python\n{code}\n```"
+    ),
+    'library_answer': "This matches a function from your library ({score:.0%} similar), written for \"{request}\":\n\n```python\n{code}\n```",
+    'library_stopwords': frozenset((
+        "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "from", "with", "by", "as", "at", "into", "is", "are", "be",
+        "it", "its", "that", "this", "which", "if", "else", "not", "all", "each", "any", "some", "me", "my", "i", "we", "you",
+        "please", "can", "could", "would", "should", "will", "function", "functions", "python", "def", "code", "write", "create",
+        "implement", "generate", "build", "make", "new", "another", "given", "take", "takes", "return", "returns", "using", "use",
+        "args", "arg", "param", "self", "none", "true", "false",
+    )),
+    'new_function_keywords': ("write", "create", "implement", "generate", "build", "design", "code"),
     'welcomes': [
         "Welcome to the Funky Coder!",
         "🌴 Welcome to Funky Coder, Brah! 🌴",
@@ -361,197 +504,5102 @@ And we won't stop till the code's fire and the docs sing.""",
     ]
 }
 
-class FunkyCoder:
-    def __init__(self, api_key: str, system_message: str, model: str = "openai/gpt-4o", max_tokens: int = 1500, temperature: float = 0.7):
+def get_litellm():
+    """
+    Import LiteLLM on first use.
+    
+    LiteLLM pulls in a large dependency tree, so it is not imported with this module.
+    If warm_up_litellm() is already importing it on another thread, this waits for
+    that import to finish instead of starting a second one.
+    
+    Returns:
+        The litellm module
+    """
+    import litellm
+    return litellm
+
+def warm_up_litellm(api_key: Optional[str] = None, model: str = "openai/gpt-4o", api_base: Optional[str] = None) -> threading.Thread:
+    """
+    Import LiteLLM and open a connection to the provider on a background thread.
+    
+    For OpenAI-compatible models a keep-alive connection is opened with a cheap model
+    listing request and handed to LiteLLM as its HTTP client, so the first prompt does
+    not pay for DNS and TLS setup. Failures are ignored; the first prompt then simply
+    does the work itself.
+    
+    Args:
+        api_key: API key used for the warm-up request
+        model: LLM model that will be used
+        api_base: Optional OpenAI-compatible endpoint
+        
+    Returns:
+        The started thread
+    """
+    def warm_up():
+        try:
+            litellm = get_litellm()
+            if api_key and (api_base or model.startswith("openai/")) and litellm.client_session is None:
+                import httpx
+                client = httpx.Client(timeout=httpx.Timeout(600.0, connect=10.0))
+                client.get((api_base or "https://api.openai.com/v1").rstrip("/") + "/models", headers={"Authorization": f"Bearer {api_key}"})
+                litellm.client_session = client
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=warm_up, name="litellm-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+RETRYABLE_ERROR_NAMES = ("RateLimitError", "APIConnectionError", "Timeout", "APITimeoutError", "ServiceUnavailableError", "InternalServerError", "ConnectError", "ReadTimeout", "RemoteProtocolError")
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Classify an error from a completion request.
+    
+    Args:
+        error: The exception raised by the request
+        
+    Returns:
+        True for transient errors (rate limits, timeouts, connection and server errors)
+        that are worth retrying, False for errors a retry cannot fix (bad request,
+        authentication, context window exceeded, ...)
+    """
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Whether a completion request was rejected for exceeding the provider's rate limits."""
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Return the wait the provider asked for in a Retry-After header, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), 60.0)
+    except (TypeError, ValueError):
+        return None
+
+def close_stream(response):
+    """Close a streaming response so the connection is dropped and generation stops."""
+    for stream in (response, getattr(response, "completion_stream", None)):
+        close = getattr(stream, "close", None)
+        if close:
+            try:
+                close()
+                return
+            except Exception:
+                pass
+
+async def aclose_stream(response):
+    """Close an async streaming response so the connection is dropped and generation stops."""
+    for stream in (response, getattr(response, "completion_stream", None)):
+        close = getattr(stream, "aclose", None)
+        if close:
+            try:
+                await close()
+                return
+            except Exception:
+                pass
+
+class GenerationCancelled(Exception):
+    """Raised inside a turn that FunkyCoder.cancel() stopped, with the text received until then."""
+
+    def __init__(self, partial: str = ""):
+        super().__init__("Generation cancelled")
+        self.partial = partial
+
+CODE_FENCE_PATTERN = re.compile(r"```[ \t]*([\w+#.-]*)[^\n]*\r?\n(.*?)```", re.DOTALL)
+PYTHON_LANGUAGE_TAGS = ("python", "python3", "py", "")
+
+class CodeBlock(NamedTuple):
+    """One fenced code block from an assistant message."""
+    version: int
+    turn: int
+    position: int
+    language: str
+    code: str
+
+SEARCH_REPLACE_PATTERN = re.compile(r"(?:```[^\n]*\n)?<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*(?:\n```)?", re.DOTALL | re.MULTILINE)
+DIFF_FENCE_PATTERN = re.compile(r"```(?:diff|patch|udiff)[^\n]*\n(.*?)```", re.DOTALL)
+
+def replace_once(code: str, old: str, new: str) -> Optional[str]:
+    """
+    Replace the one place in the code that matches a snippet.
+    
+    An exact match is tried first, then a line-by-line match that ignores trailing
+    whitespace, which models often get wrong.
+    
+    Args:
+        code: The code to change
+        old: The lines to replace
+        new: The lines to put in their place
+        
+    Returns:
+        The changed code, or None if the snippet matches nowhere or in more than one place
+    """
+    if not old.strip():
+        return None
+    if code.count(old) == 1:
+        return code.replace(old, new)
+    lines = code.split("\n")
+    old_lines = [line.rstrip() for line in old.strip("\n").split("\n")]
+    stripped = [line.rstrip() for line in lines]
+    matches = [idx for idx in range(len(lines) - len(old_lines) + 1) if stripped[idx:idx + len(old_lines)] == old_lines]
+    if len(matches) != 1:
+        return None
+    start = matches[0]
+    new_lines = new.strip("\n").split("\n") if new.strip("\n") else []
+    return "\n".join(lines[:start] + new_lines + lines[start + len(old_lines):])
+
+def apply_search_replace(code: str, blocks: List[Tuple[str, str]]) -> Optional[str]:
+    """
+    Apply search/replace blocks one after the other.
+    
+    Args:
+        code: The code to change
+        blocks: (search, replace) pairs
+        
+    Returns:
+        The changed code, or None if any block does not apply
+    """
+    for search, replace in blocks:
+        code = replace_once(code, search, replace)
+        if code is None:
+            return None
+    return code
+
+def apply_unified_diff(code: str, diff: str) -> Optional[str]:
+    """
+    Apply a unified diff, locating each hunk by its content rather than its line numbers.
+    
+    Args:
+        code: The code to change
+        diff: The diff
+        
+    Returns:
+        The changed code, or None if the diff has no hunks or any hunk does not apply
+    """
+    hunks, old, new = [], None, None
+    for line in diff.split("\n"):
+        if line.startswith("@@"):
+            if old is not None:
+                hunks.append((old, new))
+            old, new = [], []
+        elif old is None or line.startswith("---") or line.startswith("+++"):
+            continue
+        elif line.startswith("-"):
+            old.append(line[1:])
+        elif line.startswith("+"):
+            new.append(line[1:])
+        elif not line.startswith("\\"):
+            old.append(line[1:])
+            new.append(line[1:])
+    if old is not None:
+        hunks.append((old, new))
+    blocks = []
+    for old, new in hunks:
+        # Trailing blank context lines are usually an artifact of the closing fence
+        while old and new and not old[-1].strip() and not new[-1].strip():
+            old, new = old[:-1], new[:-1]
+        if old:
+            blocks.append(("\n".join(old), "\n".join(new)))
+    return apply_search_replace(code, blocks) if blocks else None
+
+def apply_patch(code: str, response: str) -> Optional[Tuple[str, int, int, int]]:
+    """
+    Apply the search/replace blocks or unified diffs in a response to the code.
+    
+    Args:
+        code: The latest version of the code
+        response: The assistant's response
+        
+    Returns:
+        The patched code, the start and end offsets of the patch in the response and
+        the number of changes, or None if the response has no patch or it does not apply
+    """
+    matches = list(SEARCH_REPLACE_PATTERN.finditer(response))
+    if matches:
+        patched = apply_search_replace(code, [(match.group(1), match.group(2)) for match in matches])
+    else:
+        matches = list(DIFF_FENCE_PATTERN.finditer(response))
+        patched = None
+        for match in matches:
+            patched = apply_unified_diff(patched if patched is not None else code, match.group(1))
+            if patched is None:
+                break
+    if not matches or patched is None:
+        return None
+    return patched, matches[0].start(), matches[-1].end(), len(matches)
+
+class TurnStats(NamedTuple):
+    """Measurements of one prompt turn."""
+    turn: int
+    model: str
+    timestamp: float
+    wall_time: float
+    time_to_first_token: Optional[float]
+    prompt_tokens: int
+    completion_tokens: int
+    cost: Optional[float]
+    retries: int = 0
+    cache_hit: bool = False
+    error: Optional[str] = None
+    cached_tokens: int = 0
+    hedged: bool = False
+    task: Optional[str] = None
+    fallback_from: Optional[str] = None
+    edit: Optional[str] = None
+    candidates: int = 1
+    queue_wait: float = 0.0
+    library: Optional[str] = None
+    cancelled: bool = False
+
+class Usage(NamedTuple):
+    """Token counts of several requests added together, shaped like a provider's usage block."""
+    prompt_tokens: int
+    completion_tokens: int
+    cache_read_input_tokens: int = 0
+
+def get_cached_tokens(usage) -> int:
+    """Prompt tokens of a usage block that were served from the provider's prompt cache."""
+    # OpenAI-style usage reports prompt_tokens_details.cached_tokens, Anthropic-style cache_read_input_tokens
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) if details else None) or getattr(usage, "cache_read_input_tokens", None) or 0
+
+def supports_n(model: str) -> bool:
+    """Whether LiteLLM can ask the model's provider for several choices in one request."""
+    try:
+        return "n" in (get_litellm().get_supported_openai_params(model=model) or [])
+    except Exception:
+        return False
+
+def combine_usage(usages: List[Any]) -> Optional[Usage]:
+    """Add up the usage blocks of several responses, or return None if none reported usage."""
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+    return Usage(
+        sum(usage.prompt_tokens or 0 for usage in usages),
+        sum(usage.completion_tokens or 0 for usage in usages),
+        sum(get_cached_tokens(usage) for usage in usages),
+    )
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+def format_metrics(turn_stats: List[TurnStats]) -> str:
+    """
+    Render turn measurements in the Prometheus text exposition format.
+    
+    Args:
+        turn_stats: Measurements of the turns to include
+        
+    Returns:
+        The metrics, suitable for a node_exporter textfile or a /metrics endpoint
+    """
+    turns, tokens, cost, ttft, latency, routes, queue_wait = {}, {}, {}, {}, {}, {}, {}
+    for stats in turn_stats:
+        outcome = "cancelled" if stats.cancelled else "error" if stats.error else ("library" if stats.library == "reuse" else "cache_hit" if stats.cache_hit else "ok")
+        turns[(stats.model, outcome)] = turns.get((stats.model, outcome), 0) + 1
+        if stats.task:
+            route = (stats.task, stats.model, stats.fallback_from or "")
+            routes[route] = routes.get(route, 0) + 1
+        tokens[(stats.model, "prompt")] = tokens.get((stats.model, "prompt"), 0) + stats.prompt_tokens
+        tokens[(stats.model, "completion")] = tokens.get((stats.model, "completion"), 0) + stats.completion_tokens
+        tokens[(stats.model, "cached")] = tokens.get((stats.model, "cached"), 0) + stats.cached_tokens
+        cost[stats.model] = cost.get(stats.model, 0.0) + (stats.cost or 0.0)
+        queue_wait[stats.model] = queue_wait.get(stats.model, 0.0) + stats.queue_wait
+        if stats.time_to_first_token is not None:
+            total, count = ttft.get(stats.model, (0.0, 0))
+            ttft[stats.model] = (total + stats.time_to_first_token, count + 1)
+        buckets, total, count = latency.get(stats.model, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+        for idx, bound in enumerate(LATENCY_BUCKETS):
+            if stats.wall_time <= bound:
+                buckets[idx] += 1
+        latency[stats.model] = (buckets, total + stats.wall_time, count + 1)
+
+    lines = ["# HELP funky_coder_turns_total Prompt turns by outcome.", "# TYPE funky_coder_turns_total counter"]
+    lines += [f'funky_coder_turns_total{{model="{model}",outcome="{outcome}"}} {count}' for (model, outcome), count in sorted(turns.items())]
+    lines += ["# HELP funky_coder_routed_turns_total Turns by task and the model that answered them.", "# TYPE funky_coder_routed_turns_total counter"]
+    lines += [f'funky_coder_routed_turns_total{{task="{task}",model="{model}",fallback_from="{fallback_from}"}} {count}' for (task, model, fallback_from), count in sorted(routes.items())]
+    lines += ["# HELP funky_coder_tokens_total Tokens sent and received.", "# TYPE funky_coder_tokens_total counter"]
+    lines += [f'funky_coder_tokens_total{{model="{model}",kind="{kind}"}} {count}' for (model, kind), count in sorted(tokens.items())]
+    lines += ["# HELP funky_coder_cost_usd_total Estimated spend in US dollars.", "# TYPE funky_coder_cost_usd_total counter"]
+    lines += [f'funky_coder_cost_usd_total{{model="{model}"}} {total:.6f}' for model, total in sorted(cost.items())]
+    lines += ["# HELP funky_coder_queue_wait_seconds_total Time requests waited for the rate limiter.", "# TYPE funky_coder_queue_wait_seconds_total counter"]
+    lines += [f'funky_coder_queue_wait_seconds_total{{model="{model}"}} {total:.6f}' for model, total in sorted(queue_wait.items())]
+    lines += ["# HELP funky_coder_time_to_first_token_seconds Time until the first streamed token.", "# TYPE funky_coder_time_to_first_token_seconds summary"]
+    for model, (total, count) in sorted(ttft.items()):
+        lines += [f'funky_coder_time_to_first_token_seconds_sum{{model="{model}"}} {total:.6f}', f'funky_coder_time_to_first_token_seconds_count{{model="{model}"}} {count}']
+    lines += ["# HELP funky_coder_turn_seconds Wall time of each turn.", "# TYPE funky_coder_turn_seconds histogram"]
+    for model, (buckets, total, count) in sorted(latency.items()):
+        lines += [f'funky_coder_turn_seconds_bucket{{model="{model}",le="{bound}"}} {bucket}' for bound, bucket in zip(LATENCY_BUCKETS, buckets)]
+        lines += [f'funky_coder_turn_seconds_bucket{{model="{model}",le="+Inf"}} {count}', f'funky_coder_turn_seconds_sum{{model="{model}"}} {total:.6f}', f'funky_coder_turn_seconds_count{{model="{model}"}} {count}']
+    return "\n".join(lines) + "\n"
+
+class ResponseCache:
+    """
+    Disk-backed cache of assistant responses keyed on the full completion request.
+    
+    Entries live in a SQLite file, expire after a time-to-live and are evicted
+    least-recently-used first once the total size exceeds a byte budget.
+    """
+    KEY_FIELDS = ("messages", "model", "temperature", "max_tokens", "top_p", "frequency_penalty", "presence_penalty")
+
+    def __init__(self, filename: str = ".funky_cache.sqlite", max_bytes: int = 64 * 1024 * 1024, ttl: Optional[float] = 7 * 24 * 3600):
         """
-        Initialize the FunkyCoder with API key and configuration settings.
+        Open (or create) the cache.
         
         Args:
-            api_key: OpenAI API key
-            system_message: Initial system instructions for the agent
-            model: LLM model to use
-            max_tokens: Maximum tokens for completion
-            temperature: Temperature for completion (0-1)
+            filename: Path to the SQLite file
+            max_bytes: Maximum total size of the cached responses
+            ttl: Seconds an entry stays valid, or None to keep entries until evicted
         """
-        self.__conversation = [{"role": "system", "content": system_message}]
-        self.__api_key = api_key
-        self.__model = model
-        self.__max_tokens = max_tokens
-        self.__temperature = temperature
+        self.__max_bytes = max_bytes
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,
+            created REAL NOT NULL, accessed REAL NOT NULL)""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.__db.commit()
+        self.hits = 0
+        self.misses = 0
 
-    def set_system_message(self, system_message: str) -> None:
-        self.__conversation.append({"role": "system", "content": system_message})
+    def make_key(self, request: Dict[str, Any]) -> str:
+        """
+        Build a stable hash of everything in a request that affects the response.
+        
+        Args:
+            request: Keyword arguments for completion()
+            
+        Returns:
+            Hex digest identifying the request
+        """
+        fields = {field: request.get(field) for field in self.KEY_FIELDS}
+        encoded = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
 
-    def prompt(self, user_input: str) -> str:
+    def get(self, key: str) -> Optional[str]:
         """
-        Send a prompt to the LLM and get a response.
+        Look up a cached response.
         
         Args:
-            user_input: The user's input text
+            key: Key from make_key()
             
         Returns:
-            The assistant's response
+            The cached response, or None on a miss
         """
-        self.__conversation.append({"role": "user", "content": user_input})
-        try:
-            response = completion(
-                messages = self.__conversation,
-                model = self.__model,
-                temperature = self.__temperature,
-                max_tokens = self.__max_tokens,
-                top_p = 1,
-                frequency_penalty = 0,
-                presence_penalty = 0
-            )
-            assistant_response = response.choices[0].message.content
-            self.__conversation.append({"role": "assistant", "content": assistant_response})
-            return assistant_response
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            print(error_msg)
-            return error_msg
-    
-    def save_to_file(self, filename: str):
+        now = time.time()
+        with self.__lock:
+            row = self.__db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.__ttl is not None and row[1] + self.__ttl < now:
+                self.__db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.__db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.__db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.__db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
         """
-        Save the entire conversation to a file.
+        Store a response, evicting the least recently used entries if over budget.
         
         Args:
-            filename: Path to the output file
+            key: Key from make_key()
+            response: The assistant's response
         """
-        try:
-            with open(filename, "w") as file:
-                for message in self.__conversation:
-                    role = message["role"]
-                    content = message["content"]
-                    file.write(f"=== {role.upper()} ===\n{content}\n\n")
-            print(f"Conversation saved to {filename}")
-        except Exception as e:
-            print(f"Error saving file: {str(e)}")
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        if size > self.__max_bytes:
+            return
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+            if self.__ttl is not None:
+                self.__db.execute("DELETE FROM responses WHERE created < ?", (now - self.__ttl,))
+            total = self.__db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.__max_bytes:
+                evict = []
+                for old_key, old_size in self.__db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if total <= self.__max_bytes:
+                        break
+                    evict.append((old_key,))
+                    total -= old_size
+                self.__db.executemany("DELETE FROM responses WHERE key = ?", evict)
+            self.__db.commit()
+
+    def clear(self):
+        """Remove every cached response."""
+        with self.__lock:
+            self.__db.execute("DELETE FROM responses")
+            self.__db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counts and the current size of the cache."""
+        with self.__lock:
+            entries, total = self.__db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total}
+
+class LibraryMatch(NamedTuple):
+    """A stored function that is similar to a request."""
+    id: int
+    score: float
+    name: str
+    signature: str
+    request: str
+    code: str
+
+class FunctionLibrary:
+    """
+    Local library of saved functions with an offline similarity index.
     
-    def extract_code(self) -> str:
+    Each entry is the code saved with '>code', indexed by the request that produced
+    it and the name, parameters and docstring of its functions. Entries live in a
+    SQLite file; the index is an in-memory inverted index of terms with IDF-weighted
+    cosine similarity, so a lookup only touches the entries sharing a term with the
+    request and stays in the milliseconds for tens of thousands of entries.
+    """
+    TERM_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+")
+    NORM_REFRESH_GROWTH = 1.1
+
+    def __init__(self, filename: str = ".funky_library.sqlite"):
         """
-        Extract Python code from the conversation.
+        Open (or create) the library and build its index.
         
-        Returns:
-            String containing all Python code found in the conversation
+        Args:
+            filename: Path to the SQLite file
         """
-        code_blocks = []
-        pattern = r"```python\n(.*?)```"
-        
-        for message in self.__conversation:
-            if message["role"] == "assistant":
-                matches = re.findall(pattern, message["content"], re.DOTALL)
-                code_blocks.extend(matches)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS functions (
+            id INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL, request TEXT NOT NULL, name TEXT NOT NULL,
+            signature TEXT NOT NULL, docstring TEXT NOT NULL, terms TEXT NOT NULL, code TEXT NOT NULL, created REAL NOT NULL)""")
+        self.__db.commit()
+        self.__postings = {}
+        self.__norms = {}
+        self.__normed_entries = 0
+        for entry_id, terms in self.__db.execute("SELECT id, terms FROM functions"):
+            self.__index(entry_id, terms.split())
+        self.__refresh_norms()
+        self.lookups = 0
+        self.matches = 0
 
-        return code_blocks[-1:][0] if code_blocks else None
-    
-    def save_code_to_file(self, filename: str) -> bool:
+    @classmethod
+    def terms(cls, text: str) -> List[str]:
         """
-        Extract code from the conversation and save it to a Python file.
+        Split text into the distinct terms it is indexed by.
+        
+        Identifiers are split at underscores and camelCase humps, stop words are
+        dropped and a plural "s" is removed, so "parse_iso_dates" and "Parse ISO date"
+        share their terms.
         
         Args:
-            filename: Path to the output Python file
+            text: The text
             
         Returns:
-            True if successful, False otherwise
+            The terms, in order of first appearance
         """
-        code = self.extract_code()
-        if not code:
-            print("No code found in the conversation.")
-            return False
+        terms = {}
+        for word in cls.TERM_PATTERN.findall(text):
+            word = word.lower()
+            if len(word) < 2 or word in data["library_stopwords"]:
+                continue
+            if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+                word = word[:-1]
+            terms[word] = None
+        return list(terms)
+
+    @staticmethod
+    def describe(code: str) -> Optional[Tuple[str, str, str, List[str]]]:
+        """
+        Find the main function of a piece of code.
+        
+        Args:
+            code: Python source
             
+        Returns:
+            The function's name, signature and docstring and the names of the other
+            top-level functions, or None if the code defines no function
+        """
         try:
-            with open(filename, "w") as file:
-                file.write(code)
-            print(f"Code saved to {filename}")
-            return True
-        except Exception as e:
-            print(f"Error saving code: {str(e)}")
-            return False
-    
-    def reset_conversation(self, keep_system_message: bool = True):
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            return None
+        functions = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        if not functions:
+            return None
+        main = next((node for node in functions if not node.name.startswith("_")), functions[0])
+        args = main.args
+        params = [arg.arg for arg in getattr(args, "posonlyargs", []) + args.args]
+        params += [f"*{args.vararg.arg}"] if args.vararg else (["*"] if args.kwonlyargs else [])
+        params += [arg.arg for arg in args.kwonlyargs] + ([f"**{args.kwarg.arg}"] if args.kwarg else [])
+        signature = f"{main.name}({', '.join(params)})"
+        return main.name, signature, ast.get_docstring(main) or "", [node.name for node in functions if node is not main]
+
+    def add(self, request: str, code: str) -> Optional[int]:
         """
-        Reset the conversation history.
+        Store a function and index it.
         
         Args:
-            keep_system_message: Whether to keep the system message
+            request: The user request the code was written for
+            code: The Python code
+            
+        Returns:
+            The entry's ID (the existing one if the same code is stored already), or None if the code defines no function
         """
-        system_message = self.__conversation[0] if keep_system_message else None
-        self.__conversation = [system_message] if system_message else []
-        print("Conversation reset.")
-    
-    def show_history(self):
-        """Print the conversation history."""
-        for idx, message in enumerate(self.__conversation):
-            role = message["role"]
-            if role == "system":
-                continue
-            print(f"\n--- Message {idx} ({role}) ---")
-            print(message["content"])
+        description = self.describe(code)
+        if description is None:
+            return None
+        name, signature, docstring, helpers = description
+        terms = self.terms(" ".join([request, signature, docstring] + helpers))
+        digest = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        with self.__lock:
+            row = self.__db.execute("SELECT id FROM functions WHERE hash = ?", (digest,)).fetchone()
+            if row:
+                return row[0]
+            cursor = self.__db.execute("INSERT INTO functions (hash, request, name, signature, docstring, terms, code, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (digest, request, name, signature, docstring, " ".join(terms), code, time.time()))
+            self.__db.commit()
+            self.__index(cursor.lastrowid, terms)
+            if len(self.__norms) > self.__normed_entries * self.NORM_REFRESH_GROWTH:
+                self.__refresh_norms()
+            else:
+                self.__norms[cursor.lastrowid] = math.sqrt(sum(self.__idf(term) ** 2 for term in terms)) or 1.0
+            return cursor.lastrowid
 
-def is_valid_filename(filename: str) -> bool:
+    def search(self, request: str, limit: int = 3, threshold: float = 0.0) -> List[LibraryMatch]:
+        """
+        Find the stored functions most similar to a request.
+        
+        Args:
+            request: The user request
+            limit: Maximum number of matches
+            threshold: Minimum similarity, from 0 to 1
+            
+        Returns:
+            The matches, most similar first
+        """
+        terms = self.terms(request)
+        with self.__lock:
+            self.lookups += 1
+            scores = {}
+            query_norm = 0.0
+            for term in terms:
+                idf = self.__idf(term)
+                query_norm += idf * idf
+                for entry_id in self.__postings.get(term, ()):
+                    scores[entry_id] = scores.get(entry_id, 0.0) + idf * idf
+            if not scores:
+                return []
+            query_norm = math.sqrt(query_norm)
+            ranked = heapq.nlargest(limit, ((score / (query_norm * self.__norms[entry_id]), entry_id) for entry_id, score in scores.items()))
+            ranked = [(score, entry_id) for score, entry_id in ranked if score >= threshold]
+            matches = []
+            for score, entry_id in ranked:
+                entry_id, name, signature, request_text, code = self.__db.execute("SELECT id, name, signature, request, code FROM functions WHERE id = ?", (entry_id,)).fetchone()
+                matches.append(LibraryMatch(entry_id, min(score, 1.0), name, signature, request_text, code))
+            self.matches += bool(matches)
+            return matches
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the number of entries and indexed terms, and how many lookups found a match."""
+        with self.__lock:
+            return {"entries": len(self.__norms), "terms": len(self.__postings), "lookups": self.lookups, "matches": self.matches}
+
+    def __index(self, entry_id: int, terms: List[str]):
+        for term in terms:
+            postings = self.__postings.get(term)
+            if postings is None:
+                postings = self.__postings[term] = array("l")
+            postings.append(entry_id)
+        self.__norms[entry_id] = 1.0
+
+    def __idf(self, term: str) -> float:
+        return math.log((len(self.__norms) + 1) / (len(self.__postings.get(term, ())) + 1)) + 1
+
+    def __refresh_norms(self):
+        """Recompute every entry's vector length with the current IDF weights."""
+        norms = dict.fromkeys(self.__norms, 0.0)
+        for term, postings in self.__postings.items():
+            weight = self.__idf(term) ** 2
+            for entry_id in postings:
+                norms[entry_id] += weight
+        self.__norms = {entry_id: math.sqrt(total) or 1.0 for entry_id, total in norms.items()}
+        self.__normed_entries = len(self.__norms)
+
+TEST_CODE_PATTERN = re.compile(r"^\s*(?:def test_\w*\s*\(|class \w+\s*\(\s*(?:unittest\.)?TestCase\s*\)|import (?:unittest|pytest)\b|from (?:unittest|pytest)\b)", re.MULTILINE)
+
+def is_test_code(code: str) -> bool:
+    """Whether a block of Python code is a test suite rather than the function under test."""
+    return bool(TEST_CODE_PATTERN.search(code))
+
+# Runs inside the sandboxed interpreter: loads the code as a module (also reachable under
+# any module name the tests import it from), blocks the socket module as a best-effort
+# network block (see run_sandboxed) and runs the tests
+VALIDATION_RUNNER = '''
+import sys, time, types, socket, builtins, inspect, unittest, traceback, runpy
+
+def blocked(*args, **kwargs):
+    raise OSError("network access is disabled during validation")
+socket.socket = blocked
+socket.create_connection = blocked
+# Tests often end with unittest.main(); the tests are collected and run below instead
+unittest.main = lambda *args, **kwargs: None
+
+solution = types.ModuleType("solution")
+solution.__file__ = "solution.py"
+sys.modules["solution"] = solution
+exec(compile(open("solution.py").read(), "solution.py", "exec"), solution.__dict__)
+
+original_import = builtins.__import__
+def import_solution(name, globals=None, locals=None, fromlist=(), level=0):
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    except ImportError as error:
+        # Only the tests and the code itself may import it under another name; libraries that probe
+        # for optional modules (pytest imports subprocess, which tries _winapi) must see the ImportError
+        if level or getattr(error, "name", None) != name.partition(".")[0] or (globals or {}).get("__name__") not in ("solution", "funky_validation"):
+            raise
+        return solution
+builtins.__import__ = import_solution
+
+try:
+    namespace = runpy.run_path("tests.py", init_globals=dict(solution.__dict__), run_name="funky_validation")
+except Exception:
+    traceback.print_exc()
+    sys.exit(1)
+suite = unittest.TestSuite()
+functions = []
+for name, value in list(namespace.items()):
+    if inspect.isclass(value) and issubclass(value, unittest.TestCase) and value is not unittest.TestCase:
+        suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(value))
+    elif name.startswith("test") and inspect.isfunction(value):
+        required = [p for p in inspect.signature(value).parameters.values() if p.default is p.empty and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+        if not required:
+            functions.append(unittest.FunctionTestCase(value, description=name))
+suite.addTests(functions)
+start = time.perf_counter()
+result = unittest.TextTestRunner(stream=sys.stdout, verbosity=1).run(suite)
+print("FUNKY_TESTS_RUN", result.testsRun, len(result.failures) + len(result.errors), time.perf_counter() - start)
+sys.exit(0 if result.wasSuccessful() and result.testsRun else 1)
+'''
+
+# unshare(2) flags from <sched.h>
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+SANDBOX_NETWORK_MARKER = "FUNKY_SANDBOX_NETWORK"
+
+# Runs first in the sandboxed interpreter, in place of a preexec_fn (which is unsafe in a
+# threaded parent): moves the process into new user and network namespaces where Linux
+# allows it, reports whether that worked, applies the resource limits and runs runner.py
+SANDBOX_BOOTSTRAP = '''
+import os, sys, runpy
+cpu, memory, flags = (int(arg) for arg in sys.argv[1:4])
+isolated, reason = False, "not Linux"
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.unshare(flags) == 0:
+            isolated, reason = True, "network namespace"
+        else:
+            reason = os.strerror(ctypes.get_errno())
+    except (ImportError, OSError, AttributeError) as error:
+        reason = str(error)
+print("%s %d %s" % (sys.argv[4], isolated, reason), flush=True)
+try:
+    import resource
+except ImportError:
+    resource = None
+if resource is not None:
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+sys.argv = ["runner.py"]
+runpy.run_path("runner.py", run_name="__main__")
+'''
+
+def run_sandboxed(files: Dict[str, str], timeout: float, memory_mb: int) -> Tuple[bool, str, bool]:
     """
-    Check if the filename is valid.
+    Run runner.py in a fresh, isolated interpreter in a temporary directory.
+    
+    The child gets CPU, memory and wall-time limits and no inherited environment (so no API keys).
+    On Linux it also moves into new user and network namespaces, where no network interface
+    is up, if the kernel allows unprivileged user namespaces. Otherwise the only network
+    block is the runner replacing socket.socket, which is best-effort: code that reaches the
+    network through C extensions or other processes gets around it.
+    
+    The limits and namespaces are set up by a small bootstrap script in the child rather than
+    a preexec_fn, so nothing runs between fork and exec in this (threaded) process.
     
     Args:
-        filename: The filename to check
+        files: Contents of the files to create in the directory, including runner.py
+        timeout: Seconds of wall time (and CPU time) the run may take
+        memory_mb: Address space limit in MB
         
     Returns:
-        True if valid, False otherwise
+        Whether the run exited successfully, its combined stdout and stderr, and whether the
+        network namespace took effect
     """
-    invalid_chars = r'<>:"/\\|?*'
-    return not any(char in filename for char in invalid_chars)
-
-def get_header(is_slang: bool = False) -> str:
-    if is_slang:
-        return """
--------------------------------
-| 🕺 F U N K Y  C O D E R 🧠 |
--------------------------------"""
-    else:
-        return """
--------------------------------
-|    F U N K Y  C O D E R    |
--------------------------------"""
+    command = [
+        sys.executable, "-I", "-c", SANDBOX_BOOTSTRAP, str(max(int(timeout), 1)), str(memory_mb * 1024 * 1024),
+        str(CLONE_NEWUSER | CLONE_NEWNET), SANDBOX_NETWORK_MARKER]
+    with tempfile.TemporaryDirectory(prefix="funky_sandbox_") as work_dir:
+        for filename, source in files.items():
+            with open(os.path.join(work_dir, filename), "w") as file:
+                file.write(source)
+        try:
+            process = subprocess.run(
+                command, cwd=work_dir, env={"PATH": os.defpath, "PYTHONHASHSEED": "0"},
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+            ok, output = process.returncode == 0, process.stdout.decode("utf-8", "replace")
+        except subprocess.TimeoutExpired as e:
+            ok, output = False, (e.output or b"").decode("utf-8", "replace") + f"\nTimed out after {timeout:g}s"
+    match = re.match(rf"{SANDBOX_NETWORK_MARKER} ([01]) [^\n]*\n?", output)
+    if match:
+        output = output[match.end():]
+    return ok, output, bool(match and match.group(1) == "1")
 
-def get_welcome(is_slang: bool = False) -> str:
-    if is_slang:
-        return random.choice(data["welcomes"][1:])
-    else:
-        return data["welcomes"][0]
+class ValidationResult(NamedTuple):
+    """Outcome of validating one version of the code."""
+    code_hash: str
+    ok: bool
+    stage: str
+    tests_run: int
+    output: str
+    seconds: float
+    cached: bool = False
+    tests_failed: int = 0
+    test_seconds: float = 0.0
+    network_isolated: bool = False
 
-def get_tagline(is_slang: bool = False) -> str:
-    if is_slang:
-        return random.choice(data["taglines"][1:])
-    else:
-        return data["taglines"][0]
+    @property
+    def pass_rate(self) -> float:
+        """Share of the tests that passed; 1.0 for code without tests that compiles."""
+        if not self.tests_run:
+            return 1.0 if self.ok else 0.0
+        return (self.tests_run - self.tests_failed) / self.tests_run
 
-def get_description(is_slang: bool = False) -> str:
-    if is_slang:
-        return random.choice(data["descriptions"][1:])
-    else:
-        return data["descriptions"][0]
+class CodeValidator:
+    """
+    Checks generated code by compiling it and running its tests in sandboxed subprocesses.
+    
+    Each run gets a fresh isolated interpreter in a temporary directory with CPU, memory
+    and wall-time limits and no inherited environment (so no API keys). The network is
+    cut off by a network namespace on Linux where user namespaces are allowed, and
+    otherwise only blocked best-effort (see run_sandboxed). Runs happen on a small worker pool so callers never wait for them, and
+    results are cached by the hash of the code and tests.
+    """
+    OUTPUT_LIMIT = 4000
 
-def get_slang(command: str) -> str:
-    return data["commands"][command]["slang"]
+    def __init__(self, workers: int = 2, timeout: float = 10.0, memory_mb: int = 512):
+        """
+        Create the validator.
+        
+        Args:
+            workers: Number of validations run at once
+            timeout: Seconds of wall time (and CPU time) each test run may take
+            memory_mb: Address space limit of each test run in MB
+        """
+        self.__timeout = timeout
+        self.__memory_mb = memory_mb
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="validation")
+        self.__lock = threading.Lock()
+        self.__results = {}
+        self.hits = 0
+        self.misses = 0
 
-def get_help_commands(is_slang: bool = False) -> str:
-    if is_slang:
-        output = """🛠️ Funky System Moves
-Here's the menu of righteous commands:"""
-    else:
-        output = "System Commands:"
-    for command in data["commands"]:
-        if is_slang:
-            output += f"\n>{get_slang(command)} -- {data['commands'][command]['slang_description']}"
-        else:
-            output += f"\n>{command} -- {data['commands'][command]['description']}"
-    return output
+    @staticmethod
+    def make_key(code: str, tests: Optional[str] = None) -> str:
+        """Hash the code and tests into the key results are cached under."""
+        return hashlib.sha256(json.dumps([code, tests or ""]).encode("utf-8")).hexdigest()
 
-def get_examples(is_slang: bool = False) -> str:
-    if is_slang:
-        return """📦 Examples for the Groovy Newbies
-You: >stash surf_log.txt  
+    def submit(self, code: str, tests: Optional[str] = None) -> Future:
+        """
+        Validate code in the background.
+        
+        Args:
+            code: The code under test
+            tests: Test code to run against it, or None to only compile the code
+            
+        Returns:
+            A future resolving to the ValidationResult
+        """
+        key = self.make_key(code, tests)
+        with self.__lock:
+            future = self.__results.get(key)
+            if future is not None:
+                self.hits += 1
+                if future.done():
+                    cached = Future()
+                    cached.set_result(future.result()._replace(cached=True))
+                    return cached
+                return future
+            self.misses += 1
+            future = self.__executor.submit(self.__validate, key, code, tests)
+            self.__results[key] = future
+            return future
+
+    def validate(self, code: str, tests: Optional[str] = None) -> ValidationResult:
+        """Validate code and wait for the result."""
+        return self.submit(code, tests).result()
+
+    def __validate(self, key: str, code: str, tests: Optional[str]) -> ValidationResult:
+        """Compile the code and, if there are tests, run them in a sandboxed interpreter."""
+        start = time.perf_counter()
+        for stage, source in (("compile", code), ("compile", tests)):
+            if source is None:
+                continue
+            try:
+                compile(source, "tests.py" if source is tests else "solution.py", "exec")
+            except SyntaxError as e:
+                return ValidationResult(key, False, stage, 0, f"{type(e).__name__}: {e}", time.perf_counter() - start)
+        if tests is None:
+            return ValidationResult(key, True, "compile", 0, "", time.perf_counter() - start)
+        ok, output, network_isolated = run_sandboxed({"solution.py": code, "tests.py": tests, "runner.py": VALIDATION_RUNNER}, self.__timeout, self.__memory_mb)
+        match = re.search(r"FUNKY_TESTS_RUN (\d+) (\d+) ([\d.e-]+)", output)
+        output = output.replace(match.group(0), "").strip() if match else output.strip()
+        tests_run, tests_failed, test_seconds = (int(match.group(1)), int(match.group(2)), float(match.group(3))) if match else (0, 0, 0.0)
+        return ValidationResult(key, ok, "tests", tests_run, output[-self.OUTPUT_LIMIT:], time.perf_counter() - start, tests_failed=tests_failed, test_seconds=test_seconds, network_isolated=network_isolated)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit and miss counts of the result cache."""
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.__results)}
+
+    def close(self):
+        """Stop the worker pool, abandoning queued validations."""
+        self.__executor.shutdown(wait=False)
+
+# Runs inside the sandboxed interpreter: loads the code, builds inputs of growing size for
+# one function, times it timeit-style, measures its peak memory with tracemalloc and
+# profiles it line by line at one size
+BENCHMARK_RUNNER = '''
+import sys, json, time, math, types, socket, random, inspect, traceback, tracemalloc, linecache
+
+def blocked(*args, **kwargs):
+    raise OSError("network access is disabled during benchmarks")
+socket.socket = blocked
+socket.create_connection = blocked
+
+spec = json.load(open("bench.json"))
+solution = types.ModuleType("solution")
+solution.__file__ = "solution.py"
+sys.modules["solution"] = solution
+exec(compile(open("solution.py").read(), "solution.py", "exec"), solution.__dict__)
+function = getattr(solution, spec["function"])
+
+TEXT_NAMES = ("s", "text", "string", "word", "sentence", "line", "name", "pattern", "source", "content")
+NUMBER_NAMES = ("n", "num", "number", "count", "k", "size", "limit", "x", "m", "steps", "depth", "width")
+
+def kind_of(param):
+    annotation = param.annotation
+    hint = (annotation if isinstance(annotation, str) else getattr(annotation, "__name__", None) or str(annotation)).lower()
+    if param.annotation is param.empty:
+        hint = ""
+    name = param.name.lower()
+    if "str" in hint or (not hint and (name in TEXT_NAMES or name.endswith(("text", "string", "str")))):
+        return "str"
+    if "dict" in hint or "mapping" in hint or (not hint and name in ("d", "mapping", "dictionary", "counts")):
+        return "dict"
+    if "set" in hint:
+        return "set"
+    if "float" in hint:
+        return "float"
+    if hint == "int" or (not hint and name in NUMBER_NAMES):
+        return "int"
+    return "list"
+
+def describe_inputs(kinds):
+    sized = {"str": "str of length n", "dict": "dict of n ints", "set": "set of n ints", "list": "list of n ints"}
+    scalar = "n" if not any(kind in sized for kind in kinds.values()) else "10"
+    return ", ".join(f"{name}: {sized.get(kind, 'int ' + scalar if kind == 'int' else 'float ' + scalar)}" for name, kind in kinds.items())
+
+def make_args(n):
+    if spec["inputs"]:
+        value = eval(spec["inputs"], {"n": n, "random": random, "math": math})
+        return value if isinstance(value, tuple) else (value,)
+    scalar = n if not any(kind in ("str", "dict", "set", "list") for kind in kinds.values()) else 10
+    values = []
+    for kind in kinds.values():
+        if kind == "str":
+            values.append("".join(random.choice("abcdefghij ") for _ in range(n)))
+        elif kind == "dict":
+            values.append({i: random.randrange(n) for i in range(n)})
+        elif kind == "set":
+            values.append(set(random.sample(range(2 * n), n)))
+        elif kind == "int":
+            values.append(scalar)
+        elif kind == "float":
+            values.append(float(scalar))
+        else:
+            values.append([random.randrange(n) for _ in range(n)])
+    return tuple(values)
+
+def time_call(n):
+    """Best seconds per call over a few repeats, with enough calls per repeat to time reliably."""
+    random.seed(n)
+    args = make_args(n)
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= 0.01 or number >= 1 << 20:
+            break
+        number *= 4
+    best = elapsed / number
+    # A single slow call is timed once more at most
+    for _ in range(spec["repeat"] - 1 if elapsed < 0.1 else min(spec["repeat"] - 1, 1)):
+        start = time.perf_counter()
+        for _ in range(number):
+            function(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def peak_memory(n):
+    random.seed(n)
+    args = make_args(n)
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def profile_lines(n):
+    """Time spent, hits and the highest memory in use on each line of the solution during one call."""
+    random.seed(n)
+    args = make_args(n)
+    lines = {}
+    state = {"line": None, "at": 0.0}
+
+    def local(frame, event, arg):
+        now = time.perf_counter()
+        if state["line"] is not None:
+            lines[state["line"]][0] += now - state["at"]
+        if event == "line":
+            stats = lines.setdefault(frame.f_lineno, [0.0, 0, 0])
+            stats[1] += 1
+            stats[2] = max(stats[2], tracemalloc.get_traced_memory()[0])
+            state["line"] = frame.f_lineno
+        elif event == "return":
+            state["line"] = frame.f_back.f_lineno if frame.f_back and frame.f_back.f_code.co_filename == "solution.py" else None
+        state["at"] = time.perf_counter()
+        return local
+
+    def call(frame, event, arg):
+        return local if frame.f_code.co_filename == "solution.py" else None
+
+    tracemalloc.start()
+    sys.settrace(call)
+    try:
+        function(*args)
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+    return lines
+
+try:
+    kinds = {} if spec["inputs"] else {p.name: kind_of(p) for p in inspect.signature(function).parameters.values() if p.default is p.empty and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)}
+    report = {"function": spec["function"], "inputs": spec["inputs"] or describe_inputs(kinds), "sizes": [], "seconds": [], "peak_bytes": []}
+    started = time.perf_counter()
+    sizes = spec["sizes"] or [16 * 4 ** step for step in range(9)]
+    for n in sizes:
+        seconds = time_call(n)
+        report["sizes"].append(n)
+        report["seconds"].append(seconds)
+        report["peak_bytes"].append(peak_memory(n))
+        # Automatic sizes grow until one call or the whole run gets slow
+        if not spec["sizes"] and (seconds > 0.1 or time.perf_counter() - started > spec["budget"]):
+            break
+    # Line tracing is slow, so profile the largest size whose call is quick
+    quick = [n for n, seconds in zip(report["sizes"], report["seconds"]) if seconds < 0.02] or report["sizes"][:1]
+    lines = profile_lines(quick[-1])
+    total = sum(stats[0] for stats in lines.values()) or 1.0
+    hot = sorted(lines.items(), key=lambda item: item[1][0], reverse=True)[:spec["hot_lines"]]
+    report["profile_size"] = quick[-1]
+    report["hot_lines"] = [[line, stats[0] / total, stats[1], linecache.getline("solution.py", line).strip()] for line, stats in hot if stats[0] / total >= 0.01]
+    if lines:
+        line, stats = max(lines.items(), key=lambda item: item[1][2])
+        report["peak_line"] = [line, stats[2], linecache.getline("solution.py", line).strip()]
+except Exception:
+    traceback.print_exc()
+    sys.exit(1)
+print("FUNKY_BENCHMARK " + json.dumps(report))
+'''
+
+COMPLEXITY_MODELS = (
+    ("O(1)", lambda n: 1.0),
+    ("O(log n)", lambda n: math.log(n)),
+    ("O(n)", lambda n: n),
+    ("O(n log n)", lambda n: n * math.log(n)),
+    ("O(n^2)", lambda n: n ** 2),
+    ("O(n^3)", lambda n: n ** 3),
+)
+
+def estimate_complexity(sizes: List[int], seconds: List[float]) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Fit measured run times to the usual complexity classes.
+    
+    Each class c * f(n) is fitted in log space, where the best c is the mean of
+    log(t / f(n)). A faster-growing class only wins if it halves the spread of the
+    measurements around the fit, so timing noise does not inflate the estimate.
+    
+    Args:
+        sizes: Input sizes, at least 3 of them
+        seconds: Time per call at each size
+        
+    Returns:
+        The best-fitting class, e.g. "O(n log n)", and the slope of log(time) over log(n), or (None, None) with too few points
+    """
+    points = [(n, t) for n, t in zip(sizes, seconds) if n > 1 and t > 0]
+    if len(points) < 3:
+        return None, None
+    xs = [math.log(n) for n, _ in points]
+    ys = [math.log(t) for _, t in points]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    exponent = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread if spread else 0.0
+    best, best_error = None, None
+    for name, model in COMPLEXITY_MODELS:
+        residuals = [y - math.log(model(n)) for (n, _), y in zip(points, ys)]
+        mean = sum(residuals) / len(residuals)
+        error = sum((residual - mean) ** 2 for residual in residuals)
+        if best_error is None or error < best_error * 0.5:
+            best, best_error = name, error
+    return best, exponent
+
+class BenchmarkResult(NamedTuple):
+    """Measurements of one function at growing input sizes."""
+    function: str
+    ok: bool
+    inputs: str = ""
+    sizes: Tuple[int, ...] = ()
+    seconds: Tuple[float, ...] = ()
+    peak_bytes: Tuple[int, ...] = ()
+    complexity: Optional[str] = None
+    exponent: Optional[float] = None
+    profile_size: Optional[int] = None
+    hot_lines: Tuple[Tuple[int, float, int, str], ...] = ()
+    peak_line: Optional[Tuple[int, int, str]] = None
+    output: str = ""
+
+def format_size(count: float) -> str:
+    """Render a byte count with a binary unit."""
+    for unit in ("B", "KB", "MB"):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} GB"
+
+def format_duration(seconds: float) -> str:
+    """Render a duration with the unit that suits it."""
+    for unit, scale in (("ns", 1e9), ("µs", 1e6), ("ms", 1e3)):
+        if seconds * scale < 1000:
+            return f"{seconds * scale:.1f} {unit}"
+    return f"{seconds:.2f} s"
+
+def format_benchmark(result: BenchmarkResult) -> str:
+    """
+    Render a benchmark as a size/time/memory table followed by the complexity and profile.
+    
+    Args:
+        result: The benchmark
+        
+    Returns:
+        The report text
+    """
+    if not result.ok:
+        return f"Benchmark of {result.function} failed:\n{result.output}"
+    lines = [f"Benchmark of {result.function} with {result.inputs}", f"{'n':>10}  {'time per call':>14}  {'peak memory':>12}"]
+    lines += [f"{n:>10}  {format_duration(seconds):>14}  {format_size(peak):>12}" for n, seconds, peak in zip(result.sizes, result.seconds, result.peak_bytes)]
+    if result.complexity:
+        lines.append(f"Estimated complexity: {result.complexity} (time grows as n^{result.exponent:.2f})")
+    if result.hot_lines:
+        lines.append(f"Hot lines at n={result.profile_size}:")
+        lines += [f"  line {line}: {share:.0%} of the time, {hits} hits -- {source}" for line, share, hits, source in result.hot_lines]
+    if result.peak_line:
+        line, peak, source = result.peak_line
+        lines.append(f"Memory peaked at {format_size(peak)} on line {line} -- {source}")
+    return "\n".join(lines)
+
+def run_benchmark(code: str, function: str, sizes: Optional[List[int]] = None, inputs: Optional[str] = None, timeout: float = 60.0, memory_mb: int = 1024, repeat: int = 5, hot_lines: int = 5) -> BenchmarkResult:
+    """
+    Measure how a function scales, in the validation sandbox.
+    
+    Args:
+        code: Python code defining the function
+        function: Name of the function to measure
+        sizes: Input sizes, or None to grow them by 4x from 16 until a call takes over 0.1s
+        inputs: Python expression of n building the arguments (a tuple for several), or None
+            to build them from the function's parameter names and annotations
+        timeout: Seconds the whole run may take
+        memory_mb: Memory limit of the run in MB
+        repeat: Timing repeats at each size; the best is kept
+        hot_lines: Number of the slowest lines to report
+        
+    Returns:
+        The measurements, with the estimated complexity
+    """
+    spec = {"function": function, "sizes": sizes or [], "inputs": inputs, "repeat": max(repeat, 1), "hot_lines": hot_lines, "budget": timeout / 3}
+    ok, output, _ = run_sandboxed({"solution.py": code, "bench.json": json.dumps(spec), "runner.py": BENCHMARK_RUNNER}, timeout, memory_mb)
+    match = re.search(r"^FUNKY_BENCHMARK (.*)$", output, re.MULTILINE)
+    if not ok or not match:
+        return BenchmarkResult(function, False, output=output.strip()[-CodeValidator.OUTPUT_LIMIT:])
+    report = json.loads(match.group(1))
+    complexity, exponent = estimate_complexity(report["sizes"], report["seconds"])
+    return BenchmarkResult(
+        function, True, report["inputs"], tuple(report["sizes"]), tuple(report["seconds"]), tuple(report["peak_bytes"]), complexity, exponent,
+        report.get("profile_size"), tuple(tuple(line) for line in report.get("hot_lines", [])),
+        tuple(report["peak_line"]) if report.get("peak_line") else None)
+
+class LintIssue(NamedTuple):
+    """One slow pattern found in a piece of code."""
+    line: int
+    rule: str
+    message: str
+
+class PerformanceLinter(ast.NodeVisitor):
+    """
+    Find avoidable slow patterns in Python code from its AST, without running it.
+    
+    Which names hold lists or strings is inferred per function from their assignments
+    and annotations; a name that is ever bound to anything else is left alone, so the
+    rules only fire where the type is clear.
+    """
+    LIST_CALLS = frozenset(("list", "sorted"))
+    STR_CALLS = frozenset(("str", "repr", "format", "chr"))
+    OTHER_CALLS = frozenset(("set", "frozenset", "dict", "tuple", "deque", "Counter", "defaultdict", "OrderedDict", "bytearray"))
+    COPY_CALLS = frozenset(("list", "sorted", "tuple", "set"))
+
+    def __init__(self):
+        self.issues: List[LintIssue] = []
+        self.__loops = 0
+        self.__functions = 0
+        self.__kinds: Dict[str, Optional[str]] = {}
+
+    def lint(self, tree: ast.AST) -> List[LintIssue]:
+        """
+        Collect the issues of a parsed module.
+        
+        Args:
+            tree: The module's AST
+            
+        Returns:
+            The distinct issues, in line order
+        """
+        self.__kinds = self.__infer_kinds(tree, None)
+        self.visit(tree)
+        return sorted(set(self.issues))
+
+    def __report(self, node: ast.AST, rule: str, message: str):
+        self.issues.append(LintIssue(node.lineno, rule, message))
+
+    @staticmethod
+    def __call_name(node: ast.AST) -> Optional[str]:
+        """The name of a called function or method, e.g. "list" or "pop"."""
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                return node.func.id
+            if isinstance(node.func, ast.Attribute):
+                return node.func.attr
+        return None
+
+    @staticmethod
+    def __annotation_kind(annotation: Optional[ast.AST]) -> Optional[str]:
+        """"list", "str" or "other" for a type annotation, or None if it says nothing useful."""
+        if isinstance(annotation, ast.Subscript):
+            annotation = annotation.value
+        if isinstance(annotation, ast.Attribute):
+            annotation = ast.Name(annotation.attr)
+        if not isinstance(annotation, ast.Name):
+            return None
+        if annotation.id in ("list", "List"):
+            return "list"
+        if annotation.id == "str":
+            return "str"
+        return "other"
+
+    def __kind(self, node: ast.AST, kinds: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """"list", "str" or "other" for the value of an expression, or None if it is unknown."""
+        kinds = self.__kinds if kinds is None else kinds
+        if isinstance(node, (ast.List, ast.ListComp)):
+            return "list"
+        if isinstance(node, ast.JoinedStr) or (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+            return "str"
+        if isinstance(node, (ast.Set, ast.SetComp, ast.Dict, ast.DictComp, ast.Tuple)):
+            return "other"
+        if isinstance(node, ast.Name):
+            return kinds.get(node.id)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mult)):
+            return self.__kind(node.left, kinds) or self.__kind(node.right, kinds)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod):
+            return self.__kind(node.left, kinds)
+        name = self.__call_name(node)
+        method = name if name and isinstance(node.func, ast.Attribute) else None
+        if name in self.LIST_CALLS or method in ("split", "splitlines"):
+            return "list"
+        if name in self.STR_CALLS or method in ("join", "strip", "lower", "upper", "replace"):
+            return "str"
+        if name in self.OTHER_CALLS:
+            return "other"
+        return None
+
+    @classmethod
+    def __scope_nodes(cls, node: ast.AST) -> Iterator[ast.AST]:
+        """The nodes of a module or function body, in source order, without those of nested functions and classes."""
+        for child in ast.iter_child_nodes(node):
+            yield child
+            if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+                yield from cls.__scope_nodes(child)
+
+    def __infer_kinds(self, scope: ast.AST, arguments: Optional[ast.arguments]) -> Dict[str, Optional[str]]:
+        """Map every name a module or function binds to its kind, or None unless it is only ever bound to one kind of value."""
+        kinds, unclear = {}, set()
+
+        def bind(name: str, kind: Optional[str]):
+            if kind is None or kinds.get(name, kind) != kind:
+                unclear.add(name)
+            kinds[name] = kind
+
+        if arguments is not None:
+            for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs:
+                bind(arg.arg, self.__annotation_kind(arg.annotation))
+        for node in self.__scope_nodes(scope):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                bind(node.name, "other")
+            elif isinstance(node, ast.alias):
+                bind((node.asname or node.name).split(".")[0], "other")
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    for name in ast.walk(target):
+                        if isinstance(name, ast.Name):
+                            bind(name.id, self.__kind(node.value, kinds) if name is target else None)
+            elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+                bind(node.target.id, self.__annotation_kind(node.annotation))
+            elif isinstance(node, (ast.For, ast.AsyncFor, ast.With, ast.AsyncWith, ast.comprehension, ast.NamedExpr)):
+                targets = [item.optional_vars for item in node.items] if isinstance(node, (ast.With, ast.AsyncWith)) else [node.target]
+                for target in targets:
+                    for name in ast.walk(target) if target is not None else ():
+                        if isinstance(name, ast.Name):
+                            bind(name.id, None)
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                unclear.update(node.names)
+        return {name: None if name in unclear else kind for name, kind in kinds.items()}
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        kinds, loops = self.__kinds, self.__loops
+        # Names of the enclosing scope stay visible unless the function binds them itself
+        self.__kinds = dict(kinds, **self.__infer_kinds(node, node.args))
+        self.__functions += 1
+        self.__loops = 0
+        for statement in node.body:
+            self.visit(statement)
+        self.__functions -= 1
+        self.__kinds, self.__loops = kinds, loops
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node: ast.Lambda):
+        loops = self.__loops
+        self.__loops = 0
+        self.visit(node.body)
+        self.__loops = loops
+
+    def visit_For(self, node: ast.For):
+        self.visit(node.iter)
+        self.__check_iteration_copy(node.iter)
+        self.__loops += 1
+        for child in [node.target] + node.body:
+            self.visit(child)
+        self.__loops -= 1
+        for child in node.orelse:
+            self.visit(child)
+
+    visit_AsyncFor = visit_For
+
+    def visit_While(self, node: ast.While):
+        self.__loops += 1
+        for child in [node.test] + node.body:
+            self.visit(child)
+        self.__loops -= 1
+        for child in node.orelse:
+            self.visit(child)
+
+    def visit_ListComp(self, node: ast.AST):
+        # The first iterable is evaluated once; everything else runs per item
+        self.visit(node.generators[0].iter)
+        self.__check_iteration_copy(node.generators[0].iter)
+        self.__loops += 1
+        for idx, generator in enumerate(node.generators):
+            if idx:
+                self.visit(generator.iter)
+            for condition in generator.ifs:
+                self.visit(condition)
+        for child in (node.key, node.value) if isinstance(node, ast.DictComp) else (node.elt,):
+            self.visit(child)
+        self.__loops -= 1
+
+    visit_SetComp = visit_GeneratorExp = visit_DictComp = visit_ListComp
+
+    def __check_iteration_copy(self, iterable: ast.AST):
+        """Flag a loop over a copy made only to be iterated once."""
+        if self.__call_name(iterable) == "list" and isinstance(iterable.func, ast.Name) and len(iterable.args) == 1 and self.__call_name(iterable.args[0]) == "range":
+            self.__report(iterable, "needless-copy", "list(range(...)) builds a list just to loop over it; loop over the range itself")
+
+    def __is_concatenation(self, target: ast.AST, value: ast.AST) -> bool:
+        """Whether `target = value` rebuilds target by adding to it (e.g. s = s + x)."""
+        if not (isinstance(target, ast.Name) and isinstance(value, ast.BinOp) and isinstance(value.op, ast.Add)):
+            return False
+        sides = (value.left, value.right)
+        return any(isinstance(side, ast.Name) and side.id == target.id for side in sides)
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        if self.__loops and isinstance(node.op, ast.Add) and isinstance(node.target, ast.Name):
+            if self.__kind(node.target) == "str" or (self.__kind(node.value) == "str" and self.__kind(node.target) is None):
+                self.__report(node, "concat-in-loop", f"'{node.target.id} += ...' copies the whole string on every iteration; collect the pieces in a list and ''.join() them once")
+        self.generic_visit(node)
+
+    def visit_Assign(self, node: ast.Assign):
+        if self.__loops and len(node.targets) == 1 and self.__is_concatenation(node.targets[0], node.value):
+            name = node.targets[0].id
+            kind = self.__kind(node.targets[0]) or self.__kind(node.value)
+            if kind == "str":
+                self.__report(node, "concat-in-loop", f"'{name} = {name} + ...' copies the whole string on every iteration; collect the pieces in a list and ''.join() them once")
+            elif kind == "list":
+                self.__report(node, "concat-in-loop", f"'{name} = {name} + ...' copies the whole list on every iteration; use {name}.append() or {name}.extend()")
+        self.generic_visit(node)
+
+    def visit_Compare(self, node: ast.Compare):
+        if self.__loops:
+            for op, container in zip(node.ops, node.comparators):
+                if not isinstance(op, (ast.In, ast.NotIn)):
+                    continue
+                if isinstance(container, ast.Name) and self.__kind(container) == "list":
+                    self.__report(node, "list-membership", f"'in {container.id}' scans the list on every iteration; keep a set alongside it for membership tests")
+                elif isinstance(container, ast.ListComp) or self.__call_name(container) in self.LIST_CALLS:
+                    self.__report(node, "list-membership", "'in' builds and scans a new list on every iteration; build a set once before the loop")
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node: ast.Subscript):
+        whole = isinstance(node.slice, ast.Slice) and node.slice.lower is None and node.slice.upper is None and node.slice.step is None
+        if self.__loops and whole and isinstance(node.value, ast.Name) and isinstance(node.ctx, ast.Load) and self.__kind(node.value) == "list":
+            self.__report(node, "needless-copy", f"{node.value.id}[:] copies the list on every iteration; copy it once before the loop, if at all")
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        name = self.__call_name(node)
+        receiver = node.func.value if isinstance(node.func, ast.Attribute) else None
+        receiver_kind = self.__kind(receiver) if receiver is not None else None
+        first = node.args[0] if node.args else None
+        if name in ("pop", "insert") and receiver is not None and receiver_kind in ("list", None) and isinstance(first, ast.Constant) and first.value == 0 and len(node.args) == (1 if name == "pop" else 2):
+            replacement = "popleft()" if name == "pop" else "appendleft()"
+            self.__report(node, "pop-front", f"{name}(0) shifts every remaining element of the list; use a collections.deque and {replacement}")
+        elif name == "compile" and isinstance(receiver, ast.Name) and receiver.id == "re":
+            if self.__loops:
+                self.__report(node, "compile-in-loop", "re.compile() runs on every iteration; compile the pattern once, at module level")
+            elif self.__functions:
+                self.__report(node, "compile-per-call", "re.compile() runs on every call; compile the pattern once, at module level")
+        elif name in ("count", "index", "remove") and self.__loops and receiver_kind == "list":
+            self.__report(node, "scan-in-loop", f".{name}() scans the whole list on every iteration; keep a dict or Counter of the items instead")
+        elif name in ("copy", "deepcopy") and self.__loops and (receiver_kind == "list" or (isinstance(receiver, ast.Name) and receiver.id == "copy")):
+            self.__report(node, "needless-copy", f"{name}() copies on every iteration; copy once before the loop, if at all")
+        elif name in self.COPY_CALLS and isinstance(node.func, ast.Name) and len(node.args) == 1 and not node.keywords:
+            rebuilt = self.__call_name(first) in self.LIST_CALLS and isinstance(first.func, ast.Name)
+            if rebuilt or (name == "list" and isinstance(first, (ast.List, ast.ListComp))):
+                self.__report(node, "needless-copy", f"{name}() copies a list that was just built; pass the original iterable or use the list as it is")
+            elif name == "list" and self.__loops and isinstance(first, ast.Name) and self.__kind(first) == "list":
+                self.__report(node, "needless-copy", f"list({first.id}) copies the list on every iteration; copy it once before the loop, if at all")
+        elif name == "len" and isinstance(node.func, ast.Name) and len(node.args) == 1 and (isinstance(first, ast.ListComp) or (self.__call_name(first) == "list" and isinstance(first.func, ast.Name))):
+            self.__report(node, "needless-copy", "len() of a list built only to be counted; use sum(1 for ...) or the length of the source")
+        elif name == "sum" and isinstance(node.func, ast.Name) and len(node.args) == 2 and isinstance(node.args[1], ast.List) and not node.args[1].elts:
+            self.__report(node, "concat-in-loop", "sum(..., []) copies the growing list for every item; use itertools.chain.from_iterable()")
+        self.generic_visit(node)
+
+def lint_code(code: str) -> List[LintIssue]:
+    """
+    Find avoidable slow patterns in Python code: string or list concatenation in loops,
+    list.pop(0) and insert(0, ...), repeated re.compile(), membership tests and scans
+    of lists in loops, and copies that are not needed.
+    
+    Args:
+        code: Python source
+        
+    Returns:
+        The issues found, in line order
+        
+    Raises:
+        SyntaxError: If the code does not parse
+    """
+    return PerformanceLinter().lint(ast.parse(code))
+
+def format_lint(issues: List[LintIssue], version: Optional[int] = None) -> str:
+    """
+    Render lint issues as one line each.
+    
+    Args:
+        issues: The issues, from lint_code()
+        version: The code version they belong to, for the heading
+        
+    Returns:
+        The report text
+    """
+    what = f"Version {version}" if version is not None else "The latest code"
+    if not issues:
+        return f"{what}: no slow patterns found."
+    lines = [f"{what}: {len(issues)} slow pattern{'s' if len(issues) != 1 else ''}"]
+    lines += [f"  line {issue.line} [{issue.rule}]: {issue.message}" for issue in issues]
+    return "\n".join(lines)
+
+class RequestScheduler:
+    """
+    Shared gate for outbound completion requests, keeping every session under the provider's limits.
+    
+    Two token buckets cap requests per minute and (estimated) tokens per minute.
+    Waiting requests are served strictly by priority class ("interactive" before
+    "batch" before "background"), and round-robin across sessions within a class, so
+    one busy session cannot starve the others. Works for threads and asyncio tasks alike.
+    
+    The buckets hold a few seconds' worth of each limit, not a whole minute's, so a
+    burst cannot send a minute's quota at once on top of the steady rate.
+    """
+    PRIORITIES = ("interactive", "batch", "background")
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None, burst_seconds: float = 5.0):
+        """
+        Create the scheduler.
+        
+        Args:
+            requests_per_minute: Request limit, or None for no limit
+            tokens_per_minute: Limit on prompt plus completion tokens, or None for no limit
+            burst_seconds: Seconds' worth of each limit that may be sent at once after a quiet spell
+        """
+        self.__rpm = requests_per_minute
+        self.__tpm = tokens_per_minute
+        # At least one request, so a low limit still lets requests through one at a time
+        self.__request_capacity = max((requests_per_minute or 0.0) * burst_seconds / 60, 1.0)
+        self.__token_capacity = (tokens_per_minute or 0.0) * burst_seconds / 60
+        self.__requests = self.__request_capacity if requests_per_minute else 0.0
+        self.__tokens = self.__token_capacity
+        self.__refilled = time.monotonic()
+        self.__paused_until = 0.0
+        self.__lock = threading.Lock()
+        self.__queues = {priority: OrderedDict() for priority in self.PRIORITIES}
+        self.__timer = None
+        self.__stats = {priority: {"granted": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0} for priority in self.PRIORITIES}
+        self.rate_limited = 0
+
+    @staticmethod
+    def estimate_tokens(request: Dict[str, Any]) -> int:
+        """Estimate the tokens a request will use: its prompt (four characters per token) plus max_tokens."""
+        prompt = sum(len(message.get("content") or "") for message in request.get("messages", [])) // 4
+        return prompt + (request.get("max_tokens") or 0) * (request.get("n") or 1)
+
+    def acquire(self, session: str, priority: str = "interactive", tokens: int = 0, timeout: Optional[float] = None, cancelled: Optional[threading.Event] = None) -> float:
+        """
+        Wait until a request may be sent.
+        
+        Args:
+            session: Key of the session sending it, for fair queuing
+            priority: One of PRIORITIES
+            tokens: Estimated tokens of the request
+            timeout: Seconds to wait at most, or None
+            cancelled: Stop waiting once this event is set
+            
+        Returns:
+            Seconds spent waiting
+        """
+        granted = threading.Event()
+        waiter = self.__enqueue(session, priority, tokens, granted.set)
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while not granted.is_set():
+            remaining = None if give_up is None else give_up - time.monotonic()
+            if cancelled is not None:
+                remaining = 0.1 if remaining is None else min(remaining, 0.1)
+            if granted.wait(remaining):
+                break
+            if cancelled is not None and cancelled.is_set():
+                error = RuntimeError("Request cancelled while queued")
+            elif give_up is not None and time.monotonic() >= give_up:
+                error = TimeoutError(f"Waited {timeout:g}s for the rate limiter")
+            else:
+                continue
+            if self.__withdraw(waiter):
+                raise error
+        return time.monotonic() - waiter["enqueued"]
+
+    async def aacquire(self, session: str, priority: str = "interactive", tokens: int = 0, timeout: Optional[float] = None) -> float:
+        """Wait, without blocking the event loop, until a request may be sent; see acquire()."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self.__enqueue(session, priority, tokens, grant)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if self.__withdraw(waiter):
+                raise TimeoutError(f"Waited {timeout:g}s for the rate limiter")
+            # Granted just as the wait ran out
+            await future
+        except asyncio.CancelledError:
+            self.__withdraw(waiter)
+            raise
+        return time.monotonic() - waiter["enqueued"]
+
+    def settle(self, estimated: int, actual: int):
+        """
+        Correct the token bucket once a request's real usage is known.
+        
+        Args:
+            estimated: Tokens charged when the request was admitted
+            actual: Tokens it really used
+        """
+        with self.__lock:
+            if self.__tpm:
+                self.__tokens = min(self.__tokens + estimated - actual, self.__token_capacity)
+        self.__dispatch()
+
+    def pause(self, seconds: float):
+        """Hold every request back after the provider reported a rate limit anyway."""
+        with self.__lock:
+            self.rate_limited += 1
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+        self.__dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        """Grants, total and longest queue wait per priority, and the requests queued right now."""
+        with self.__lock:
+            stats = {priority: dict(values, queued=sum(len(waiters) for waiters in self.__queues[priority].values())) for priority, values in self.__stats.items()}
+            stats["rate_limited"] = self.rate_limited
+            return stats
+
+    def __enqueue(self, session: str, priority: str, tokens: int, grant: Callable[[], None]) -> Dict[str, Any]:
+        waiter = {"session": session, "priority": priority if priority in self.__queues else "interactive", "tokens": tokens, "grant": grant, "enqueued": time.monotonic()}
+        with self.__lock:
+            self.__queues[waiter["priority"]].setdefault(session, deque()).append(waiter)
+        self.__dispatch()
+        return waiter
+
+    def __withdraw(self, waiter: Dict[str, Any]) -> bool:
+        """Remove a waiter that gave up; False if it had already been granted."""
+        with self.__lock:
+            waiters = self.__queues[waiter["priority"]].get(waiter["session"])
+            if not waiters or waiter not in waiters:
+                return False
+            waiters.remove(waiter)
+            if not waiters:
+                del self.__queues[waiter["priority"]][waiter["session"]]
+            return True
+
+    def __dispatch(self):
+        """Grant waiting requests while the buckets allow, then wake up again when they will have refilled."""
+        granted = []
+        with self.__lock:
+            now = time.monotonic()
+            elapsed, self.__refilled = now - self.__refilled, now
+            if self.__rpm:
+                self.__requests = min(self.__requests + elapsed * self.__rpm / 60, self.__request_capacity)
+            if self.__tpm:
+                self.__tokens = min(self.__tokens + elapsed * self.__tpm / 60, self.__token_capacity)
+            delay = None
+            for priority in self.PRIORITIES:
+                sessions = self.__queues[priority]
+                while sessions:
+                    session, waiters = next(iter(sessions.items()))
+                    waiter = waiters[0]
+                    # A request larger than the whole bucket only waits for a full bucket, and is
+                    # charged in full, so the bucket goes negative and holds back the next requests
+                    tokens = waiter["tokens"] if self.__tpm else 0
+                    delay = max(
+                        self.__paused_until - now,
+                        (1 - self.__requests) * 60 / self.__rpm if self.__rpm else 0.0,
+                        (min(tokens, self.__token_capacity) - self.__tokens) * 60 / self.__tpm if self.__tpm else 0.0,
+                    )
+                    if delay > 0:
+                        break
+                    delay = None
+                    if self.__rpm:
+                        self.__requests -= 1
+                    self.__tokens -= tokens
+                    waiters.popleft()
+                    # Round robin: the session goes to the back of its class
+                    del sessions[session]
+                    if waiters:
+                        sessions[session] = waiters
+                    wait = now - waiter["enqueued"]
+                    stats = self.__stats[priority]
+                    stats["granted"] += 1
+                    stats["wait_seconds"] += wait
+                    stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+                    granted.append(waiter["grant"])
+                if delay is not None:
+                    break
+            if delay is not None and self.__timer is None:
+                self.__timer = threading.Timer(delay, self.__wake_up)
+                self.__timer.daemon = True
+                self.__timer.start()
+        for grant in granted:
+            grant()
+
+    def __wake_up(self):
+        with self.__lock:
+            self.__timer = None
+        self.__dispatch()
+
+class CompressedText:
+    """Text kept zlib-compressed in memory and decompressed on every read."""
+    __slots__ = ("data", "length")
+    LEVEL = 6
+
+    def __init__(self, text: str):
+        self.data = zlib.compress(text.encode("utf-8"), self.LEVEL)
+        self.length = len(text)
+
+    @property
+    def text(self) -> str:
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @classmethod
+    def pack(cls, text: str, min_chars: int = 256) -> Union[str, "CompressedText"]:
+        """
+        Compress text if that saves memory.
+        
+        Args:
+            text: The text
+            min_chars: Shorter texts are returned unchanged
+            
+        Returns:
+            A CompressedText, or the text itself if it is short or does not compress
+        """
+        if len(text) < min_chars:
+            return text
+        packed = cls(text)
+        return packed if sys.getsizeof(packed.data) + sys.getsizeof(packed) < sys.getsizeof(text) else text
+
+def unpack_text(text: Union[str, CompressedText]) -> str:
+    """Return the text of a value produced by CompressedText.pack()."""
+    return text.text if isinstance(text, CompressedText) else text
+
+class StoredMessage:
+    """A compact, compressed conversation message; roles are interned so every message shares one string."""
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: Union[str, CompressedText]):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def as_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": unpack_text(self.content)}
+
+class MessageStore:
+    """
+    The conversation of one session, kept compact in memory.
+    
+    Recent messages are plain dicts, so the requests built from them reuse the same
+    objects turn after turn. Older messages that are no longer sent are swapped for
+    slotted StoredMessage records whose content is zlib-compressed; reading them
+    (history, transcripts, reloading) decompresses them transparently. Indexing and
+    iterating always return plain {"role", "content"} dicts.
+    """
+    MIN_COMPRESS_CHARS = 256
+
+    def __init__(self, messages: Optional[List[Dict[str, str]]] = None):
+        """
+        Create the store.
+        
+        Args:
+            messages: Initial messages with "role" and "content"
+        """
+        self.__messages = [{"role": sys.intern(message["role"]), "content": message["content"]} for message in messages or []]
+        self.__compressed_upto = 0
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict[str, str], List[Dict[str, str]]]:
+        if isinstance(idx, slice):
+            return [self.__load(message) for message in self.__messages[idx]]
+        return self.__load(self.__messages[idx])
+
+    def __setitem__(self, idx: int, message: Dict[str, str]):
+        self.__messages[idx] = message
+
+    def __delitem__(self, idx: Union[int, slice]):
+        del self.__messages[idx]
+        self.__compressed_upto = min(self.__compressed_upto, len(self.__messages))
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return (self.__load(message) for message in self.__messages)
+
+    @staticmethod
+    def __load(message: Union[Dict[str, str], StoredMessage]) -> Dict[str, str]:
+        return message.as_dict() if isinstance(message, StoredMessage) else message
+
+    def append(self, message: Dict[str, str]):
+        self.__messages.append(message)
+
+    def insert(self, idx: int, message: Dict[str, str]):
+        self.__messages.insert(idx, message)
+        self.__compressed_upto = 0
+
+    def role(self, idx: int) -> str:
+        """Role of a message, without decompressing it."""
+        message = self.__messages[idx]
+        return message.role if isinstance(message, StoredMessage) else message["role"]
+
+    def length(self, idx: int) -> int:
+        """Length of a message's content in characters, without decompressing it."""
+        message = self.__messages[idx]
+        if isinstance(message, StoredMessage):
+            return message.content.length if isinstance(message.content, CompressedText) else len(message.content)
+        return len(message["content"])
+
+    def compress(self, before: int, unsent: Optional[List[int]] = None):
+        """
+        Compress the user and assistant messages that are no longer sent; system messages stay as they are.
+        
+        Args:
+            before: Index of the first message that is still sent with every request
+            unsent: Indexes of later messages that are not sent as they are either
+        """
+        before = min(before, len(self.__messages))
+        for idx in list(range(self.__compressed_upto, before)) + [idx for idx in unsent or [] if before <= idx < len(self.__messages)]:
+            message = self.__messages[idx]
+            if isinstance(message, dict) and message["role"] != "system":
+                self.__messages[idx] = StoredMessage(message["role"], CompressedText.pack(message["content"], self.MIN_COMPRESS_CHARS))
+        self.__compressed_upto = max(self.__compressed_upto, before)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Account for the memory the messages take.
+        
+        Returns:
+            Message counts, the characters of text held, and the bytes used by plain and compressed messages
+        """
+        usage = {"messages": len(self.__messages), "compressed_messages": 0, "chars": 0, "plain_bytes": 0, "compressed_bytes": 0, "bytes": sys.getsizeof(self.__messages)}
+        for message in self.__messages:
+            if isinstance(message, StoredMessage):
+                content = message.content
+                size = sys.getsizeof(message) + (sys.getsizeof(content) + sys.getsizeof(content.data) if isinstance(content, CompressedText) else sys.getsizeof(content))
+                usage["compressed_messages"] += 1
+                usage["compressed_bytes"] += size
+                usage["chars"] += content.length if isinstance(content, CompressedText) else len(content)
+            else:
+                size = sys.getsizeof(message) + sys.getsizeof(message["content"])
+                usage["plain_bytes"] += size
+                usage["chars"] += len(message["content"])
+            usage["bytes"] += size
+        return usage
+
+class ContextWindow:
+    """
+    Fits a conversation into a token budget before it is sent to the LLM.
+    
+    The messages sent only change shape when the budget is exceeded. Then superseded
+    code blocks are collapsed (only the latest version is sent in full) and the oldest
+    turns are dropped - optionally behind a short summary of what the user asked for -
+    down to a fraction of the budget. Later turns reuse that layout until the budget is
+    hit again, so the start of each request stays byte-identical and providers can
+    serve it from their prompt cache. max_tokens is chosen from the room that is left.
+    """
+    CODE_BLOCK_PATTERN = re.compile(r"```[\w+-]*\n.*?```", re.DOTALL)
+    COLLAPSED_CODE = "```python\n# earlier version omitted - see the latest code below\n```"
+    SUMMARY_REQUESTS = 10
+    TRIM_TARGET = 0.75
+
+    def __init__(self, model: str, budget: int = 16000, min_response_tokens: int = 256, collapse_code: bool = True, summarize: bool = True):
+        """
+        Configure the context window.
+        
+        Args:
+            model: LLM model, used to count tokens
+            budget: Maximum tokens for the prompt and the response together
+            min_response_tokens: Room always left for the response
+            collapse_code: Replace code blocks of superseded versions with a placeholder
+            summarize: Leave a note listing the requests of dropped turns
+        """
+        self.model = model
+        self.budget = budget
+        self.min_response_tokens = min_response_tokens
+        self.collapse_code = collapse_code
+        self.summarize = summarize
+        self.__token_counts = {}
+        self.reset()
+
+    def reset(self):
+        """Forget the current layout, e.g. after the conversation was replaced."""
+        self.__cut = 0
+        self.__note = None
+        self.__rewritten = {}
+
+    @property
+    def cut(self) -> int:
+        """Index of the first conversation message after the leading system messages that is still sent."""
+        return self.__cut
+
+    @property
+    def collapsed(self) -> List[int]:
+        """Indexes of the conversation messages that are sent with their code collapsed."""
+        return list(self.__rewritten)
+
+    def count_tokens(self, message: Dict[str, str]) -> int:
+        """
+        Count the tokens of one message, remembering the result for unchanged messages.
+        
+        Args:
+            message: A conversation message
+            
+        Returns:
+            Number of tokens the message takes in the prompt
+        """
+        key = (message["role"], message["content"])
+        count = self.__token_counts.get(key)
+        if count is None:
+            try:
+                count = get_litellm().token_counter(model=self.model, messages=[message])
+            except Exception:
+                count = len(message["content"]) // 4 + 4
+            self.__token_counts[key] = count
+        return count
+
+    def fit(self, conversation: List[Dict[str, str]], max_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+        """
+        Build the messages to send for the next turn.
+        
+        Args:
+            conversation: The full conversation, ending with the new user message
+            max_tokens: The configured maximum tokens for the response
+            
+        Returns:
+            The messages to send and the max_tokens to request
+        """
+        head = 0
+        while head < len(conversation) and conversation[head]["role"] == "system":
+            head += 1
+        if self.__cut < head or self.__cut >= len(conversation):
+            self.reset()
+            self.__cut = head
+        messages = self.__layout(conversation, head)
+        used = sum(self.count_tokens(message) for message in messages)
+        limit = self.budget - self.min_response_tokens
+        if used > limit:
+            messages = self.__trim(conversation, head, int(limit * self.TRIM_TARGET))
+            used = sum(self.count_tokens(message) for message in messages)
+        # Forget counts for messages that are no longer sent, so their text can be freed (or compressed)
+        self.__token_counts = {key: self.__token_counts[key] for key in [(m["role"], m["content"]) for m in messages] if key in self.__token_counts}
+
+        room = max(self.budget - used, self.min_response_tokens)
+        return messages, min(max_tokens, room)
+
+    def __layout(self, conversation: List[Dict[str, str]], head: int) -> List[Dict[str, str]]:
+        """Apply the current cut, summary note and collapsed messages to the conversation."""
+        messages = conversation[:head] + ([self.__note] if self.__note else [])
+        for idx in range(self.__cut, len(conversation)):
+            # The conversation only grows between resets, so a collapsed message still stands for its original
+            messages.append(self.__rewritten.get(idx) or conversation[idx])
+        return messages
+
+    def __trim(self, conversation: List[Dict[str, str]], head: int, target: int) -> List[Dict[str, str]]:
+        """Collapse superseded code and drop the oldest turns until the prompt fits the target."""
+        if self.collapse_code:
+            self.__rewritten = self.__collapse_superseded_code(conversation, head)
+        cut = self.__cut
+        last = len(conversation) - 1
+        while True:
+            self.__cut = cut
+            self.__note = self.__summarize(conversation[head:cut])
+            messages = self.__layout(conversation, head)
+            if cut >= last or sum(self.count_tokens(message) for message in messages) <= target:
+                self.__rewritten = {idx: collapsed for idx, collapsed in self.__rewritten.items() if idx >= cut}
+                return messages
+            # Drop whole turns so the history never starts with an orphaned reply
+            cut += 1
+            while cut < last and conversation[cut]["role"] != "user":
+                cut += 1
+
+    def __collapse_superseded_code(self, conversation: List[Dict[str, str]], head: int) -> Dict[int, Dict[str, str]]:
+        """Map each superseded code-bearing assistant message that is still sent to a copy with its code collapsed."""
+        head = max(head, self.__cut)
+        latest = None
+        for idx in range(head, len(conversation)):
+            message = conversation[idx]
+            if message["role"] == "assistant" and "```" in message["content"] and self.CODE_BLOCK_PATTERN.search(message["content"]):
+                latest = idx
+        rewritten = {}
+        for idx in range(head, latest or head):
+            message = conversation[idx]
+            if message["role"] == "assistant" and "```" in message["content"]:
+                rewritten[idx] = {"role": "assistant", "content": self.CODE_BLOCK_PATTERN.sub(self.COLLAPSED_CODE, message["content"])}
+        return rewritten
+
+    def __summarize(self, dropped: List[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        """Build a system note listing the user requests of dropped turns and any instructions still in effect."""
+        parts = []
+        requests = [message["content"].strip().replace("\n", " ") for message in dropped if message["role"] == "user"]
+        if requests and self.summarize:
+            lines = [f"- {request[:120]}" for request in requests[-self.SUMMARY_REQUESTS:]]
+            parts.append("Earlier turns were removed to save space. In them the user asked:\n" + "\n".join(lines))
+        instructions = [message["content"] for message in dropped if message["role"] == "system"]
+        if instructions:
+            # A mode switch that was dropped is still in effect
+            parts.append(instructions[-1])
+        return {"role": "system", "content": "\n\n".join(parts)} if parts else None
+
+class SessionJournal:
+    """
+    Append-only JSONL log of a session's conversation.
+    
+    Every change to the conversation is written as one line as soon as it happens, so
+    saving costs O(new messages) and a session survives a crash. A snapshot of the whole
+    conversation is written when the journal starts, on reset and every few hundred
+    records, so loading only has to read the file from the last snapshot onwards.
+    """
+    SNAPSHOT_MARKER = b'{"op": "snapshot"'
+    READ_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, filename: str, fsync: bool = False, snapshot_every: int = 200):
+        """
+        Open a journal for appending.
+        
+        Args:
+            filename: Path to the JSONL file (created if missing)
+            fsync: Force every record to disk before returning
+            snapshot_every: Records between automatic snapshots
+        """
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filename = filename
+        self.__fsync = fsync
+        self.__snapshot_every = snapshot_every
+        self.__records_since_snapshot = 0
+        self.__drop_torn_tail(filename)
+        self.__file = open(filename, "a", encoding="utf-8")
+
+    @classmethod
+    def __drop_torn_tail(cls, filename: str):
+        """Cut a record left unfinished by a crash, so the next one starts on a line of its own."""
+        try:
+            file = open(filename, "r+b")
+        except FileNotFoundError:
+            return
+        with file:
+            position = file.seek(0, os.SEEK_END)
+            if position == 0:
+                return
+            file.seek(position - 1)
+            if file.read(1) == b"\n":
+                return
+            while position > 0:
+                size = min(cls.READ_BLOCK_SIZE, position)
+                position -= size
+                file.seek(position)
+                end = file.read(size).rfind(b"\n")
+                if end >= 0:
+                    file.truncate(position + end + 1)
+                    return
+            file.truncate(0)
+
+    def record(self, op: str, **fields):
+        """
+        Append one record.
+        
+        Args:
+            op: Record type: "snapshot", "message", "system", "mode" or "truncate"
+            fields: The record's data
+        """
+        self.__file.write(json.dumps(dict(op=op, ts=round(time.time(), 3), **fields)) + "\n")
+        self.__file.flush()
+        if self.__fsync:
+            os.fsync(self.__file.fileno())
+        self.__records_since_snapshot += 1
+
+    def snapshot(self, conversation: List[Dict[str, str]], **numbering):
+        """
+        Append the whole conversation so loading can start from here.
+        
+        Args:
+            conversation: The conversation
+            numbering: dropped_turns and dropped_versions of a trimmed conversation, so
+                resuming it keeps the turn and code version numbers
+        """
+        self.record("snapshot", messages=list(conversation), **numbering)
+        self.__records_since_snapshot = 0
+
+    def message(self, message: Dict[str, str], conversation: List[Dict[str, str]], **numbering):
+        """
+        Append a message, taking a snapshot instead when one is due.
+        
+        Args:
+            message: The message just added
+            conversation: The conversation including the new message
+            numbering: Passed on to snapshot()
+        """
+        if self.__records_since_snapshot >= self.__snapshot_every:
+            self.snapshot(conversation, **numbering)
+        else:
+            self.record("message", role=message["role"], content=message["content"])
+
+    def close(self):
+        """Close the journal file."""
+        self.__file.close()
+
+    @classmethod
+    def load(cls, filename: str) -> List[Dict[str, str]]:
+        """
+        Rebuild a conversation from a journal.
+        
+        The file is read backwards until the last snapshot, so only the tail is parsed.
+        
+        Args:
+            filename: Path to the JSONL file
+            
+        Returns:
+            The conversation messages
+        """
+        return cls.load_state(filename)[0]
+
+    @classmethod
+    def load_state(cls, filename: str) -> Tuple[List[Dict[str, str]], Optional[str], Dict[str, int]]:
+        """
+        Rebuild a conversation from a journal, along with a mode switch still waiting for the next turn.
+        
+        Args:
+            filename: Path to the JSONL file
+            
+        Returns:
+            The conversation messages, the pending system instructions or None, and the
+            numbering of a trimmed conversation (see snapshot())
+        """
+        lines = cls.__tail_lines(filename)
+        conversation, pending, numbering = [], None, {}
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record cut short by a crash
+                continue
+            if record["op"] == "snapshot":
+                conversation = [{"role": message["role"], "content": message["content"]} for message in record["messages"]]
+                pending = None
+                numbering = {key: record[key] for key in ("dropped_turns", "dropped_versions") if key in record}
+            elif record["op"] == "message":
+                conversation.append({"role": record["role"], "content": record["content"]})
+                pending = None if record["role"] == "system" else pending
+            elif record["op"] == "mode":
+                pending = record["content"]
+            elif record["op"] == "truncate":
+                del conversation[record["length"]:]
+            elif record["op"] == "system":
+                if conversation and conversation[0]["role"] == "system":
+                    conversation[0] = {"role": "system", "content": record["content"]}
+                else:
+                    conversation.insert(0, {"role": "system", "content": record["content"]})
+        return conversation, pending, numbering
+
+    @classmethod
+    def __tail_lines(cls, filename: str) -> List[bytes]:
+        """Return the lines from the last snapshot to the end of the file."""
+        with open(filename, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            position = file.tell()
+            buffer = b""
+            while position > 0:
+                size = min(cls.READ_BLOCK_SIZE, position)
+                position -= size
+                file.seek(position)
+                buffer = file.read(size) + buffer
+                lines = buffer.split(b"\n")
+                # The first piece may be a partial line unless we reached the start of the file
+                complete = lines if position == 0 else lines[1:]
+                for idx in range(len(complete) - 1, -1, -1):
+                    if complete[idx].startswith(cls.SNAPSHOT_MARKER):
+                        return [line for line in complete[idx:] if line.strip()]
+            return [line for line in buffer.split(b"\n") if line.strip()]
+
+class CoderOptions(NamedTuple):
+    """
+    Settings of a FunkyCoder agent; every one has a default.
+    
+    Pass one to FunkyCoder(), or set single ones as keyword arguments.
+    
+    Attributes:
+        model: LLM model to use
+        max_tokens: Maximum tokens for completion
+        temperature: Temperature for completion (0-1)
+        stream: Stream responses token-by-token by default
+        api_base: Optional OpenAI-compatible endpoint to send requests to
+        cache: Optional response cache consulted before calling the LLM
+        context_budget: Token budget for prompt plus response; None sends the whole history
+        metrics_hook: Called with the TurnStats of every turn, e.g. to forward them to telemetry
+        speculate: After each turn that produces code, prefetch the documentation and test follow-ups
+        speculation_budget: Maximum estimated spend in US dollars on speculative requests
+        deadline: Seconds a turn may take, retries included; None for no limit
+        max_retries: Retries after a transient error (rate limit, timeout, server error)
+        hedge: Send a second request when the first is slower than usual to respond, keeping whichever answers first
+        hedge_after: Seconds before hedging; None uses the p95 of recent turns
+        routes: Model for each kind of task ("new", "refine", "docs", "tests"); tasks without one use model,
+            which also takes over when a routed model's answer contains no code
+        edit_mode: Ask for search/replace patches against the latest code on refinement and documentation
+            turns, and apply them locally, instead of having the model repeat the whole function
+        validator: Check each new version of the code (and its tests) in the background; failures are
+            reported to the model at the start of the next turn
+        candidates: Answers generated at once for each prompt; the one whose code compiles and passes
+            the most tests is kept
+        scheduler: Rate limiter shared with other agents; every request waits for its turn there
+        priority: The scheduler's priority class for this agent's prompts ("interactive" or "batch");
+            speculative requests always run as "background"
+        session: Key this agent is queued under for fair sharing of the scheduler (defaults to a random one)
+        library: Library of saved functions; code saved with save_code_to_file() is added to it, and
+            requests for a new function are looked up in it
+        library_mode: What to do with a close match: "hint" sends it to the model as a starting point,
+            "reuse" answers the request with it at once
+        library_threshold: Minimum similarity (0 to 1) of a library match
+        lint: Check each new version of the code for slow patterns with lint_code(); the ones found
+            are reported to the model at the start of the next turn
+    """
+    model: str = "openai/gpt-4o"
+    max_tokens: int = 1500
+    temperature: float = 0.7
+    stream: bool = True
+    api_base: Optional[str] = None
+    cache: Optional[ResponseCache] = None
+    context_budget: Optional[int] = None
+    metrics_hook: Optional[Callable[[TurnStats], None]] = None
+    speculate: bool = False
+    speculation_budget: float = 0.25
+    deadline: Optional[float] = 180.0
+    max_retries: int = 2
+    hedge: bool = False
+    hedge_after: Optional[float] = None
+    routes: Optional[Dict[str, str]] = None
+    edit_mode: bool = False
+    validator: Optional[CodeValidator] = None
+    candidates: int = 1
+    scheduler: Optional[RequestScheduler] = None
+    priority: str = "interactive"
+    session: Optional[str] = None
+    library: Optional[FunctionLibrary] = None
+    library_mode: str = "hint"
+    library_threshold: float = 0.5
+    lint: bool = False
+
+class FunkyCoder:
+    MODE_SWITCH_PREFIX = "From now on, follow these instructions instead of the earlier ones:\n"
+    FEEDBACK_PREFIX = "[Automatic feedback]\n"
+    RETRY_BASE_DELAY = 0.5
+    RETRY_MAX_DELAY = 8.0
+    HEDGE_DEFAULT_DELAY = 5.0
+    BENCHMARK_TIMEOUT = 60.0
+    BENCHMARK_MEMORY_MB = 1024
+    # Charged to the speculation budget for models LiteLLM has no price for (US dollars per token)
+    UNKNOWN_COST_PER_TOKEN = 10e-6
+
+    def __init__(self, api_key: str, system_message: str, options: Optional[CoderOptions] = None, **overrides):
+        """
+        Initialize the FunkyCoder with API key and configuration settings.
+        
+        Args:
+            api_key: OpenAI API key
+            system_message: Initial system instructions for the agent
+            options: The agent's settings (defaults to CoderOptions())
+            overrides: Single settings of CoderOptions to change, e.g. model="openai/gpt-4o-mini"
+            
+        Raises:
+            ValueError: If an override is not a field of CoderOptions
+        """
+        options = (options or CoderOptions())._replace(**overrides)
+        self.__conversation = MessageStore([{"role": "system", "content": system_message}])
+        self.__system_message = system_message
+        self.__applied_system_message = system_message
+        self.__api_key = api_key
+        self.__model = options.model
+        self.__max_tokens = options.max_tokens
+        self.__temperature = options.temperature
+        self.__stream = options.stream
+        self.__api_base = options.api_base
+        self.__last_time_to_first_token = None
+        self.__last_error = None
+        self.__cache = options.cache
+        self.__code_blocks = []
+        self.__latest_python = None
+        self.__turns = 0
+        # Turns and code versions trimmed off the front of the conversation, which keep their numbers
+        self.__dropped_turns = 0
+        self.__dropped_versions = 0
+        self.__turn_stats = []
+        self.__metrics_hook = options.metrics_hook
+        self.__turn_started = None
+        self.__turn_request = None
+        self.__turn_usage = None
+        self.__journal = None
+        self.__deadline = options.deadline
+        self.__max_retries = options.max_retries
+        self.__hedge = options.hedge
+        self.__hedge_after = options.hedge_after
+        self.__turn_retries = 0
+        self.__turn_hedged = False
+        self.__turn_rollback = (1, system_message, None, None)
+        self.__routes = dict(options.routes or {})
+        self.__turn_task = None
+        self.__turn_fallback = None
+        self.__edit_mode = options.edit_mode
+        self.__turn_edit = None
+        self.__turn_messages = None
+        self.__turn_notes = []
+        self.__validator = options.validator
+        self.__candidates = max(options.candidates, 1)
+        self.__scheduler = options.scheduler
+        self.__priority = options.priority
+        self.__session = options.session or uuid.uuid4().hex
+        self.__library = options.library
+        self.__library_mode = options.library_mode
+        self.__library_threshold = options.library_threshold
+        self.__function_request = None
+        self.__turn_library = None
+        self.__turn_library_match = None
+        self.__last_benchmark = None
+        self.__turn_cancelled = threading.Event()
+        self.__keep_partial = False
+        self.__in_turn = False
+        self.__last_cancelled = False
+        # Every response stream the turn is reading, from the main thread, hedged requests or candidates
+        self.__turn_streams = set()
+        self.__streams_lock = threading.Lock()
+        self.__claimed_speculation = None
+        self.__lint = options.lint
+        self.__lint_results = {}
+        self.__lint_report = None
+        self.__admission_lock = threading.Lock()
+        self.__turn_queue_wait = 0.0
+        self.__turn_scheduled_tokens = 0
+        self.__candidate_validator = None
+        self.__turn_candidates = 1
+        self.__validation = None
+        self.__validation_results = []
+        self.__speculate = options.speculate
+        self.__speculation_budget = options.speculation_budget
+        self.__speculations = {}
+        self.__speculation_executor = None
+        self.__speculation_lock = threading.Lock()
+        self.__speculation_stats = {"launched": 0, "served": 0, "discarded": 0, "spent": 0.0}
+        # Estimated cost of the speculative requests still running, held against the budget
+        self.__speculation_reserved = 0.0
+        self.__context_window = ContextWindow(options.model, options.context_budget) if options.context_budget else None
+
+    @property
+    def context_window(self) -> Optional[ContextWindow]:
+        """The token budget applied to each request, or None."""
+        return self.__context_window
+
+    @property
+    def turn_stats(self) -> List[TurnStats]:
+        """Measurements of every turn so far, oldest first."""
+        return list(self.__turn_stats)
+
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        """The response cache in front of the LLM, or None."""
+        return self.__cache
+
+    @property
+    def last_time_to_first_token(self) -> Optional[float]:
+        """Seconds until the first token of the last streamed response arrived, or None."""
+        return self.__last_time_to_first_token
+
+    @property
+    def candidates(self) -> int:
+        """Default number of candidate answers per prompt."""
+        return self.__candidates
+
+    @property
+    def conversation(self) -> List[Dict[str, str]]:
+        """A copy of the conversation, oldest message first."""
+        return [dict(message) for message in self.__conversation]
+
+    @property
+    def system_message(self) -> str:
+        """The system instructions currently in effect."""
+        return self.__system_message
+
+    @property
+    def last_cancelled(self) -> bool:
+        """Whether the latest turn was stopped with cancel()."""
+        return self.__last_cancelled
+
+    @property
+    def last_error(self) -> Optional[str]:
+        """Error message of the last turn if it failed, or None."""
+        return self.__last_error
+
+    def set_system_message(self, system_message: str) -> None:
+        """
+        Switch the agent to new system instructions.
+        
+        Before the first turn the system message is simply replaced. Afterwards the
+        earlier messages are left untouched, so requests keep a stable prefix for
+        provider prompt caching, and the new instructions are added once, right before
+        the next user message.
+        
+        Args:
+            system_message: New system instructions for the agent
+        """
+        self.__system_message = system_message
+        if any(message["role"] != "system" for message in self.__conversation):
+            self.__record_pending_mode()
+            return
+        if self.__conversation:
+            self.__conversation[0] = {"role": "system", "content": system_message}
+        else:
+            self.__conversation.insert(0, {"role": "system", "content": system_message})
+        self.__applied_system_message = system_message
+        if self.__journal:
+            self.__journal.record("system", content=system_message)
+
+    def start_journal(self, filename: str, fsync: bool = False):
+        """
+        Write every change to the conversation to an append-only journal from now on.
+        
+        Args:
+            filename: Path to the JSONL journal
+            fsync: Force every record to disk
+        """
+        self.close_journal()
+        self.__journal = SessionJournal(filename, fsync)
+        self.__journal.snapshot(self.__conversation, **self.__numbering())
+        self.__record_pending_mode()
+
+    def __record_pending_mode(self):
+        """Journal a mode switch that is waiting for the next turn, so resuming keeps it."""
+        if self.__journal and self.__system_message != self.__applied_system_message:
+            self.__journal.record("mode", content=self.__system_message)
+
+    def resume(self, filename: str, fsync: bool = False) -> bool:
+        """
+        Load the conversation from a journal and keep appending to it.
+        
+        Args:
+            filename: Path to the JSONL journal
+            fsync: Force every record to disk
+            
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            conversation, pending_mode, numbering = SessionJournal.load_state(filename)
+        except Exception as e:
+            print(f"Error loading session: {str(e)}")
+            return False
+        self.load_conversation(conversation, **numbering)
+        self.close_journal()
+        self.__journal = SessionJournal(filename, fsync)
+        if pending_mode:
+            self.set_system_message(pending_mode)
+        print(f"Session loaded from {filename} ({len(conversation)} messages)")
+        return True
+
+    def close_journal(self):
+        """Stop journaling the conversation."""
+        if self.__journal:
+            self.__journal.close()
+            self.__journal = None
+
+    @property
+    def journal_file(self) -> Optional[str]:
+        """Path of the journal the conversation is written to, or None."""
+        return self.__journal.filename if self.__journal else None
+
+    def load_conversation(self, conversation: List[Dict[str, str]], dropped_turns: int = 0, dropped_versions: int = 0):
+        """
+        Replace the conversation, rebuilding the code index from its assistant messages.
+        
+        Args:
+            conversation: Messages with "role" and "content"
+            dropped_turns: Turns trimmed off before the conversation, so numbering continues after them
+            dropped_versions: Code versions trimmed off before the conversation
+        """
+        self.cancel_speculation()
+        self.__conversation = MessageStore(conversation)
+        self.__code_blocks = []
+        self.__latest_python = None
+        self.__turns = self.__dropped_turns = dropped_turns
+        self.__dropped_versions = dropped_versions
+        self.__function_request = None
+        self.__validation = None
+        self.__lint_results = {}
+        self.__lint_report = None
+        for idx, message in enumerate(self.__conversation):
+            if message["role"] == "assistant":
+                self.__index_code(message["content"])
+            elif message["role"] == "system":
+                # Only the opening message and mode switches set the instructions; feedback between turns does not
+                if message["content"].startswith(self.MODE_SWITCH_PREFIX):
+                    self.__system_message = message["content"][len(self.MODE_SWITCH_PREFIX):]
+                elif idx == 0 and not message["content"].startswith(self.FEEDBACK_PREFIX):
+                    self.__system_message = message["content"]
+        self.__applied_system_message = self.__system_message
+        if self.__context_window:
+            self.__context_window.reset()
+        if self.__journal:
+            self.__journal.snapshot(self.__conversation, **self.__numbering())
+
+    def __numbering(self) -> Dict[str, int]:
+        """The numbering a journal snapshot needs to resume a trimmed conversation; empty if nothing was trimmed."""
+        if not self.__dropped_turns:
+            return {}
+        return {"dropped_turns": self.__dropped_turns, "dropped_versions": self.__dropped_versions}
+
+    def prompt(self, user_input: str, stream: Optional[bool] = None, on_token: Optional[Callable[[str], None]] = None, use_cache: bool = True, candidates: Optional[int] = None, use_library: bool = True) -> str:
+        """
+        Send a prompt to the LLM and get a response.
+        
+        Args:
+            user_input: The user's input text
+            stream: Stream the response token-by-token (defaults to the agent setting)
+            on_token: Called with each piece of text as it arrives while streaming
+            use_cache: Consult and fill the response cache for this call, if one is configured
+            candidates: Generate this many answers at once and keep the best (defaults to the agent setting)
+            use_library: Look a request for a new function up in the function library, if one is configured
+            
+        Returns:
+            The assistant's response
+        """
+        count = candidates or self.candidates
+        speculation = self._claim_speculation(user_input, claim=count == 1)
+        request = self._begin_turn(user_input, stream, allow_edit=speculation is None and count == 1, candidates=count, use_library=use_library and speculation is None)
+        reused = self._library_answer()
+        if reused is not None:
+            if request["stream"] and on_token:
+                on_token(reused)
+            return self._finish_turn(reused, cache_hit=True)
+        cache_key, cached = self._cache_get(request, use_cache)
+        if cached is not None:
+            if request["stream"] and on_token:
+                on_token(cached)
+            return self._finish_turn(cached, cache_hit=True)
+        if speculation is not None:
+            try:
+                assistant_response, usage = self.__speculation_result(speculation)
+                if request["stream"] and on_token:
+                    on_token(assistant_response)
+                return self._finish_turn(assistant_response, usage)
+            except GenerationCancelled:
+                return self._cancel_turn("")
+            except Exception:
+                # The speculative request failed; fall back to a regular one
+                pass
+        try:
+            if count > 1:
+                assistant_response, usage = self.__best_of(request, count)
+                if request["stream"] and on_token:
+                    on_token(assistant_response)
+            else:
+                assistant_response, usage = self.__complete(request, on_token)
+                assistant_response, fallback_request = self._check_response(assistant_response, usage)
+                if fallback_request is not None:
+                    assistant_response, usage = self.__complete(fallback_request, on_token)
+        except GenerationCancelled as e:
+            return self._cancel_turn(e.partial)
+        except Exception as e:
+            return self._fail_turn(e)
+        self._cache_put(cache_key, assistant_response)
+        return self._finish_turn(assistant_response, usage)
+
+    def cancel(self, keep_partial: bool = False) -> bool:
+        """
+        Stop the turn in progress, e.g. from another thread while prompt() runs.
+        
+        Every streamed response of the turn (including hedged requests and best-of-N
+        candidates) is closed at once, so the provider stops generating (and billing)
+        it; an unstreamed one is abandoned. prompt() then returns the text received so
+        far and last_cancelled is set.
+        
+        Args:
+            keep_partial: Keep the text received so far in the conversation, marked as
+                stopped, instead of rolling the turn back
+            
+        Returns:
+            Whether a turn was in progress
+        """
+        if not self.__in_turn:
+            return False
+        self.__keep_partial = keep_partial
+        self.__turn_cancelled.set()
+        if self.__claimed_speculation is not None:
+            self.__claimed_speculation.set()
+        with self.__streams_lock:
+            streams = list(self.__turn_streams)
+        for response in streams:
+            close_stream(response)
+        return True
+
+    def __track_stream(self, response) -> bool:
+        """
+        Register a response stream of the current turn, so cancel() can close it.
+        
+        Returns:
+            False if the turn has already been cancelled; the stream is then closed instead
+        """
+        with self.__streams_lock:
+            if not self.__turn_cancelled.is_set():
+                self.__turn_streams.add(response)
+                return True
+        close_stream(response)
+        return False
+
+    def __untrack_stream(self, response):
+        with self.__streams_lock:
+            self.__turn_streams.discard(response)
+
+    def __speculation_result(self, speculation: Future) -> Tuple[str, Any]:
+        """Wait for the claimed speculative response, giving up if the turn is cancelled."""
+        while not self.__turn_cancelled.is_set():
+            done, _ = wait([speculation], timeout=0.1)
+            if done:
+                return speculation.result()
+        raise GenerationCancelled()
+
+    def __with_notes(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Put this turn's one-off notes right before its user message."""
+        return messages[:-1] + self.__turn_notes + messages[-1:] if self.__turn_notes else messages
+
+    def _begin_turn(self, user_input: str, stream: Optional[bool] = None, allow_edit: bool = True, candidates: int = 1, use_library: bool = True) -> Dict[str, Any]:
+        """
+        Record the user's message and build the completion request for this turn.
+        
+        Args:
+            user_input: The user's input text
+            stream: Whether to stream the response (defaults to the agent setting)
+            allow_edit: Whether the turn may ask for a patch in edit mode
+            candidates: Number of candidate answers the turn generates
+            use_library: Whether a request for a new function is looked up in the function library
+            
+        Returns:
+            Keyword arguments for completion() / acompletion()
+        """
+        # The pending validation and lint reports are taken by this turn; a failed turn gives them back
+        self.__turn_rollback = (len(self.__conversation), self.__applied_system_message, self.__validation, self.__lint_report)
+        task = classify_turn(user_input, self.__latest_python is not None)
+        matches = self.find_similar(user_input, 1) if use_library and task == "new" else []
+        self.__turn_library = (self.__library_mode if self.__library_mode == "reuse" else "hint") if matches else None
+        self.__turn_library_match = matches[0] if matches else None
+        if task == "new":
+            self.__function_request = user_input
+        feedback = self.__validation_feedback()
+        if feedback:
+            self.__append({"role": "system", "content": self.FEEDBACK_PREFIX + feedback})
+        if self.__system_message != self.__applied_system_message:
+            self.__append({"role": "system", "content": self.MODE_SWITCH_PREFIX + self.__system_message})
+            self.__applied_system_message = self.__system_message
+        # Lint findings and library matches only go with this turn's requests; the conversation keeps the plain turn
+        self.__turn_notes = []
+        lint_feedback = self.__lint_feedback()
+        if lint_feedback:
+            self.__turn_notes.append({"role": "system", "content": lint_feedback})
+        if self.__turn_library == "hint":
+            match = self.__turn_library_match
+            self.__turn_notes.append({"role": "system", "content": data["library_hint"].format(request=match.request, code=match.code.strip())})
+        self.__append({"role": "user", "content": user_input})
+        self.__last_time_to_first_token = None
+        self.__last_error = None
+        self.__turn_cancelled = threading.Event()
+        self.__keep_partial = False
+        self.__last_cancelled = False
+        self.__in_turn = True
+        self.__turn_started = time.perf_counter()
+        self.__turn_usage = None
+        self.__turn_retries = 0
+        self.__turn_hedged = False
+        self.__turn_task = task
+        self.__turn_fallback = None
+        self.__turn_edit = None
+        self.__turn_candidates = candidates
+        with self.__admission_lock:
+            self.__turn_queue_wait = 0.0
+            self.__turn_scheduled_tokens = 0
+        if self.__context_window:
+            messages, max_tokens = self.__context_window.fit(self.__conversation, self.__max_tokens)
+        else:
+            messages, max_tokens = self.__conversation[:], self.__max_tokens
+        self.__turn_messages = messages
+        if allow_edit and self.__edit_mode and self.__latest_python and self.__turn_task in data["edit_tasks"]:
+            # Only the request carries the edit instruction; the conversation keeps the plain request and, once the patch is applied, the full code
+            self.__turn_edit = "patch"
+            messages = messages[:-1] + [{"role": "user", "content": f"{user_input}\n\n{data['edit_instruction']}"}]
+        messages = self.__with_notes(messages)
+        if self.__context_window and self.__turn_notes:
+            max_tokens = max(min(max_tokens, self.__context_window.budget - sum(self.__context_window.count_tokens(message) for message in messages)), self.__context_window.min_response_tokens)
+        request = {
+            "messages": messages,
+            "model": self.route(self.__turn_task),
+            "temperature": self.__temperature,
+            "max_tokens": max_tokens,
+            "top_p": 1,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "stream": self.__stream if stream is None else stream,
+        }
+        if self.__api_base:
+            request["api_base"] = self.__api_base
+        if request["stream"]:
+            request["stream_options"] = {"include_usage": True}
+        self.__turn_request = request
+        return request
+
+    def _stream_token(self, chunk, start: Optional[float] = None) -> Optional[str]:
+        """
+        Pull the text out of a streamed chunk, recording the time to the first token.
+        
+        Args:
+            chunk: One chunk of a streaming completion
+            start: perf_counter() value the time to first token is measured from (defaults to the start of the turn)
+            
+        Returns:
+            The chunk's text, or None if it carries none
+        """
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            self.__turn_usage = usage
+        if not chunk.choices:
+            return None
+        token = chunk.choices[0].delta.content
+        if token and self.__last_time_to_first_token is None:
+            self.__last_time_to_first_token = time.perf_counter() - (self.__turn_started if start is None else start)
+        return token
+
+    def route(self, task: str) -> str:
+        """
+        Pick the model for a kind of task.
+        
+        Args:
+            task: A task name from data["tasks"], as returned by classify_turn()
+            
+        Returns:
+            The model configured for the task, or the agent's main model
+        """
+        return self.__routes.get(task, self.__model)
+
+    def _check_response(self, assistant_response: str, usage=None) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Apply an edit-mode patch and check the answer, deciding whether the turn must be asked again.
+        
+        A patch that does not apply is retried as a full rewrite. A routed model's answer
+        that contains no code is handed to the main model, since every task is expected
+        to produce or revise code.
+        
+        Args:
+            assistant_response: The model's answer
+            usage: Its usage block, if it was not streamed
+            
+        Returns:
+            The answer, with an applied patch replaced by the full code, and the request to
+            send instead, or None to keep the answer
+        """
+        model = self.__turn_request["model"]
+        if self.__turn_edit == "patch":
+            patch = apply_patch(self.__latest_python.code, assistant_response)
+            if patch is not None:
+                code, start, end, changes = patch
+                print(f"\n[Applied {changes} change{'s' if changes != 1 else ''} to version {self.__latest_python.version}; use >code to save the full code]")
+                return f"{assistant_response[:start]}```python\n{code.rstrip()}\n```{assistant_response[end:]}", None
+            if not SEARCH_REPLACE_PATTERN.search(assistant_response) and not DIFF_FENCE_PATTERN.search(assistant_response) and CODE_FENCE_PATTERN.search(assistant_response):
+                # The model sent the whole code anyway
+                self.__turn_edit = "full"
+                return assistant_response, None
+            print(f"\n[The patch did not apply; asking {model} for the whole code]")
+            self.__turn_edit = "rewrite"
+            fallback_model = model
+        elif model != self.__model and not CODE_FENCE_PATTERN.search(assistant_response or ""):
+            print(f"\n[{model} returned no code for this {self.__turn_task} task; asking {self.__model}]")
+            fallback_model = self.__model
+        else:
+            return assistant_response, None
+        self.__turn_fallback = (model,) + self.__measure(model, self.__turn_request["messages"], assistant_response, usage or self.__turn_usage)
+        self.__turn_usage = None
+        self.__turn_request = dict(self.__turn_request, model=fallback_model, messages=self.__with_notes(self.__turn_messages))
+        return assistant_response, self.__turn_request
+
+    def _turn_deadline(self) -> Optional[float]:
+        """perf_counter() value by which the current turn must finish, or None."""
+        return self.__turn_started + self.__deadline if self.__deadline else None
+
+    def _deadline_error(self) -> TimeoutError:
+        """The error a turn ends with when it runs past its deadline."""
+        return TimeoutError(f"No complete response within the {self.__deadline:g}s deadline")
+
+    def _attempt_request(self, request: Dict[str, Any], deadline: Optional[float]) -> Dict[str, Any]:
+        """Return the request with a timeout that ends at the turn's deadline."""
+        if deadline is None:
+            return request
+        return dict(request, timeout=max(deadline - time.perf_counter(), 0.1))
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: Optional[float], emitted: bool) -> Optional[float]:
+        """
+        Decide whether a failed attempt is retried and how long to wait first.
+        
+        Args:
+            error: The attempt's exception
+            attempt: 0-based number of the attempt that failed
+            deadline: The turn's deadline, or None
+            emitted: Whether part of the response was already passed to on_token
+            
+        Returns:
+            Seconds to wait before the next attempt, or None to give up
+        """
+        if self.__scheduler is not None and is_rate_limit_error(error):
+            # Hold every session back, not just this one, so the limit is not hit again straight away
+            self.__scheduler.pause(get_retry_after(error) or min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt))
+        if emitted or attempt >= self.__max_retries or not is_retryable_error(error):
+            return None
+        # Full jitter: a random wait up to an exponentially growing cap, unless the provider says how long
+        delay = get_retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt))
+        if deadline is not None and time.perf_counter() + delay >= deadline:
+            return None
+        self.__turn_retries += 1
+        return delay
+
+    def _hedge_delay(self, stream: bool) -> Optional[float]:
+        """
+        Seconds to wait for the first token (or, unstreamed, the response) before hedging.
+        
+        Args:
+            stream: Whether the request streams
+            
+        Returns:
+            The p95 of recent turns (or the configured value), or None when hedging is off
+        """
+        if not self.__hedge:
+            return None
+        if self.__hedge_after is not None:
+            return self.__hedge_after
+        samples = []
+        for stats in self.__turn_stats[-50:]:
+            if stats.error or stats.cache_hit:
+                continue
+            if stream and stats.time_to_first_token is not None:
+                samples.append(stats.time_to_first_token)
+            elif not stream and stats.time_to_first_token is None:
+                samples.append(stats.wall_time)
+        if len(samples) < 5:
+            return self.HEDGE_DEFAULT_DELAY
+        samples.sort()
+        return max(samples[int(0.95 * (len(samples) - 1))], 0.5)
+
+    def _note_hedged(self):
+        """Record that the current turn sent a hedged request."""
+        self.__turn_hedged = True
+
+    def _admit(self, request: Dict[str, Any], cancelled: Optional[threading.Event] = None):
+        """
+        Wait until the scheduler lets a request of the current turn through.
+        
+        Args:
+            request: Keyword arguments for completion(); its timeout bounds the wait
+            cancelled: Stop waiting once this event is set
+        """
+        if self.__scheduler is None:
+            return
+        tokens = self.__scheduler.estimate_tokens(request)
+        try:
+            wait = self.__scheduler.acquire(self.__session, self.__priority, tokens, request.get("timeout"), cancelled)
+        except TimeoutError:
+            raise self._deadline_error()
+        self.__note_admitted(tokens, wait)
+
+    async def _aadmit(self, request: Dict[str, Any]):
+        """Wait, without blocking the event loop, until the scheduler lets a request of the current turn through; its timeout bounds the wait."""
+        if self.__scheduler is None:
+            return
+        tokens = self.__scheduler.estimate_tokens(request)
+        try:
+            wait = await self.__scheduler.aacquire(self.__session, self.__priority, tokens, request.get("timeout"))
+        except TimeoutError:
+            raise self._deadline_error()
+        self.__note_admitted(tokens, wait)
+
+    def __note_admitted(self, tokens: int, wait: float):
+        with self.__admission_lock:
+            self.__turn_queue_wait += wait
+            self.__turn_scheduled_tokens += tokens
+
+    def _completion(self, request: Dict[str, Any], cancelled: Optional[threading.Event] = None):
+        """Send a request of the current turn once the scheduler admits it."""
+        self._admit(request, cancelled or self.__turn_cancelled)
+        if self.__turn_cancelled.is_set():
+            raise GenerationCancelled()
+        return get_litellm().completion(**request)
+
+    async def _acompletion(self, request: Dict[str, Any]):
+        """Send a request of the current turn once the scheduler admits it, without blocking the event loop."""
+        await self._aadmit(request)
+        # The first call imports LiteLLM, which takes seconds
+        litellm = await asyncio.get_event_loop().run_in_executor(None, get_litellm)
+        return await litellm.acompletion(**request)
+
+    def __complete(self, request: Dict[str, Any], on_token: Optional[Callable[[str], None]]) -> Tuple[str, Any]:
+        """
+        Get the response for a turn, retrying and hedging within the turn's deadline.
+        
+        Args:
+            request: Keyword arguments for completion()
+            on_token: Called with each piece of text as it arrives while streaming
+            
+        Returns:
+            The response text and its usage block (None if it arrived with the stream)
+        """
+        deadline = self._turn_deadline()
+        emitted = []
+
+        def forward(token: str):
+            emitted.append(token)
+            if on_token:
+                on_token(token)
+
+        attempt = 0
+        while True:
+            try:
+                hedge_delay = self._hedge_delay(request["stream"])
+                if hedge_delay is not None:
+                    text, usage = self.__hedged_attempt(self._attempt_request(request, deadline), forward, deadline, hedge_delay)
+                else:
+                    text, usage = self.__single_attempt(self._attempt_request(request, deadline), forward, deadline)
+                if self.__turn_cancelled.is_set():
+                    raise GenerationCancelled()
+                return text, usage
+            except Exception as e:
+                if self.__turn_cancelled.is_set():
+                    # Closing the stream may surface as any error; report what had arrived
+                    raise GenerationCancelled("".join(emitted)) from e
+                delay = self._retry_delay(e, attempt, deadline, bool(emitted))
+                if delay is None:
+                    raise
+                if self.__turn_cancelled.wait(delay):
+                    raise GenerationCancelled("".join(emitted))
+                attempt += 1
+
+    def __single_attempt(self, request: Dict[str, Any], forward: Callable[[str], None], deadline: Optional[float]) -> Tuple[str, Any]:
+        """Send one request and read its response."""
+        if not request["stream"]:
+            return self.__unstreamed_attempt(request)
+        response = self._completion(request)
+        if not self.__track_stream(response):
+            raise GenerationCancelled()
+        try:
+            pieces = []
+            for chunk in response:
+                if self.__turn_cancelled.is_set():
+                    raise GenerationCancelled()
+                if deadline is not None and time.perf_counter() > deadline:
+                    raise self._deadline_error()
+                token = self._stream_token(chunk)
+                if token:
+                    pieces.append(token)
+                    forward(token)
+            return "".join(pieces), None
+        finally:
+            self.__untrack_stream(response)
+
+    def __unstreamed_attempt(self, request: Dict[str, Any]) -> Tuple[str, Any]:
+        """Send one unstreamed request from a background thread, so that cancel() need not wait for it."""
+        events = queue.Queue()
+        _, cancelled = self.__start_attempt(request, events, 0)
+        while True:
+            try:
+                _, kind, payload = events.get(timeout=0.1)
+            except queue.Empty:
+                if self.__turn_cancelled.is_set():
+                    cancelled.set()
+                    raise GenerationCancelled()
+                continue
+            if kind == "error":
+                raise payload
+            return payload.choices[0].message.content, getattr(payload, "usage", None)
+
+    def __hedged_attempt(self, request: Dict[str, Any], forward: Callable[[str], None], deadline: Optional[float], hedge_delay: float) -> Tuple[str, Any]:
+        """
+        Send a request and, if it shows no sign of life within hedge_delay, a second one.
+        
+        Whichever request responds first is read to the end; the other is cancelled.
+        """
+        events = queue.Queue()
+        attempts = [self.__start_attempt(request, events, 0)]
+        hedge_at = time.perf_counter() + hedge_delay
+        winner, failed, pieces = None, 0, []
+        try:
+            while True:
+                if self.__turn_cancelled.is_set():
+                    raise GenerationCancelled()
+                # Wake up often enough to notice a cancel()
+                wake_up = min(deadline if deadline is not None else math.inf, time.perf_counter() + 0.1)
+                if winner is None and len(attempts) == 1:
+                    wake_up = min(wake_up, hedge_at)
+                try:
+                    idx, kind, payload = events.get(timeout=max(wake_up - time.perf_counter(), 0.001))
+                except queue.Empty:
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        raise self._deadline_error()
+                    if winner is None and len(attempts) == 1:
+                        attempts.append(self.__start_attempt(request, events, 1))
+                        self._note_hedged()
+                    continue
+                if kind == "error":
+                    failed += 1
+                    if idx == winner or (winner is None and failed == len(attempts)):
+                        raise payload
+                    continue
+                if winner is None:
+                    winner = idx
+                    for other, (_, cancelled) in enumerate(attempts):
+                        if other != winner:
+                            cancelled.set()
+                if idx != winner:
+                    continue
+                if kind == "response":
+                    return payload.choices[0].message.content, getattr(payload, "usage", None)
+                if kind == "done":
+                    return "".join(pieces), None
+                token = self._stream_token(payload)
+                if token:
+                    pieces.append(token)
+                    forward(token)
+        finally:
+            for _, cancelled in attempts:
+                cancelled.set()
+
+    def __start_attempt(self, request: Dict[str, Any], events: queue.Queue, idx: int) -> Tuple[threading.Thread, threading.Event]:
+        """Run one request on a background thread, reporting its chunks to the events queue."""
+        cancelled = threading.Event()
+
+        def run():
+            try:
+                response = self._completion(request, cancelled)
+                if not request["stream"]:
+                    events.put((idx, "response", response))
+                    return
+                if not self.__track_stream(response):
+                    return
+                try:
+                    for chunk in response:
+                        if cancelled.is_set():
+                            close_stream(response)
+                            return
+                        events.put((idx, "chunk", chunk))
+                finally:
+                    self.__untrack_stream(response)
+                events.put((idx, "done", None))
+            except Exception as e:
+                events.put((idx, "error", e))
+
+        thread = threading.Thread(target=run, name="hedged-request", daemon=True)
+        thread.start()
+        return thread, cancelled
+
+    def benchmark(self, sizes: Optional[List[int]] = None, inputs: Optional[str] = None, function: Optional[str] = None) -> Optional[BenchmarkResult]:
+        """
+        Measure how the latest function scales, in a sandboxed subprocess.
+        
+        Args:
+            sizes: Input sizes, or None to grow them until a call gets slow
+            inputs: Python expression of n building the arguments, or None to build them from the parameters
+            function: Name of the function to measure (defaults to the first public function of the latest code)
+            
+        Returns:
+            The measurements, or None if there is no function to measure
+        """
+        code, _ = self.__latest_code_and_tests()
+        description = FunctionLibrary.describe(code.code) if code else None
+        if description is None:
+            print("No function found in the conversation.")
+            return None
+        self.__last_benchmark = run_benchmark(code.code, function or description[0], sizes, inputs, self.BENCHMARK_TIMEOUT, self.BENCHMARK_MEMORY_MB)
+        return self.__last_benchmark
+
+    def optimize_prompt(self, result: Optional[BenchmarkResult] = None) -> Optional[str]:
+        """
+        Build the request asking the model to optimize the function with a benchmark's measurements.
+        
+        Args:
+            result: The benchmark (defaults to the latest one)
+            
+        Returns:
+            The request, or None if there is no successful benchmark
+        """
+        result = result or self.__last_benchmark
+        if result is None or not result.ok:
+            return None
+        return data["optimize_prompt"].format(profile=format_benchmark(result))
+
+    def optimize(self, result: Optional[BenchmarkResult] = None, stream: Optional[bool] = None, on_token: Optional[Callable[[str], None]] = None) -> Optional[str]:
+        """
+        Send a benchmark's measurements back to the model as a request to optimize the function.
+        
+        Args:
+            result: The benchmark (defaults to the latest one)
+            stream: Stream the response token-by-token (defaults to the agent setting)
+            on_token: Called with each piece of text as it arrives while streaming
+            
+        Returns:
+            The assistant's response, or None if there is no successful benchmark
+        """
+        request = self.optimize_prompt(result)
+        if request is None:
+            print("Run a successful benchmark first.")
+            return None
+        return self.prompt(request, stream=stream, on_token=on_token, use_library=False)
+
+    def find_similar(self, user_input: str, limit: int = 3) -> List[LibraryMatch]:
+        """
+        Look a request up in the function library.
+        
+        Args:
+            user_input: The user's input text
+            limit: Maximum number of matches
+            
+        Returns:
+            The library functions at least library_threshold similar to the request, most similar first
+        """
+        if self.__library is None:
+            return []
+        return self.__library.search(user_input, limit, self.__library_threshold)
+
+    def reuse_function(self, user_input: str, match: LibraryMatch) -> str:
+        """
+        Answer a request with a function from the library, without asking the LLM.
+        
+        Args:
+            user_input: The user's input text
+            match: The library function, from find_similar()
+            
+        Returns:
+            The assistant's response
+        """
+        self._claim_speculation(user_input, claim=False)
+        self._begin_turn(user_input, use_library=False)
+        self.__turn_library, self.__turn_library_match = "reuse", match
+        return self._finish_turn(self._library_answer(), cache_hit=True)
+
+    def _library_answer(self) -> Optional[str]:
+        """The answer of the current turn if it is served from the function library, or None."""
+        if self.__turn_library != "reuse":
+            return None
+        match = self.__turn_library_match
+        return data["library_answer"].format(score=match.score, request=match.request, code=match.code.strip())
+
+    def _cache_get(self, request: Dict[str, Any], use_cache: bool = True) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Look a request up in the response cache.
+        
+        Args:
+            request: Keyword arguments for completion()
+            use_cache: False to bypass the cache for this call
+            
+        Returns:
+            The cache key (None when the cache is not used) and the cached response, if any
+        """
+        if self.__cache is None or not use_cache:
+            return None, None
+        key = self.__cache.make_key(request)
+        return key, self.__cache.get(key)
+
+    def _cache_put(self, key: Optional[str], assistant_response: str):
+        """Store a fresh response under a key returned by _cache_get()."""
+        if key is not None and assistant_response:
+            self.__cache.put(key, assistant_response)
+
+    @property
+    def speculation_stats(self) -> Dict[str, Any]:
+        """Counts of launched, served and discarded speculative requests and the estimated spend."""
+        with self.__speculation_lock:
+            return dict(self.__speculation_stats)
+
+    def __launch_speculation(self, messages: List[Dict[str, str]]):
+        """Start background requests for the standard follow-ups to the turn that just ended."""
+        self.cancel_speculation()
+        if self.__speculation_executor is None:
+            self.__speculation_executor = ThreadPoolExecutor(max_workers=len(data["follow_ups"]), thread_name_prefix="speculation")
+        request = dict(self.__turn_request, stream=True, stream_options={"include_usage": True})
+        if self.__deadline:
+            request["timeout"] = self.__deadline
+        for kind, follow_up in data["follow_ups"].items():
+            speculative_request = dict(request, model=self.route(kind), messages=messages + [{"role": "user", "content": follow_up["prompt"]}])
+            # Reserve the most the request can cost, so requests running at once cannot overshoot the budget together
+            prompt_tokens = sum(len(message["content"]) for message in speculative_request["messages"]) // 4
+            reserved = self.__speculation_cost(speculative_request["model"], prompt_tokens, speculative_request["max_tokens"])
+            with self.__speculation_lock:
+                if self.__speculation_stats["spent"] + self.__speculation_reserved + reserved > self.__speculation_budget:
+                    continue
+                self.__speculation_reserved += reserved
+                self.__speculation_stats["launched"] += 1
+            cancelled = threading.Event()
+            future = self.__speculation_executor.submit(self.__run_speculation, speculative_request, cancelled)
+            future.add_done_callback(lambda _, reserved=reserved: self.__release_speculation(reserved))
+            self.__speculations[kind] = (future, cancelled, len(self.__conversation))
+
+    def __release_speculation(self, reserved: float):
+        with self.__speculation_lock:
+            self.__speculation_reserved = max(self.__speculation_reserved - reserved, 0.0)
+
+    def __speculation_cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """Cost of a speculative request in US dollars, estimated locally for models LiteLLM has no price for."""
+        try:
+            return sum(get_litellm().cost_per_token(model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+        except Exception:
+            return (prompt_tokens + completion_tokens) * self.UNKNOWN_COST_PER_TOKEN
+
+    def __run_speculation(self, request: Dict[str, Any], cancelled: threading.Event) -> Tuple[str, Any]:
+        """Run one speculative request, giving up as soon as it is cancelled."""
+        if cancelled.is_set():
+            raise RuntimeError("Speculation cancelled")
+        deadline = time.perf_counter() + request["timeout"] if request.get("timeout") else None
+        tokens = self.__scheduler.estimate_tokens(request) if self.__scheduler else 0
+        if self.__scheduler:
+            self.__scheduler.acquire(self.__session, "background", tokens, request.get("timeout"), cancelled)
+        response = get_litellm().completion(**request)
+        pieces, usage = [], None
+        try:
+            for chunk in response:
+                if cancelled.is_set():
+                    raise RuntimeError("Speculation cancelled")
+                if deadline is not None and time.perf_counter() > deadline:
+                    cancelled.set()
+                    raise TimeoutError("Speculation ran past the deadline")
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+        finally:
+            if cancelled.is_set():
+                close_stream(response)
+            prompt_tokens = usage.prompt_tokens if usage else sum(len(message["content"]) for message in request["messages"]) // 4
+            completion_tokens = usage.completion_tokens if usage else len("".join(pieces)) // 4
+            cost = self.__speculation_cost(request["model"], prompt_tokens, completion_tokens)
+            with self.__speculation_lock:
+                self.__speculation_stats["spent"] += cost
+            if self.__scheduler:
+                self.__scheduler.settle(tokens, prompt_tokens + completion_tokens)
+        return "".join(pieces), usage
+
+    def _claim_speculation(self, user_input: str, claim: bool = True):
+        """
+        Take the speculative response that matches the user's next request, if any.
+        
+        Every other speculation, and all of them if the conversation moved on some
+        other way, is cancelled.
+        
+        Args:
+            user_input: The user's input text
+            claim: False to cancel every speculation without taking one
+            
+        Returns:
+            A future resolving to the response text and usage, or None
+        """
+        if not self.__speculations:
+            return None
+        kind = get_follow_up_kind(user_input) if claim else None
+        unchanged = self.__system_message == self.__applied_system_message
+        claimed, discarded = None, 0
+        self.__claimed_speculation = None
+        for name, (future, cancelled, conversation_length) in self.__speculations.items():
+            if name == kind and unchanged and conversation_length == len(self.__conversation):
+                claimed = future
+                self.__claimed_speculation = cancelled
+                continue
+            cancelled.set()
+            future.cancel()
+            discarded += 1
+        with self.__speculation_lock:
+            self.__speculation_stats["served"] += 1 if claimed else 0
+            self.__speculation_stats["discarded"] += discarded
+        self.__speculations = {}
+        return claimed
+
+    def cancel_speculation(self):
+        """Cancel every outstanding speculative request."""
+        for future, cancelled, _ in self.__speculations.values():
+            cancelled.set()
+            future.cancel()
+        with self.__speculation_lock:
+            self.__speculation_stats["discarded"] += len(self.__speculations)
+        self.__speculations = {}
+
+    def __best_of(self, request: Dict[str, Any], count: int) -> Tuple[str, Any]:
+        """
+        Generate several candidate answers at once and keep the one whose code checks out best.
+        
+        Args:
+            request: Keyword arguments for completion()
+            count: Number of candidates
+            
+        Returns:
+            The winning answer and the combined usage of all candidates
+        """
+        # Candidates are streamed (without being shown) so that cancel() can close them all
+        request = dict(self._candidate_request(request), stream=True, stream_options={"include_usage": True})
+        texts, usages, errors = [], [], []
+        if supports_n(request["model"]):
+            self.__gather_candidates([dict(request, n=count)], texts, usages, errors)
+        missing = count - len(texts)
+        if missing > 0:
+            # Without n= support (or if the provider ignored it) the rest are parallel calls
+            self.__gather_candidates([request] * missing, texts, usages, errors)
+        texts = texts[:count]
+        if not texts:
+            raise errors[-1]
+        checks = self._check_candidates(texts)
+        pending = [check for check in checks if check]
+        while pending:
+            if self.__turn_cancelled.is_set():
+                raise GenerationCancelled()
+            _, pending = wait(pending, timeout=0.1)
+        results = []
+        for check in checks:
+            try:
+                results.append(check.result() if check else None)
+            except Exception:
+                results.append(None)
+        return self._pick_candidate(texts, results), combine_usage(usages)
+
+    def __gather_candidates(self, requests: List[Dict[str, Any]], texts: List[str], usages: List[Any], errors: List[Exception]):
+        """
+        Run streamed candidate requests in parallel and collect the text of every choice.
+        
+        Args:
+            requests: The requests to send at once
+            texts: Receives the text of every choice of the requests that finished
+            usages: Receives their usage blocks
+            errors: Receives the errors of the requests that failed
+            
+        Raises:
+            GenerationCancelled: If the turn is cancelled; every request is closed first
+        """
+        events = queue.Queue()
+        attempts = [self.__start_attempt(request, events, idx) for idx, request in enumerate(requests)]
+        pieces = [{} for _ in requests]
+        usage = [None] * len(requests)
+        running = len(requests)
+        try:
+            while running:
+                try:
+                    idx, kind, payload = events.get(timeout=0.1)
+                except queue.Empty:
+                    if self.__turn_cancelled.is_set():
+                        raise GenerationCancelled()
+                    continue
+                if kind == "error":
+                    errors.append(payload)
+                    running -= 1
+                elif kind == "done":
+                    texts.extend("".join(choice) for _, choice in sorted(pieces[idx].items()))
+                    usages.append(usage[idx])
+                    running -= 1
+                else:
+                    usage[idx] = getattr(payload, "usage", None) or usage[idx]
+                    for choice in getattr(payload, "choices", None) or []:
+                        delta = getattr(choice, "delta", None)
+                        pieces[idx].setdefault(getattr(choice, "index", 0) or 0, []).append(getattr(delta, "content", None) or "")
+            if self.__turn_cancelled.is_set():
+                raise GenerationCancelled()
+        finally:
+            for _, cancelled in attempts:
+                cancelled.set()
+
+    def _candidate_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Turn the turn's request into the non-streamed request each candidate is generated with."""
+        request = self._attempt_request(dict(request, stream=False), self._turn_deadline())
+        request.pop("stream_options", None)
+        return request
+
+    def __latest_code_and_tests(self) -> Tuple[Optional[CodeBlock], Optional[CodeBlock]]:
+        """Find the latest Python code block that is not a test suite, and the latest one that is."""
+        code, tests = None, None
+        for block in reversed(self.__code_blocks):
+            if block.language not in PYTHON_LANGUAGE_TAGS:
+                continue
+            block = block._replace(code=unpack_text(block.code))
+            if is_test_code(block.code):
+                tests = tests or block
+            elif code is None:
+                code = block
+            if code and tests:
+                break
+        return code, tests
+
+    def _check_candidates(self, texts: List[str]) -> List[Optional[Future]]:
+        """
+        Start a quick check of every candidate answer.
+        
+        A candidate's code is run against its own tests, or the latest tests in the
+        conversation; candidate tests are run against the latest code.
+        
+        Args:
+            texts: The candidate answers
+            
+        Returns:
+            A future ValidationResult per candidate, or None for a candidate without Python code
+        """
+        if self.__validator is None and self.__candidate_validator is None:
+            self.__candidate_validator = CodeValidator(workers=4, timeout=5.0)
+        validator = self.__validator or self.__candidate_validator
+        latest_code, latest_tests = self.__latest_code_and_tests()
+        checks = []
+        for text in texts:
+            code, tests = None, None
+            for match in CODE_FENCE_PATTERN.finditer(text):
+                if match.group(1).lower() in PYTHON_LANGUAGE_TAGS:
+                    if is_test_code(match.group(2)):
+                        tests = match.group(2)
+                    else:
+                        code = match.group(2)
+            if code is None and tests is None:
+                checks.append(None)
+                continue
+            if code is None:
+                code = latest_code.code if latest_code else ""
+            elif tests is None and latest_tests:
+                tests = latest_tests.code
+            checks.append(validator.submit(code, tests))
+        return checks
+
+    @staticmethod
+    def _pick_candidate(texts: List[str], results: List[Optional[ValidationResult]]) -> str:
+        """
+        Choose the best candidate: code over none, then compiling code, then code with
+        passing tests, then the highest test pass rate, then the fastest test run, then
+        the earliest candidate.
+        
+        Args:
+            texts: The candidate answers
+            results: Their check results (None for no code)
+            
+        Returns:
+            The winning answer
+        """
+        def score(idx: int) -> Tuple[int, int, int, float, float, int]:
+            result = results[idx]
+            if result is None:
+                return (0, 0, 0, 0.0, 0.0, -idx)
+            compiles = result.ok or result.stage == "tests"
+            # Code without tests has a pass rate of 1.0 and takes no time, so it must not outrank code whose tests pass
+            tested = result.tests_run > result.tests_failed
+            return (1, int(compiles), int(tested), result.pass_rate, -result.test_seconds, -idx)
+
+        winner = max(range(len(texts)), key=score)
+        result = results[winner]
+        if result is None:
+            summary = "no code"
+        elif result.tests_run:
+            summary = f"{result.tests_run - result.tests_failed}/{result.tests_run} tests passed in {result.test_seconds:.3f}s"
+        else:
+            summary = "compiles" if result.ok else f"failed at {result.stage}"
+        print(f"\n[Picked candidate {winner + 1} of {len(texts)}: {summary}]")
+        return texts[winner]
+
+    def __launch_validation(self):
+        """Validate the latest code, with the latest tests if there are any, in the background."""
+        code, tests = self.__latest_code_and_tests()
+        if code is None and tests is not None:
+            # Tests that carry their own copy of the function are validated on their own
+            code = tests
+            future = self.__validator.submit("", tests.code)
+        elif code is not None:
+            future = self.__validator.submit(code.code, tests.code if tests else None)
+        else:
+            return
+        self.__validation = (code, tests, future)
+        future.add_done_callback(lambda future: self.__report_validation(code, tests, future))
+
+    def __report_validation(self, code: CodeBlock, tests: Optional[CodeBlock], future: Future):
+        """Print the outcome of a background validation as soon as it is known."""
+        if future.cancelled():
+            return
+        result = future.exception() or future.result()
+        if isinstance(result, Exception):
+            print(f"\n[Validation of version {code.version} could not run: {result}]")
+            return
+        self.__validation_results.append(result)
+        checked = f"{result.tests_run} tests against version {tests.version}" if tests else "compiles"
+        if result.ok:
+            print(f"\n[Validation of version {code.version}: passed ({checked}){' (cached)' if result.cached else ''}]")
+        else:
+            print(f"\n[Validation of version {code.version}: failed at {result.stage} ({checked}); it will be reported with your next request]")
+
+    def __validation_feedback(self) -> Optional[str]:
+        """Take the failure report of the last validation, if it has failed, to pass on to the model."""
+        if self.__validation is None or not self.__validation[2].done():
+            return None
+        code, tests, future = self.__validation
+        self.__validation = None
+        try:
+            result = future.result()
+        except Exception:
+            return None
+        if result.ok:
+            return None
+        what = "did not compile" if result.stage == "compile" else f"failed its tests (version {tests.version})" if tests else "failed its tests"
+        return f"Automatic validation: version {code.version} of the code {what}. Fix this as part of the next answer.\n{result.output}"
+
+    def wait_for_validation(self, timeout: Optional[float] = None) -> Optional[ValidationResult]:
+        """
+        Wait for the validation of the latest code, if one is running.
+        
+        Args:
+            timeout: Seconds to wait, or None to wait until it finishes
+            
+        Returns:
+            The result, or None if nothing was validated or it did not finish in time
+        """
+        if self.__validation is None:
+            return None
+        try:
+            return self.__validation[2].result(timeout)
+        except Exception:
+            return None
+
+    @property
+    def validation_results(self) -> List[ValidationResult]:
+        """Outcomes of the background validations so far, oldest first."""
+        return list(self.__validation_results)
+
+    def lint(self, version: Optional[int] = None) -> Optional[List[LintIssue]]:
+        """
+        Check one version of the code for slow patterns, without running it or calling the LLM.
+        
+        Args:
+            version: 1-based version number, or None for the latest Python code that is not a test suite
+            
+        Returns:
+            The issues found (empty if none), or None if there is no such Python code or it does not parse
+        """
+        block = self.get_code_version(version) if version is not None else self.__latest_code_and_tests()[0]
+        if block is None or block.language not in PYTHON_LANGUAGE_TAGS:
+            return None
+        if block.version not in self.__lint_results:
+            try:
+                self.__lint_results[block.version] = lint_code(block.code)
+            except SyntaxError:
+                self.__lint_results[block.version] = None
+        return self.__lint_results[block.version]
+
+    def __report_lint(self):
+        """Lint the code of the turn that just ended and keep the issues for the next request."""
+        code, _ = self.__latest_code_and_tests()
+        issues = self.lint(code.version) if code and code.turn == self.__turns else None
+        if issues:
+            self.__lint_report = (code.version, issues)
+            print(f"\n[Lint of version {code.version}: {len(issues)} slow pattern{'s' if len(issues) != 1 else ''}, to be reported with your next request]")
+
+    def __lint_feedback(self) -> Optional[str]:
+        """Take the issues found in the latest code, if any, to pass on to the model."""
+        if self.__lint_report is None:
+            return None
+        version, issues = self.__lint_report
+        self.__lint_report = None
+        return data["lint_feedback"].format(version=version, issues=format_lint(issues, version))
+
+    def __append(self, message: Dict[str, str]):
+        """Add a message to the conversation and the journal."""
+        self.__conversation.append(message)
+        if self.__journal:
+            self.__journal.message(message, self.__conversation, **self.__numbering())
+
+    def _finish_turn(self, assistant_response: str, usage=None, cache_hit: bool = False) -> str:
+        """
+        Record the assistant's response and the turn's measurements.
+        
+        Args:
+            assistant_response: The complete response
+            usage: The usage block of a non-streamed response (streamed usage is picked up from the chunks)
+            cache_hit: Whether the response came from the response cache
+            
+        Returns:
+            The assistant's response
+        """
+        self.__in_turn = False
+        self.__append_response(assistant_response)
+        self.__record_turn(assistant_response, usage or self.__turn_usage, cache_hit)
+        if self.__latest_python and self.__latest_python.turn == self.__turns:
+            if self.__validator:
+                self.__launch_validation()
+            if self.__lint:
+                self.__report_lint()
+            if self.__speculate:
+                self.__launch_speculation(self.__turn_messages + [self.__conversation[-1]])
+        return assistant_response
+
+    def _fail_turn(self, error: Exception) -> str:
+        """
+        Report a failed turn and roll the conversation back to where it was before it.
+        
+        Args:
+            error: The exception that ended the turn
+            
+        Returns:
+            The error message
+        """
+        self.__in_turn = False
+        error_msg = f"Error: {str(error) or type(error).__name__}"
+        self.__last_error = error_msg
+        self.__record_turn("", self.__turn_usage, error=error_msg)
+        self.__roll_back_turn()
+        print(error_msg)
+        return error_msg
+
+    def _cancel_turn(self, partial: str) -> str:
+        """
+        End a turn stopped by cancel(), keeping the text received so far if asked to,
+        or rolling the conversation back to where it was before the turn.
+        
+        Args:
+            partial: The text received before the turn was stopped
+            
+        Returns:
+            The partial response
+        """
+        self.__in_turn = False
+        self.__last_cancelled = True
+        if self.__keep_partial and partial.strip():
+            self.__append_response(partial + data["cancelled_note"])
+            self.__record_turn(partial, self.__turn_usage, cancelled=True)
+        else:
+            self.__record_turn(partial, self.__turn_usage, error="cancelled", cancelled=True)
+            self.__roll_back_turn()
+        return partial
+
+    def __append_response(self, assistant_response: str):
+        """Add the assistant's response to the conversation and index its code."""
+        self.__append({"role": "assistant", "content": assistant_response})
+        if self.__context_window:
+            # Turns the context window no longer sends are only read again on request
+            self.__conversation.compress(self.__context_window.cut, self.__context_window.collapsed)
+        self.__index_code(assistant_response)
+
+    def __roll_back_turn(self):
+        """Drop the messages of the current turn from the conversation and the journal, and keep its feedback for the next one."""
+        length, self.__applied_system_message, validation, lint_report = self.__turn_rollback
+        self.__validation = self.__validation or validation
+        self.__lint_report = self.__lint_report or lint_report
+        if len(self.__conversation) > length:
+            del self.__conversation[length:]
+            if self.__journal:
+                self.__journal.record("truncate", length=length)
+                self.__record_pending_mode()
+
+    def __measure(self, model: str, messages: List[Dict[str, str]], assistant_response: str, usage) -> Tuple[int, int, int, Optional[float]]:
+        """
+        Work out the tokens and estimated cost of one request.
+        
+        Args:
+            model: The model the request was sent to
+            messages: The messages that were sent
+            assistant_response: The response text
+            usage: The provider's usage block, or None to count the tokens locally
+            
+        Returns:
+            Prompt tokens, completion tokens, prompt tokens served from the provider's cache, and cost (None if unknown)
+        """
+        cached_tokens = 0
+        if usage:
+            prompt_tokens, completion_tokens = usage.prompt_tokens or 0, usage.completion_tokens or 0
+            cached_tokens = get_cached_tokens(usage)
+        else:
+            try:
+                litellm = get_litellm()
+                prompt_tokens = litellm.token_counter(model=model, messages=messages)
+                completion_tokens = litellm.token_counter(model=model, text=assistant_response) if assistant_response else 0
+            except Exception:
+                prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+                completion_tokens = len(assistant_response) // 4
+        try:
+            cost = sum(get_litellm().cost_per_token(model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+        except Exception:
+            cost = None
+        return prompt_tokens, completion_tokens, cached_tokens, cost
+
+    def __record_turn(self, assistant_response: str, usage, cache_hit: bool = False, error: Optional[str] = None, cancelled: bool = False):
+        """Measure the turn that just ended and pass it to the metrics hook."""
+        model = self.__turn_request["model"]
+        # A stopped turn is billed for what it received, if anything
+        if not usage and (cache_hit or (error and not (cancelled and assistant_response))):
+            prompt_tokens, completion_tokens, cached_tokens, cost = 0, 0, 0, 0.0
+        else:
+            prompt_tokens, completion_tokens, cached_tokens, cost = self.__measure(model, self.__turn_request["messages"], assistant_response, usage)
+        fallback_from = None
+        if self.__turn_fallback:
+            # The rejected answer is part of the turn's cost
+            fallback_from, fallback_prompt, fallback_completion, fallback_cached, fallback_cost = self.__turn_fallback
+            fallback_from = fallback_from if fallback_from != model else None
+            prompt_tokens += fallback_prompt
+            completion_tokens += fallback_completion
+            cached_tokens += fallback_cached
+            cost = None if cost is None or fallback_cost is None else cost + fallback_cost
+        with self.__admission_lock:
+            queue_wait, scheduled_tokens = self.__turn_queue_wait, self.__turn_scheduled_tokens
+        if self.__scheduler is not None and scheduled_tokens:
+            # Admission charged an estimate; hand back (or charge) the difference to what the turn really used
+            self.__scheduler.settle(scheduled_tokens, prompt_tokens + completion_tokens)
+        stats = TurnStats(
+            turn = len(self.__turn_stats) + 1,
+            model = model,
+            timestamp = time.time(),
+            wall_time = time.perf_counter() - self.__turn_started,
+            time_to_first_token = self.__last_time_to_first_token,
+            prompt_tokens = prompt_tokens,
+            completion_tokens = completion_tokens,
+            cost = cost,
+            retries = self.__turn_retries,
+            cache_hit = cache_hit,
+            error = error,
+            cached_tokens = cached_tokens,
+            hedged = self.__turn_hedged,
+            task = self.__turn_task,
+            fallback_from = fallback_from,
+            edit = self.__turn_edit if not (cache_hit or error) else None,
+            candidates = self.__turn_candidates,
+            queue_wait = queue_wait,
+            library = self.__turn_library if not error else None,
+            cancelled = cancelled
+        )
+        self.__turn_stats.append(stats)
+        if self.__metrics_hook:
+            try:
+                self.__metrics_hook(stats)
+            except Exception as e:
+                print(f"Error in metrics hook: {str(e)}")
+
+    def show_stats(self):
+        """Print the measurements of every turn and the session totals."""
+        if not self.__turn_stats:
+            print("No turns yet.")
+            return
+        for stats in self.__turn_stats:
+            ttft = f"{stats.time_to_first_token:.2f}s" if stats.time_to_first_token is not None else "-"
+            cost = f"${stats.cost:.4f}" if stats.cost is not None else "-"
+            outcome = ("stopped, partial answer kept" if stats.error is None else "stopped") if stats.cancelled else "error" if stats.error else ("from the library" if stats.library == "reuse" else "cache hit" if stats.cache_hit else "ok")
+            if stats.hedged:
+                outcome += ", hedged"
+            if stats.candidates > 1:
+                outcome += f", best of {stats.candidates}"
+            if stats.queue_wait >= 0.01:
+                outcome += f", queued {stats.queue_wait:.2f}s"
+            if stats.library == "hint":
+                outcome += ", library hint"
+            if stats.edit:
+                outcome += {"patch": ", patched", "rewrite": ", patch failed", "full": ", rewritten"}[stats.edit]
+            model = f"{stats.fallback_from} -> {stats.model}" if stats.fallback_from else stats.model
+            print(f"Turn {stats.turn}: {stats.wall_time:.2f}s (first token {ttft}), {stats.prompt_tokens} prompt ({stats.cached_tokens} cached) + {stats.completion_tokens} completion tokens, {cost}, {stats.retries} retries, {stats.task or '-'} on {model}, {outcome}")
+        wall_time = sum(stats.wall_time for stats in self.__turn_stats)
+        prompt_tokens = sum(stats.prompt_tokens for stats in self.__turn_stats)
+        cached_tokens = sum(stats.cached_tokens for stats in self.__turn_stats)
+        tokens = prompt_tokens + sum(stats.completion_tokens for stats in self.__turn_stats)
+        cost = sum(stats.cost or 0.0 for stats in self.__turn_stats)
+        hit_rate = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0.0
+        if self.__routes:
+            models = set(stats.model for stats in self.__turn_stats) | set(stats.fallback_from for stats in self.__turn_stats if stats.fallback_from)
+            for model in sorted(models):
+                turns = [stats for stats in self.__turn_stats if stats.model == model and not stats.error and not stats.cache_hit]
+                average = sum(stats.wall_time for stats in turns) / len(turns) if turns else 0.0
+                fallbacks = sum(1 for stats in self.__turn_stats if stats.fallback_from == model)
+                print(f"{model}: {len(turns)} turns answered, {average:.2f}s average, ${sum(stats.cost or 0.0 for stats in turns):.4f}, {fallbacks} handed to {self.__model}")
+        if self.__validation_results:
+            passed = sum(1 for result in self.__validation_results if result.ok)
+            print(f"Validation: {len(self.__validation_results)} runs, {passed} passed, {len(self.__validation_results) - passed} failed, latest {'passed' if self.__validation_results[-1].ok else 'failed'}")
+        if self.__speculation_stats["launched"]:
+            speculation = self.speculation_stats
+            served_rate = speculation["served"] / speculation["launched"] * 100
+            print(f"Speculation: {speculation['launched']} prefetched, {speculation['served']} served ({served_rate:.0f}%), {speculation['discarded']} discarded, ${speculation['spent']:.4f} spent")
+        memory = self.memory_usage()
+        print(f"Memory: {memory['total_bytes'] / 1024:.1f} KB for {memory['messages']} messages ({memory['compressed_messages']} compressed, {memory['chars']} characters) and {memory['code_versions']} code versions")
+        print(f"Total: {len(self.__turn_stats)} turns, {wall_time:.2f}s, {tokens} tokens ({hit_rate:.0f}% of prompt tokens from the provider's prompt cache), ${cost:.4f}")
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Account for the memory this session's conversation and code versions take.
+        
+        Returns:
+            The conversation's message counts and bytes (see MessageStore.memory_usage), plus the
+            number of code versions, the bytes they take and the session's total bytes
+        """
+        usage = self.__conversation.memory_usage()
+        usage["code_versions"] = len(self.__code_blocks)
+        usage["code_bytes"] = sys.getsizeof(self.__code_blocks)
+        for block in self.__code_blocks:
+            usage["code_bytes"] += sys.getsizeof(block) + (sys.getsizeof(block.code) + sys.getsizeof(block.code.data) if isinstance(block.code, CompressedText) else sys.getsizeof(block.code))
+        if self.__latest_python:
+            usage["code_bytes"] += sys.getsizeof(self.__latest_python.code)
+        usage["total_bytes"] = usage["bytes"] + usage["code_bytes"]
+        return usage
+
+    def save_stats(self, filename: str):
+        """
+        Save the turn measurements as JSON.
+        
+        Args:
+            filename: Path to the output JSON file
+        """
+        try:
+            with open(filename, "w") as file:
+                json.dump([stats._asdict() for stats in self.__turn_stats], file, indent=2)
+        except Exception as e:
+            print(f"Error saving stats: {str(e)}")
+
+    def write_metrics_textfile(self, filename: str):
+        """
+        Write a Prometheus textfile snapshot of this session's turn measurements.
+        
+        Args:
+            filename: Path to the .prom file, replaced atomically
+        """
+        try:
+            temp_filename = filename + ".tmp"
+            with open(temp_filename, "w") as file:
+                file.write(format_metrics(self.__turn_stats))
+            os.replace(temp_filename, filename)
+        except Exception as e:
+            print(f"Error writing metrics: {str(e)}")
+
+    def format_transcript(self) -> str:
+        """
+        Render the entire conversation as text.
+        
+        Returns:
+            Every message under a header naming its role
+        """
+        return "".join(f"=== {message['role'].upper()} ===\n{message['content']}\n\n" for message in self.__conversation)
+
+    def save_to_file(self, filename: str):
+        """
+        Save the entire conversation to a file.
+        
+        Args:
+            filename: Path to the output file
+        """
+        try:
+            with open(filename, "w") as file:
+                file.write(self.format_transcript())
+            print(f"Conversation saved to {filename}")
+            self.save_stats(os.path.splitext(filename)[0] + ".stats.json")
+        except Exception as e:
+            print(f"Error saving file: {str(e)}")
+    
+    def extract_code(self) -> str:
+        """
+        Extract Python code from the conversation.
+        
+        Returns:
+            The latest block of Python code found in the conversation, or None
+        """
+        return self.__latest_python.code if self.__latest_python else None
+
+    def code_versions(self) -> List[CodeBlock]:
+        """
+        List every code block the assistant has produced, oldest first.
+        
+        Returns:
+            The indexed code blocks; versions are numbered from 1 in the order they were
+            written, and those of trimmed turns are missing
+        """
+        return [block._replace(code=unpack_text(block.code)) for block in self.__code_blocks]
+
+    def get_code_version(self, version: Optional[int] = None) -> Optional[CodeBlock]:
+        """
+        Look up one version of the code.
+        
+        Args:
+            version: 1-based version number, or None for the latest Python block
+            
+        Returns:
+            The code block, or None if there is no such version
+        """
+        if version is None:
+            return self.__latest_python
+        if self.__dropped_versions < version <= self.__dropped_versions + len(self.__code_blocks):
+            block = self.__code_blocks[version - self.__dropped_versions - 1]
+            return block._replace(code=unpack_text(block.code))
+        return None
+
+    def __index_code(self, content: str):
+        """Add the code blocks of a new assistant message to the index."""
+        self.__turns += 1
+        if "```" not in content:
+            return
+        for position, match in enumerate(CODE_FENCE_PATTERN.finditer(content), 1):
+            language = match.group(1).lower()
+            block = CodeBlock(self.__dropped_versions + len(self.__code_blocks) + 1, self.__turns, position, sys.intern(language), match.group(2))
+            # Every version is kept compressed; only the latest Python block stays as plain text for extract_code()
+            self.__code_blocks.append(block._replace(code=CompressedText.pack(block.code)))
+            if language in PYTHON_LANGUAGE_TAGS:
+                self.__latest_python = block
+
+    def save_code_to_file(self, filename: str, version: Optional[int] = None) -> bool:
+        """
+        Extract code from the conversation and save it to a Python file.
+        
+        Args:
+            filename: Path to the output Python file
+            version: Version number from code_versions() to save, or None for the latest
+            
+        Returns:
+            True if successful, False otherwise
+        """
+        block = self.get_code_version(version)
+        code = block.code if block else None
+        if not code:
+            if version is None:
+                print("No code found in the conversation.")
+            else:
+                print(f"No code version {version} in the conversation.")
+            return False
+        if block.language in PYTHON_LANGUAGE_TAGS:
+            try:
+                compile(code, filename, "exec")
+            except SyntaxError as e:
+                print(f"Warning: version {block.version} does not compile: {e}")
+            issues = self.lint(block.version) if not is_test_code(code) else None
+            if issues:
+                print(f"Warning: version {block.version} has {len(issues)} slow pattern{'s' if len(issues) != 1 else ''} (see >lint {block.version})")
+            
+        try:
+            with open(filename, "w") as file:
+                file.write(code)
+            print(f"Code saved to {filename}")
+        except Exception as e:
+            print(f"Error saving code: {str(e)}")
+            return False
+        if self.__library and block.language in PYTHON_LANGUAGE_TAGS and not is_test_code(code):
+            try:
+                self.__library.add(self.__function_request or self.__last_user_request(), code)
+            except Exception as e:
+                print(f"Error adding code to the library: {str(e)}")
+        return True
+
+    def __last_user_request(self) -> str:
+        """The latest user message, for code whose request was not seen (e.g. a resumed session)."""
+        for idx in range(len(self.__conversation) - 1, -1, -1):
+            if self.__conversation.role(idx) == "user":
+                return self.__conversation[idx]["content"]
+        return ""
+    
+    def trim_history(self, max_chars: int) -> int:
+        """
+        Drop the oldest turns until the conversation fits in a size limit.
+        
+        The current system instructions and the latest turn are always kept. The code
+        versions of dropped turns are dropped too, but turns and versions keep their
+        numbers, and the function being worked on is still known. The journal, if any,
+        still holds everything that was dropped, before its new snapshot.
+        
+        Args:
+            max_chars: Maximum total length of the message contents
+            
+        Returns:
+            The number of messages dropped
+        """
+        sizes = [self.__conversation.length(idx) for idx in range(len(self.__conversation))]
+        if sum(sizes) <= max_chars:
+            return 0
+        starts = [idx for idx in range(1, len(self.__conversation)) if self.__conversation.role(idx) == "user"]
+        if not starts:
+            return 0
+        budget = max_chars - len(self.__system_message)
+        keep_from = starts[-1]
+        for start in starts:
+            if sum(sizes[start:]) <= budget:
+                keep_from = start
+                break
+        dropped = keep_from - 1
+        self.__conversation[0] = {"role": "system", "content": self.__applied_system_message}
+        self.__dropped_turns += sum(1 for idx in range(1, keep_from) if self.__conversation.role(idx) == "assistant")
+        del self.__conversation[1:keep_from]
+        kept = [block for block in self.__code_blocks if block.turn > self.__dropped_turns]
+        self.__dropped_versions += len(self.__code_blocks) - len(kept)
+        self.__code_blocks = kept
+        # Follow-ups prefetched for the latest turn are still valid answers
+        self.__speculations = {name: (future, cancelled, conversation_length - dropped) for name, (future, cancelled, conversation_length) in self.__speculations.items()}
+        if self.__context_window:
+            self.__context_window.reset()
+        if self.__journal:
+            self.__journal.snapshot(self.__conversation, **self.__numbering())
+            self.__record_pending_mode()
+        return dropped
+
+    def reset_conversation(self, keep_system_message: bool = True):
+        """
+        Reset the conversation history.
+        
+        Args:
+            keep_system_message: Whether to keep the system message
+        """
+        self.cancel_speculation()
+        system_message = self.__conversation[0] if keep_system_message else None
+        self.__conversation = MessageStore([system_message] if system_message else [])
+        # Keep the original system message as the prefix; a later mode switch is re-added on the next turn
+        self.__applied_system_message = system_message["content"] if system_message else self.__system_message
+        self.__code_blocks = []
+        self.__latest_python = None
+        self.__turns = self.__dropped_turns = self.__dropped_versions = 0
+        self.__function_request = None
+        self.__validation = None
+        self.__lint_results = {}
+        self.__lint_report = None
+        if self.__context_window:
+            self.__context_window.reset()
+        if self.__journal:
+            self.__journal.snapshot(self.__conversation)
+            self.__record_pending_mode()
+        print("Conversation reset.")
+    
+    def show_code_versions(self):
+        """Print a one-line summary of every indexed code block."""
+        if not self.__code_blocks:
+            print("No code found in the conversation.")
+            return
+        for block in self.code_versions():
+            lines = block.code.strip().splitlines()
+            first_line = lines[0] if lines else ""
+            print(f"v{block.version}: turn {block.turn}, block {block.position}, {block.language or 'untagged'}, {len(lines)} lines -- {first_line[:60]}")
+
+    def show_history(self):
+        """Print the conversation history."""
+        for idx, message in enumerate(self.__conversation):
+            role = message["role"]
+            if role == "system":
+                continue
+            print(f"\n--- Message {idx} ({role}) ---")
+            print(message["content"])
+
+class AsyncFunkyCoder(FunkyCoder):
+    """
+    asyncio counterpart of FunkyCoder built on LiteLLM acompletion.
+    
+    The conversation, save and extract logic is inherited from FunkyCoder; only the
+    network calls are awaited, so many sessions can share a single event loop.
+    """
+
+    async def aprompt(self, user_input: str, stream: Optional[bool] = None, on_token: Optional[Callable[[str], None]] = None, use_cache: bool = True, candidates: Optional[int] = None, use_library: bool = True) -> str:
+        """
+        Send a prompt to the LLM and await the response.
+        
+        Args:
+            user_input: The user's input text
+            stream: Stream the response token-by-token (defaults to the agent setting)
+            on_token: Called with each piece of text as it arrives while streaming
+            use_cache: Consult and fill the response cache for this call, if one is configured
+            candidates: Generate this many answers at once and keep the best (defaults to the agent setting)
+            use_library: Look a request for a new function up in the function library, if one is configured
+            
+        Returns:
+            The assistant's response
+        """
+        count = candidates or self.candidates
+        speculation = self._claim_speculation(user_input, claim=count == 1)
+        try:
+            request = await self.__off_loop(self._begin_turn, user_input, stream, allow_edit=speculation is None and count == 1, candidates=count, use_library=use_library and speculation is None)
+            return await self.__arun_turn(request, on_token, use_cache, count, speculation)
+        except asyncio.CancelledError:
+            # The task running the prompt was cancelled (e.g. a server client went away): close the turn
+            if self.cancel():
+                self._cancel_turn("")
+            raise
+
+    async def __off_loop(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run blocking turn bookkeeping (journal writes, the cache, token counting, checks) on a worker thread.
+        
+        If the caller is cancelled meanwhile, the call is still waited for, so the
+        turn is never left half-updated.
+        """
+        future = asyncio.get_event_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def __arun_turn(self, request: Dict[str, Any], on_token: Optional[Callable[[str], None]], use_cache: bool, count: int, speculation: Optional[Future]) -> str:
+        """Answer the turn aprompt() began, from the library, the cache, a speculation or the model."""
+        reused = self._library_answer()
+        if reused is not None:
+            if request["stream"] and on_token:
+                on_token(reused)
+            return await self.__off_loop(self._finish_turn, reused, cache_hit=True)
+        cache_key, cached = await self.__off_loop(self._cache_get, request, use_cache)
+        if cached is not None:
+            if request["stream"] and on_token:
+                on_token(cached)
+            return await self.__off_loop(self._finish_turn, cached, cache_hit=True)
+        if speculation is not None:
+            try:
+                assistant_response, usage = await asyncio.wrap_future(speculation)
+                if request["stream"] and on_token:
+                    on_token(assistant_response)
+                return await self.__off_loop(self._finish_turn, assistant_response, usage)
+            except Exception:
+                # The speculative request failed; fall back to a regular one
+                pass
+        try:
+            if count > 1:
+                assistant_response, usage = await self.__abest_of(request, count)
+                if request["stream"] and on_token:
+                    on_token(assistant_response)
+            else:
+                assistant_response, usage = await self.__acomplete(request, on_token)
+                assistant_response, fallback_request = await self.__off_loop(self._check_response, assistant_response, usage)
+                if fallback_request is not None:
+                    assistant_response, usage = await self.__acomplete(fallback_request, on_token)
+        except Exception as e:
+            return await self.__off_loop(self._fail_turn, e)
+        await self.__off_loop(self._cache_put, cache_key, assistant_response)
+        return await self.__off_loop(self._finish_turn, assistant_response, usage)
+
+    async def __abest_of(self, request: Dict[str, Any], count: int) -> Tuple[str, Any]:
+        """
+        Generate several candidate answers at once and keep the one whose code checks out best.
+        
+        Args:
+            request: Keyword arguments for acompletion()
+            count: Number of candidates
+            
+        Returns:
+            The winning answer and the combined usage of all candidates
+        """
+        request = self._candidate_request(request)
+        responses, errors = [], []
+        if supports_n(request["model"]):
+            try:
+                responses.append(await self._acompletion(dict(request, n=count)))
+            except Exception as e:
+                errors.append(e)
+        missing = count - sum(len(response.choices) for response in responses)
+        if missing > 0:
+            for outcome in await asyncio.gather(*(self._acompletion(request) for _ in range(missing)), return_exceptions=True):
+                (errors if isinstance(outcome, Exception) else responses).append(outcome)
+        texts = [choice.message.content or "" for response in responses for choice in response.choices][:count]
+        if not texts:
+            raise errors[-1]
+        results = []
+        for check in self._check_candidates(texts):
+            try:
+                results.append(await asyncio.wrap_future(check) if check else None)
+            except Exception:
+                results.append(None)
+        return self._pick_candidate(texts, results), combine_usage([getattr(response, "usage", None) for response in responses])
+
+    async def __acomplete(self, request: Dict[str, Any], on_token: Optional[Callable[[str], None]]) -> Tuple[str, Any]:
+        """
+        Get the response for a turn, retrying and hedging within the turn's deadline.
+        
+        Args:
+            request: Keyword arguments for acompletion()
+            on_token: Called with each piece of text as it arrives while streaming
+            
+        Returns:
+            The response text and its usage block (None if it arrived with the stream)
+        """
+        deadline = self._turn_deadline()
+        emitted = []
+
+        def forward(token: str):
+            emitted.append(token)
+            if on_token:
+                on_token(token)
+
+        attempt = 0
+        while True:
+            try:
+                attempt_request = self._attempt_request(request, deadline)
+                hedge_delay = self._hedge_delay(request["stream"])
+                if hedge_delay is not None:
+                    coroutine = self.__ahedged_attempt(attempt_request, forward, hedge_delay)
+                else:
+                    coroutine = self.__asingle_attempt(attempt_request, forward)
+                timeout = max(deadline - time.perf_counter(), 0.001) if deadline is not None else None
+                return await asyncio.wait_for(coroutine, timeout)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and deadline is not None and time.perf_counter() >= deadline:
+                    raise self._deadline_error()
+                delay = self._retry_delay(e, attempt, deadline, bool(emitted))
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def __asingle_attempt(self, request: Dict[str, Any], forward: Callable[[str], None]) -> Tuple[str, Any]:
+        """Send one request and read its response."""
+        response = await self._acompletion(request)
+        if not request["stream"]:
+            return response.choices[0].message.content, getattr(response, "usage", None)
+        pieces = []
+        try:
+            async for chunk in response:
+                token = self._stream_token(chunk)
+                if token:
+                    pieces.append(token)
+                    forward(token)
+        except BaseException:
+            # Cancelled or failed mid-stream: drop the connection so the provider stops generating
+            await aclose_stream(response)
+            raise
+        return "".join(pieces), None
+
+    async def __ahedged_attempt(self, request: Dict[str, Any], forward: Callable[[str], None], hedge_delay: float) -> Tuple[str, Any]:
+        """
+        Send a request and, if it shows no sign of life within hedge_delay, a second one.
+        
+        Whichever request responds first is read to the end; the other is cancelled.
+        """
+        async def first_chunk():
+            response = await self._acompletion(request)
+            if not request["stream"]:
+                return response, None, None
+            iterator = response.__aiter__()
+            try:
+                return response, iterator, await iterator.__anext__()
+            except StopAsyncIteration:
+                return response, iterator, None
+
+        tasks = [asyncio.ensure_future(first_chunk())]
+        done, pending = await asyncio.wait(tasks, timeout=hedge_delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(first_chunk()))
+            self._note_hedged()
+        winner = None
+        try:
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if not task.exception()), None)
+            if winner is None:
+                raise tasks[-1].exception()
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    if task.done() and not task.cancelled() and not task.exception():
+                        await aclose_stream(task.result()[0])
+
+        response, iterator, chunk = winner.result()
+        if iterator is None:
+            return response.choices[0].message.content, getattr(response, "usage", None)
+        pieces = []
+        while chunk is not None:
+            token = self._stream_token(chunk)
+            if token:
+                pieces.append(token)
+                forward(token)
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+        return "".join(pieces), None
+
+    async def astream(self, user_input: str, use_cache: bool = True, candidates: Optional[int] = None, use_library: bool = True) -> AsyncIterator[str]:
+        """
+        Send a prompt to the LLM and yield the response as it arrives.
+        
+        The turn runs through aprompt(), with the same cache, library, speculation,
+        edit mode and best-of-N handling; answers that do not arrive as a stream are
+        yielded in one piece. If the caller stops iterating early, the turn is
+        cancelled and rolled back.
+        
+        Args:
+            user_input: The user's input text
+            use_cache: Consult and fill the response cache for this call, if one is configured
+            candidates: Generate this many answers at once and keep the best (defaults to the agent setting)
+            use_library: Look a request for a new function up in the function library, if one is configured
+            
+        Yields:
+            Pieces of the assistant's response
+        """
+        tokens = asyncio.Queue()
+        finished = object()
+        task = asyncio.ensure_future(self.aprompt(user_input, stream=True, on_token=tokens.put_nowait, use_cache=use_cache, candidates=candidates, use_library=use_library))
+        task.add_done_callback(lambda _: tokens.put_nowait(finished))
+        try:
+            while True:
+                token = await tokens.get()
+                if token is finished:
+                    break
+                yield token
+            task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+class PlannedFunction(NamedTuple):
+    """One function of a project plan."""
+    name: str
+    module: str
+    signature: str
+    description: str
+    depends_on: Tuple[str, ...] = ()
+
+class BuiltFunction(NamedTuple):
+    """A function generated for a project, with its tests and timings."""
+    name: str
+    module: str
+    code: str = ""
+    tests: str = ""
+    turns: int = 0
+    started: float = 0.0
+    seconds: float = 0.0
+    validated: Optional[bool] = None
+    error: Optional[str] = None
+
+class ProjectResult(NamedTuple):
+    """Outcome of building a project."""
+    description: str
+    directory: str
+    plan: List[PlannedFunction]
+    functions: List[BuiltFunction]
+    files: List[str]
+    seconds: float
+    turn_seconds: float
+    critical_path: float
+    errors: List[str]
+
+def parse_project_plan(text: str) -> List[PlannedFunction]:
+    """
+    Read a project plan from the planner's answer.
+    
+    The plan is a JSON object, optionally in a fenced block: {"modules": [{"name": ...,
+    "functions": [{"name", "signature", "description", "depends_on"}]}]}.
+    Modules whose functions call each other both ways are merged into the first of them,
+    so the assembled modules never import each other in a cycle.
+    
+    Args:
+        text: The planner's answer
+        
+    Returns:
+        The planned functions, each after the functions it depends on
+        
+    Raises:
+        ValueError: If the plan is malformed, names a function twice, depends on an unknown
+            function or has a dependency cycle
+    """
+    blocks = [match.group(2) for match in CODE_FENCE_PATTERN.finditer(text) if match.group(1).lower() in ("json", "")]
+    source = blocks[0] if blocks else text[text.find("{"):text.rfind("}") + 1]
+    try:
+        plan = json.loads(source)
+    except ValueError as e:
+        raise ValueError(f"the plan is not valid JSON: {e}")
+    if not isinstance(plan, dict) or not isinstance(plan.get("modules"), list) or not plan["modules"]:
+        raise ValueError("the plan has no modules")
+    stdlib = getattr(sys, "stdlib_module_names", frozenset())
+    functions = {}
+    for module in plan["modules"]:
+        module_name = module.get("name") if isinstance(module, dict) else None
+        if not isinstance(module_name, str) or not module_name.isidentifier():
+            raise ValueError(f"invalid module name {module_name!r}")
+        if module_name in stdlib or module_name.startswith("test"):
+            # A module named like the standard library, or like a test file, would be shadowed or collected
+            module_name += "_lib"
+        for function in module.get("functions") or []:
+            name = function.get("name") if isinstance(function, dict) else None
+            if not isinstance(name, str) or not name.isidentifier():
+                raise ValueError(f"invalid function name {name!r} in module {module_name}")
+            if name in functions:
+                raise ValueError(f"function {name} is planned twice")
+            depends_on = function.get("depends_on") or []
+            if not isinstance(depends_on, list) or not all(isinstance(dependency, str) for dependency in depends_on):
+                raise ValueError(f"depends_on of {name} is not a list of names")
+            functions[name] = PlannedFunction(name, module_name, str(function.get("signature") or f"def {name}(...)"), str(function.get("description") or ""), tuple(dict.fromkeys(depends_on)))
+    if not functions:
+        raise ValueError("the plan has no functions")
+    for function in functions.values():
+        unknown = [dependency for dependency in function.depends_on if dependency not in functions or dependency == function.name]
+        if unknown:
+            raise ValueError(f"{function.name} depends on {', '.join(unknown)}, which {'is' if len(unknown) == 1 else 'are'} not another planned function")
+    # Kahn's algorithm, keeping the planner's order among functions that are ready together
+    waiting = {name: len(function.depends_on) for name, function in functions.items()}
+    dependents = {name: [] for name in functions}
+    for function in functions.values():
+        for dependency in function.depends_on:
+            dependents[dependency].append(function.name)
+    ready = deque(name for name, count in waiting.items() if not count)
+    ordered = []
+    while ready:
+        name = ready.popleft()
+        ordered.append(functions[name])
+        for dependent in dependents[name]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                ready.append(dependent)
+    if len(ordered) < len(functions):
+        raise ValueError(f"dependency cycle among {', '.join(name for name, count in waiting.items() if count)}")
+    # Modules that can reach each other through imports form a cycle, and are merged
+    modules = list(dict.fromkeys(function.module for function in functions.values()))
+    imports = {module: set() for module in modules}
+    for function in functions.values():
+        imports[function.module].update(functions[dependency].module for dependency in function.depends_on)
+    reachable = {}
+    for module in modules:
+        seen, pending = set(), [module]
+        while pending:
+            for imported in imports[pending.pop()]:
+                if imported not in seen:
+                    seen.add(imported)
+                    pending.append(imported)
+        reachable[module] = seen
+    merged = {module: next(other for other in modules if other == module or (other in reachable[module] and module in reachable[other])) for module in modules}
+    return [function._replace(module=merged[function.module]) for function in ordered]
+
+def split_python_source(code: str) -> Tuple[List[str], List[Tuple[Optional[str], str]]]:
+    """
+    Split Python code into its top-level imports and its other top-level statements.
+    
+    `if __name__ == "__main__":` blocks are dropped.
+    
+    Args:
+        code: Python source
+        
+    Returns:
+        The import statements, and (name, source) of every other statement, where name is
+        that of the function or class it defines, or None
+        
+    Raises:
+        SyntaxError: If the code does not parse
+    """
+    tree = ast.parse(code)
+    lines = code.splitlines()
+    imports, statements = [], []
+    for node in tree.body:
+        first = node.decorator_list[0].lineno if getattr(node, "decorator_list", None) else node.lineno
+        source = "\n".join(lines[first - 1:node.end_lineno])
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.append(source)
+        elif isinstance(node, ast.If) and "__name__" in ast.get_source_segment(code, node.test):
+            continue
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str) and not statements:
+            continue  # a module docstring
+        else:
+            statements.append((node.name if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) else None, source))
+    return imports, statements
+
+class ProjectBuilder:
+    """
+    Build a small project of several functions: plan the functions and their dependencies,
+    generate each one in its own sub-conversation, and assemble them into modules with tests.
+    
+    Functions are generated as soon as the functions they depend on are done, up to
+    `workers` at a time, so the wall time follows the longest dependency chain rather
+    than the number of functions. Each function's code and tests are checked in the
+    validation sandbox together with the code of its dependencies, and a failure is sent
+    back to its sub-conversation for a fix.
+    """
+
+    def __init__(self, api_key: str, system_message: str, agent_options: Optional[Dict[str, Any]] = None, workers: int = 4, repairs: int = 1):
+        """
+        Args:
+            api_key: OpenAI API key
+            system_message: System instructions of the sub-conversations
+            agent_options: Extra keyword arguments for every sub-conversation's FunkyCoder (model, cache, scheduler, ...);
+                a "validator" is used for the checks rather than given to the sub-conversations, and speculation,
+                candidates, lint and edit mode are turned off, as the builder checks and repairs every function itself
+            workers: Functions generated at once
+            repairs: Fix requests sent to a function's sub-conversation when its tests fail
+        """
+        self.__api_key = api_key
+        self.__system_message = system_message
+        self.__agent_options = dict(agent_options or {})
+        self.__validator = self.__agent_options.pop("validator", None)
+        self.__own_validator = None
+        self.__workers = max(workers, 1)
+        self.__repairs = max(repairs, 0)
+        self.__lock = threading.Lock()
+
+    def __agent(self, system_message: str, session: str) -> FunkyCoder:
+        options = dict(self.__agent_options, stream=False, session=session, speculate=False, candidates=1, lint=False, edit_mode=False)
+        return FunkyCoder(self.__api_key, system_message, **options)
+
+    def plan(self, description: str) -> List[PlannedFunction]:
+        """
+        Ask the model for the functions of a project and their dependencies.
+        
+        Args:
+            description: What the project should do
+            
+        Returns:
+            The planned functions, each after the functions it depends on
+            
+        Raises:
+            ValueError: If the model does not produce a valid plan, even when asked to fix it
+        """
+        planner = self.__agent(data["project_planner"], f"project-plan-{uuid.uuid4().hex[:8]}")
+        request = data["project_plan_prompt"].format(description=description)
+        try:
+            for attempt in range(2):
+                answer = planner.prompt(request, use_cache=attempt == 0, use_library=False)
+                if planner.last_error:
+                    raise ValueError(planner.last_error)
+                try:
+                    return parse_project_plan(answer)
+                except ValueError as e:
+                    error = e
+                    request = data["project_plan_fix"].format(error=e)
+            raise ValueError(f"No usable plan: {error}")
+        finally:
+            planner.cancel_speculation()
+
+    def build(self, description: str, directory: str, plan: Optional[List[PlannedFunction]] = None) -> ProjectResult:
+        """
+        Plan (unless a plan is given), generate, check and assemble a project.
+        
+        Args:
+            description: What the project should do
+            directory: Directory for the modules and their test files
+            plan: The functions to build, from plan(); None to ask the model for them
+            
+        Returns:
+            The functions built, the files written and the timings
+        """
+        try:
+            return self.__build(description, directory, plan)
+        finally:
+            with self.__lock:
+                if self.__own_validator:
+                    self.__own_validator.close()
+                    self.__own_validator = None
+
+    def __build(self, description: str, directory: str, plan: Optional[List[PlannedFunction]]) -> ProjectResult:
+        """Run build(); the sandbox the builder started for its checks is shut down by the caller."""
+        start = time.perf_counter()
+        plan = plan or self.plan(description)
+        specs = {function.name: function for function in plan}
+        print(f"Plan: {len(plan)} functions in {len(set(function.module for function in plan))} modules")
+        for function in plan:
+            after = f" (after {', '.join(function.depends_on)})" if function.depends_on else ""
+            print(f"  {function.module}.{function.name}{after}")
+        built, errors = {}, []
+        dependents = {name: [other.name for other in plan if name in other.depends_on] for name in specs}
+        remaining = {name: set(function.depends_on) for name, function in specs.items()}
+        ready = deque(function.name for function in plan if not function.depends_on)
+
+        def complete(name: str, result: BuiltFunction):
+            built[name] = result
+            if result.error:
+                errors.append(f"{name}: {result.error}")
+            outcome = f"failed: {result.error}" if result.error else {True: "tests pass", False: "tests fail", None: "no tests"}[result.validated]
+            print(f"[{name}: {outcome} after {result.seconds:.1f}s]")
+            for dependent in dependents[name]:
+                remaining[dependent].discard(name)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        with ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="project") as executor:
+            running = {}
+            while ready or running:
+                while ready:
+                    name = ready.popleft()
+                    failed = [dependency for dependency in specs[name].depends_on if built[dependency].error]
+                    if failed:
+                        complete(name, BuiltFunction(name, specs[name].module, error=f"skipped, as {', '.join(failed)} failed"))
+                    else:
+                        running[executor.submit(self.__generate, description, specs[name], built, plan, start)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = BuiltFunction(name, specs[name].module, error=str(e) or type(e).__name__)
+                    complete(name, result)
+        functions = [built[function.name] for function in plan]
+        files = self.__write(description, directory, plan, built, errors) if any(not function.error for function in functions) else []
+        finish = {}
+        for function in plan:
+            finish[function.name] = built[function.name].seconds + max((finish[dependency] for dependency in function.depends_on), default=0.0)
+        return ProjectResult(
+            description, directory, plan, functions, files, time.perf_counter() - start,
+            sum(function.seconds for function in functions), max(finish.values(), default=0.0), errors)
+
+    def __validate(self, code: str, tests: Optional[str]) -> ValidationResult:
+        """Check code, and its tests if any, in the validation sandbox."""
+        with self.__lock:
+            if self.__validator is None and self.__own_validator is None:
+                self.__own_validator = CodeValidator(workers=self.__workers)
+        return (self.__validator or self.__own_validator).validate(code, tests)
+
+    @staticmethod
+    def __closure(names: Sequence[str], plan: List[PlannedFunction]) -> List[str]:
+        """The given functions and everything they depend on, in plan order."""
+        specs = {function.name: function for function in plan}
+        needed, pending = set(), list(names)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(specs[name].depends_on)
+        return [function.name for function in plan if function.name in needed]
+
+    @staticmethod
+    def __join(codes: List[str], extra_imports: Optional[List[str]] = None, docstring: Optional[str] = None) -> str:
+        """Merge pieces of code into one module: their imports first, deduplicated, then their other statements."""
+        imports, statements = [], []
+        for code in codes:
+            code_imports, code_statements = split_python_source(code)
+            imports += code_imports
+            statements += [source for _, source in code_statements]
+        imports = list(dict.fromkeys(imports + (extra_imports or [])))
+        imports.sort(key=lambda line: not line.startswith("from __future__"))
+        parts = ["\n".join(imports)] if imports else []
+        parts += list(dict.fromkeys(statements))
+        source = "\n\n\n".join(parts) + "\n"
+        return f'"""{docstring}"""\n\n{source}' if docstring else source
+
+    @staticmethod
+    def __clean(code: str, own: str, planned: Dict[str, PlannedFunction], is_tests: bool) -> str:
+        """
+        Keep only what a function's answer adds to the project: drop its copies of other planned
+        functions and, in tests, the imports of planned functions (the assembled test file imports them).
+        """
+        imports, statements = split_python_source(code)
+        if is_tests:
+            kept = []
+            for source in imports:
+                node = ast.parse(source).body[0]
+                names = [alias.name.partition(".")[0] for alias in node.names]
+                modules = [node.module or ""] if isinstance(node, ast.ImportFrom) else names
+                if not any(name in planned for name in names) and not any(module in {function.module for function in planned.values()} for module in modules):
+                    kept.append(source)
+            imports = kept
+        statements = [(name, source) for name, source in statements if name is None or name == own or name not in planned]
+        return "\n\n\n".join(["\n".join(imports)] * bool(imports) + [source for _, source in statements]) + "\n"
+
+    def __generate(self, description: str, spec: PlannedFunction, built: Dict[str, BuiltFunction], plan: List[PlannedFunction], start: float) -> BuiltFunction:
+        """Write one function and its tests in a fresh sub-conversation, checking them with the functions they depend on."""
+        started = time.perf_counter()
+        planned = {function.name: function for function in plan}
+        dependencies = [built[name].code for name in self.__closure(spec.depends_on, plan)]
+        request = data["project_function_prompt"].format(
+            description=description, module=spec.module, name=spec.name, signature=spec.signature, purpose=spec.description,
+            dependencies=data["project_dependencies"].format(code=self.__join(dependencies).strip()) if dependencies else "")
+        agent = self.__agent(self.__system_message, f"project-{spec.module}-{spec.name}")
+        try:
+            code, tests, validated, turns = "", "", None, 0
+            for attempt in range(self.__repairs + 1):
+                agent.prompt(request, use_library=attempt == 0)
+                turns += 1
+                if agent.last_error:
+                    return BuiltFunction(spec.name, spec.module, code, tests, turns, started - start, time.perf_counter() - started, validated, agent.last_error)
+                found_code = found_tests = None
+                for block in reversed(agent.code_versions()):
+                    if block.language not in PYTHON_LANGUAGE_TAGS:
+                        continue
+                    if is_test_code(block.code):
+                        found_tests = found_tests or block.code
+                    elif found_code is None and re.search(rf"^(?:async\s+)?def\s+{spec.name}\s*\(", block.code, re.MULTILINE):
+                        found_code = block.code
+                try:
+                    code = self.__clean(found_code, spec.name, planned, False) if found_code else ""
+                    tests = self.__clean(found_tests, spec.name, planned, True) if found_tests else tests
+                except SyntaxError as e:
+                    request = data["project_fix"].format(output=f"The code does not parse: {e}")
+                    continue
+                if not code:
+                    request = data["project_fix"].format(output=f"There is no definition of {spec.name}.")
+                    continue
+                result = self.__validate(self.__join(dependencies + [code]), tests or None)
+                validated = result.ok if tests else None
+                if result.ok:
+                    break
+                request = data["project_fix"].format(output=result.output or f"It failed at {result.stage}.")
+            error = None if code else f"no definition of {spec.name} after {turns} turns"
+            return BuiltFunction(spec.name, spec.module, code, tests, turns, started - start, time.perf_counter() - started, validated, error)
+        finally:
+            agent.cancel_speculation()
+
+    def __write(self, description: str, directory: str, plan: List[PlannedFunction], built: Dict[str, BuiltFunction], errors: List[str]) -> List[str]:
+        """Assemble the functions built into their modules and test files, and check each module's tests."""
+        os.makedirs(directory, exist_ok=True)
+        specs = {function.name: function for function in plan}
+        files = []
+        for module in dict.fromkeys(function.module for function in plan):
+            names = [function.name for function in plan if function.module == module and not built[function.name].error]
+            if not names:
+                continue
+            imported = {}
+            for name in names:
+                for dependency in specs[name].depends_on:
+                    if specs[dependency].module != module:
+                        imported.setdefault(specs[dependency].module, []).append(dependency)
+            cross_imports = [f"from {other} import {', '.join(sorted(set(dependencies)))}" for other, dependencies in imported.items()]
+            source = self.__join([built[name].code for name in names], cross_imports, description.strip().splitlines()[0].replace('"', "'"))
+            tests, used = [], set()
+            for name in names:
+                if not built[name].tests:
+                    continue
+                imports, statements = split_python_source(built[name].tests)
+                pieces = list(imports)
+                for statement_name, statement in statements:
+                    if statement_name is not None and statement_name in used:
+                        # Test functions of different functions are often named alike (test_basic, TestEdgeCases, ...)
+                        statement = re.sub(rf"\b(def|class)\s+{statement_name}\b", rf"\1 {statement_name}_{name}", statement, count=1)
+                    used.add(statement_name)
+                    pieces.append(statement)
+                tests.append("\n\n\n".join(pieces))
+            test_source = self.__join(tests, [f"from {module} import {', '.join(names)}"]) if tests else None
+            for filename, content in ((f"{module}.py", source), (f"test_{module}.py", test_source)):
+                if content is not None:
+                    with open(os.path.join(directory, filename), "w") as file:
+                        file.write(content)
+                    files.append(filename)
+            if test_source:
+                flat = self.__join([built[name].code for name in self.__closure(names, plan) if not built[name].error])
+                result = self.__validate(flat, test_source)
+                print(f"[{module}: {result.tests_run - result.tests_failed}/{result.tests_run} tests pass]" if result.tests_run else f"[{module}: tests failed at {result.stage}]")
+                if not result.ok:
+                    errors.append(f"{module}: tests fail")
+        return files
+
+def format_project(result: ProjectResult) -> str:
+    """
+    Render the outcome of a project build.
+    
+    Args:
+        result: The build, from ProjectBuilder.build()
+        
+    Returns:
+        The report text
+    """
+    done = [function for function in result.functions if not function.error]
+    lines = [f"Built {len(done)} of {len(result.functions)} functions in {result.seconds:.1f}s "
+             f"(turns took {result.turn_seconds:.1f}s in all; the longest dependency chain {result.critical_path:.1f}s)"]
+    for function in result.functions:
+        status = function.error or {True: "tests pass", False: "tests fail", None: "no tests"}[function.validated]
+        lines.append(f"  {function.module}.{function.name}: {status}, {function.turns} turn{'s' if function.turns != 1 else ''}, "
+                     f"{function.started:.1f}s to {function.started + function.seconds:.1f}s")
+    if result.files:
+        lines.append(f"Files in {result.directory}: {', '.join(result.files)}")
+    return "\n".join(lines)
+
+class SessionServer:
+    """
+    Hosts many AsyncFunkyCoder sessions behind a small HTTP API in one asyncio process.
+    
+    Every session is journaled to its own file, which doubles as its swap space:
+    sessions idle for longer than the idle timeout, or the least recently used ones
+    beyond the active limit, are dropped from memory and resumed from their journal
+    on the next request. Prompts can stream their response as server-sent events.
+    
+    API (JSON bodies and responses):
+        GET    /health                       active and paged-out session counts, rate limiter queues
+        POST   /sessions                     create a session: {"slang": false}
+        GET    /sessions/<id>                session summary and memory use
+        DELETE /sessions/<id>                end a session
+        POST   /sessions/<id>/prompt         {"input": "...", "stream": true, "candidates": 1}
+        GET    /sessions/<id>/history        the conversation
+        GET    /sessions/<id>/code           latest code, or ?version=N
+        GET    /sessions/<id>/versions       every code version
+        GET    /sessions/<id>/save           the transcript as text
+        GET    /sessions/<id>/stats          per-turn measurements
+        POST   /sessions/<id>/reset          start the conversation over
+        POST   /sessions/<id>/mode           {"mode": "slang"} or {"mode": "normal"}
+        POST   /sessions/<id>/bench          {"sizes": [...], "inputs": "...", "optimize": false}
+    """
+    SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+    MAX_BODY_BYTES = 1024 * 1024
+
+    def __init__(self, api_key: str, session_dir: str = os.path.join(".funky_sessions", "server"), agent_options: Optional[Dict[str, Any]] = None, max_active: int = 1000, idle_timeout: float = 600.0, max_session_chars: int = 200000, max_candidates: int = 4):
+        """
+        Create the server.
+        
+        Args:
+            api_key: OpenAI API key
+            session_dir: Directory holding one journal per session
+            agent_options: Extra keyword arguments for every session's AsyncFunkyCoder (model, cache, ...)
+            max_active: Maximum number of sessions kept in memory
+            idle_timeout: Seconds after which an unused session is paged out to disk
+            max_session_chars: Size limit of a session's in-memory conversation; older turns beyond it are dropped
+            max_candidates: Most candidate answers a client may ask for in one prompt
+        """
+        self.__api_key = api_key
+        self.__session_dir = session_dir
+        self.__agent_options = dict(agent_options or {})
+        self.__max_active = max_active
+        self.__idle_timeout = idle_timeout
+        self.__max_session_chars = max_session_chars
+        self.__max_candidates = max(max_candidates, 1)
+        self.__sessions = OrderedDict()
+        self.__locks = {}
+        self.__last_used = {}
+        self.paged_in = 0
+        self.paged_out = 0
+        os.makedirs(session_dir, exist_ok=True)
+
+    @property
+    def active_sessions(self) -> int:
+        """Number of sessions currently in memory."""
+        return len(self.__sessions)
+
+    def __journal_path(self, session_id: str) -> str:
+        return os.path.join(self.__session_dir, f"{session_id}.jsonl")
+
+    def create_session(self, is_slang: bool = False) -> str:
+        """
+        Start a new session.
+        
+        Args:
+            is_slang: Start in Funky Slang Mode
+            
+        Returns:
+            The session ID
+        """
+        session_id = uuid.uuid4().hex
+        agent = AsyncFunkyCoder(self.__api_key, get_system_message(is_slang), session=session_id, **self.__agent_options)
+        agent.start_journal(self.__journal_path(session_id))
+        self.__activate(session_id, agent)
+        return session_id
+
+    async def get_session(self, session_id: str) -> Optional[AsyncFunkyCoder]:
+        """
+        Look a session up, paging it in from its journal if it is not in memory.
+        
+        Args:
+            session_id: The session ID
+            
+        Returns:
+            The session's agent, or None if there is no such session
+        """
+        agent = self.__sessions.get(session_id)
+        if agent is not None:
+            self.__sessions.move_to_end(session_id)
+            self.__last_used[session_id] = time.monotonic()
+            return agent
+        path = self.__journal_path(session_id)
+        if not self.SESSION_ID_PATTERN.match(session_id) or not os.path.exists(path):
+            return None
+        agent = AsyncFunkyCoder(self.__api_key, get_system_message(), session=session_id, **self.__agent_options)
+        loaded = await asyncio.get_event_loop().run_in_executor(None, agent.resume, path)
+        if not loaded:
+            return None
+        # Another request may have paged the session in while the journal was being read
+        if session_id in self.__sessions:
+            agent.close_journal()
+            return await self.get_session(session_id)
+        self.paged_in += 1
+        self.__activate(session_id, agent)
+        return agent
+
+    def __activate(self, session_id: str, agent: AsyncFunkyCoder):
+        """Add a session to memory, paging out the least recently used ones beyond the limit."""
+        self.__sessions[session_id] = agent
+        self.__locks[session_id] = asyncio.Lock()
+        self.__last_used[session_id] = time.monotonic()
+        for idle_id in list(self.__sessions):
+            if len(self.__sessions) <= self.__max_active:
+                break
+            if idle_id != session_id:
+                self.page_out(idle_id)
+
+    def page_out(self, session_id: str) -> bool:
+        """
+        Drop a session from memory; its journal already holds everything needed to resume it.
+        
+        Args:
+            session_id: The session ID
+            
+        Returns:
+            True if the session was paged out, False if it is busy or not in memory
+        """
+        lock = self.__locks.get(session_id)
+        if session_id not in self.__sessions or (lock and lock.locked()):
+            return False
+        agent = self.__sessions.pop(session_id)
+        del self.__locks[session_id]
+        del self.__last_used[session_id]
+        agent.cancel_speculation()
+        agent.close_journal()
+        self.paged_out += 1
+        return True
+
+    def end_session(self, session_id: str) -> bool:
+        """Page a session out and delete its journal."""
+        self.page_out(session_id)
+        path = self.__journal_path(session_id)
+        if session_id in self.__sessions or not self.SESSION_ID_PATTERN.match(session_id) or not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def page_out_idle(self) -> int:
+        """Page out every session unused for longer than the idle timeout and return how many were."""
+        cutoff = time.monotonic() - self.__idle_timeout
+        return sum(1 for session_id, last_used in list(self.__last_used.items()) if last_used < cutoff and self.page_out(session_id))
+
+    async def __sweep_idle(self):
+        while True:
+            await asyncio.sleep(min(self.__idle_timeout / 2, 30.0))
+            self.page_out_idle()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        """
+        Accept connections until cancelled.
+        
+        Args:
+            host: Interface to listen on
+            port: Port to listen on
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        sweeper = asyncio.ensure_future(self.__sweep_idle())
+        print(f"Funky Coder server listening on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+            self.close()
+
+    def close(self):
+        """Page out every session."""
+        for session_id in list(self.__sessions):
+            self.page_out(session_id)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one HTTP request on a connection, then close it."""
+        try:
+            request = await self.__read_request(reader)
+            if request is None:
+                await self.__send_json(writer, 400, {"error": "Bad request"})
+            else:
+                await self.__dispatch(writer, *request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            try:
+                await self.__send_json(writer, 500, {"error": str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+
+    async def __read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, List[str], Dict[str, List[str]], Dict[str, Any]]]:
+        """Read a request and return its method, path segments, query and JSON body."""
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            return None
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > self.MAX_BODY_BYTES:
+            return None
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                return None
+        url = urlsplit(target)
+        return method.upper(), [unquote(part) for part in url.path.strip("/").split("/") if part], parse_qs(url.query), body if isinstance(body, dict) else {}
+
+    async def __send_json(self, writer: asyncio.StreamWriter, status: int, payload: Any):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def __dispatch(self, writer: asyncio.StreamWriter, method: str, path: List[str], query: Dict[str, List[str]], body: Dict[str, Any]):
+        """Route a request to the session API."""
+        if path == ["health"] and method == "GET":
+            health = {"active_sessions": len(self.__sessions), "paged_in": self.paged_in, "paged_out": self.paged_out}
+            if self.__agent_options.get("scheduler"):
+                health["scheduler"] = self.__agent_options["scheduler"].stats()
+            await self.__send_json(writer, 200, health)
+            return
+        if path == ["sessions"] and method == "POST":
+            await self.__send_json(writer, 201, {"id": self.create_session(bool(body.get("slang", False)))})
+            return
+        if len(path) not in (2, 3) or path[0] != "sessions":
+            await self.__send_json(writer, 404, {"error": "Not found"})
+            return
+        session_id, action = path[1], path[2] if len(path) == 3 else None
+        if action is None and method == "DELETE":
+            await self.__send_json(writer, 200 if self.end_session(session_id) else 404, {"id": session_id})
+            return
+        agent = await self.get_session(session_id)
+        if agent is None:
+            await self.__send_json(writer, 404, {"error": f"No session {session_id}"})
+            return
+        async with self.__locks[session_id]:
+            if action == "prompt" and method == "POST":
+                await self.__prompt(writer, agent, body)
+                await asyncio.get_event_loop().run_in_executor(None, agent.trim_history, self.__max_session_chars)
+            elif action is None and method == "GET":
+                memory = agent.memory_usage()
+                await self.__send_json(writer, 200, {"id": session_id, "slang": agent.system_message == get_system_message(True), "messages": memory["messages"], "code_versions": memory["code_versions"], "memory": memory})
+            elif action == "history" and method == "GET":
+                await self.__send_json(writer, 200, {"messages": [message for message in agent.conversation if message["role"] != "system"]})
+            elif action == "code" and method == "GET":
+                version = query.get("version", [None])[0]
+                block = agent.get_code_version(int(version) if version and version.isdigit() else None)
+                if block is None:
+                    await self.__send_json(writer, 404, {"error": "No code found in the conversation."})
+                else:
+                    await self.__send_json(writer, 200, block._asdict())
+            elif action == "versions" and method == "GET":
+                await self.__send_json(writer, 200, {"versions": [dict(block._asdict(), code=None, lines=len(block.code.splitlines())) for block in agent.code_versions()]})
+            elif action == "save" and method == "GET":
+                await self.__send_json(writer, 200, {"transcript": agent.format_transcript()})
+            elif action == "stats" and method == "GET":
+                await self.__send_json(writer, 200, {"turns": [stats._asdict() for stats in agent.turn_stats]})
+            elif action == "bench" and method == "POST":
+                await self.__bench(writer, agent, body)
+            elif action == "lint" and method == "GET":
+                version = query.get("version", [None])[0]
+                issues = agent.lint(int(version) if version and version.isdigit() else None)
+                if issues is None:
+                    await self.__send_json(writer, 404, {"error": "No Python code to check, or it does not parse."})
+                else:
+                    await self.__send_json(writer, 200, {"issues": [issue._asdict() for issue in issues]})
+            elif action == "reset" and method == "POST":
+                agent.reset_conversation()
+                await self.__send_json(writer, 200, {"id": session_id})
+            elif action == "mode" and method == "POST" and body.get("mode") in ("slang", "normal"):
+                agent.set_system_message(get_system_message(body["mode"] == "slang"))
+                await self.__send_json(writer, 200, {"id": session_id, "mode": body["mode"]})
+            else:
+                await self.__send_json(writer, 404, {"error": "Not found"})
+
+    async def __prompt(self, writer: asyncio.StreamWriter, agent: AsyncFunkyCoder, body: Dict[str, Any]):
+        """Run a prompt, streaming the response as server-sent events unless "stream" is false."""
+        user_input = body.get("input")
+        if not isinstance(user_input, str) or not user_input.strip():
+            await self.__send_json(writer, 400, {"error": "Missing input"})
+            return
+        candidates = body.get("candidates")
+        if candidates is not None and (not isinstance(candidates, int) or isinstance(candidates, bool) or not 1 <= candidates <= self.__max_candidates):
+            await self.__send_json(writer, 400, {"error": f"candidates must be an integer from 1 to {self.__max_candidates}"})
+            return
+        if not body.get("stream", True):
+            response = await agent.aprompt(user_input, stream=False, candidates=candidates)
+            await self.__send_json(writer, 502 if agent.last_error else 200, {"response": response, "error": agent.last_error, "stats": agent.turn_stats[-1]._asdict()})
+            return
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+
+        async def send_event(event: str, payload: Dict[str, Any]):
+            writer.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            # Wait while a slow client lets the socket buffer fill up
+            await writer.drain()
+
+        # Tokens are queued by the turn and written by this coroutine, so the write buffer stays bounded
+        tokens = asyncio.Queue()
+        finished = object()
+        task = asyncio.ensure_future(agent.aprompt(user_input, stream=True, on_token=tokens.put_nowait, candidates=candidates))
+        task.add_done_callback(lambda _: tokens.put_nowait(finished))
+        try:
+            while True:
+                token = await tokens.get()
+                if token is finished:
+                    break
+                await send_event("token", {"token": token})
+            response = task.result()
+        finally:
+            if not task.done():
+                # The client went away: stop the turn
+                task.cancel()
+                await asyncio.wait([task])
+        await send_event("error" if agent.last_error else "done", {"response": response, "error": agent.last_error, "stats": agent.turn_stats[-1]._asdict()})
+
+    async def __bench(self, writer: asyncio.StreamWriter, agent: AsyncFunkyCoder, body: Dict[str, Any]):
+        """Benchmark the session's latest function and, if asked, send the measurements back as an optimize request."""
+        sizes = body.get("sizes")
+        if sizes is not None and not (isinstance(sizes, list) and sizes and all(isinstance(n, int) and n > 0 for n in sizes)):
+            await self.__send_json(writer, 400, {"error": "sizes must be a list of positive integers"})
+            return
+        inputs = body.get("inputs") if isinstance(body.get("inputs"), str) else None
+        result = await asyncio.get_event_loop().run_in_executor(None, agent.benchmark, sizes, inputs)
+        if result is None:
+            await self.__send_json(writer, 404, {"error": "No function found in the conversation."})
+            return
+        payload = {"benchmark": result._asdict(), "report": format_benchmark(result)}
+        if body.get("optimize") and result.ok:
+            payload["response"] = await agent.aprompt(agent.optimize_prompt(result), stream=False, use_library=False)
+            payload["error"] = agent.last_error
+        await self.__send_json(writer, 200 if result.ok else 422, payload)
+
+def is_valid_filename(filename: str) -> bool:
+    """
+    Check if the filename is valid.
+    
+    Args:
+        filename: The filename to check
+        
+    Returns:
+        True if valid, False otherwise
+    """
+    invalid_chars = r'<>:"/\\|?*'
+    return not any(char in filename for char in invalid_chars)
+
+def get_header(is_slang: bool = False) -> str:
+    if is_slang:
+        return """
+-------------------------------
+| 🕺 F U N K Y  C O D E R 🧠 |
+-------------------------------"""
+    else:
+        return """
+-------------------------------
+|    F U N K Y  C O D E R    |
+-------------------------------"""
+
+def get_welcome(is_slang: bool = False) -> str:
+    if is_slang:
+        return random.choice(data["welcomes"][1:])
+    else:
+        return data["welcomes"][0]
+
+def get_tagline(is_slang: bool = False) -> str:
+    if is_slang:
+        return random.choice(data["taglines"][1:])
+    else:
+        return data["taglines"][0]
+
+def get_description(is_slang: bool = False) -> str:
+    if is_slang:
+        return random.choice(data["descriptions"][1:])
+    else:
+        return data["descriptions"][0]
+
+def get_slang(command: str) -> str:
+    return data["commands"][command]["slang"]
+
+def get_help_commands(is_slang: bool = False) -> str:
+    if is_slang:
+        output = """🛠️ Funky System Moves
+Here's the menu of righteous commands:"""
+    else:
+        output = "System Commands:"
+    for command in data["commands"]:
+        if is_slang:
+            output += f"\n>{get_slang(command)} -- {data['commands'][command]['slang_description']}"
+        else:
+            output += f"\n>{command} -- {data['commands'][command]['description']}"
+    return output
+
+def get_examples(is_slang: bool = False) -> str:
+    if is_slang:
+        return """📦 Examples for the Groovy Newbies
+You: >stash surf_log.txt  
 You: >ripcord beachbot.py  
 You: >peaceout"""
     else:
@@ -592,13 +5640,529 @@ def show_help(is_slang: bool = False):
     print("\n" + get_examples(is_slang))
     print("\n" + get_user_call_to_action(is_slang))
 
+def get_follow_up_kind(user_input: str) -> Optional[str]:
+    """
+    Recognize a short request for one of the standard follow-ups.
+    
+    Args:
+        user_input: The user's input text
+        
+    Returns:
+        The follow-up name from data["follow_ups"], or None if the request is something else
+    """
+    words = re.findall(r"[a-z]+", user_input.lower())
+    if not words or len(words) > 10 or any(word in data["follow_up_negation_words"] for word in words):
+        return None
+    kinds = [kind for kind, follow_up in data["follow_ups"].items() if any(word in follow_up["keywords"] for word in words)]
+    if len(kinds) != 1:
+        return None
+    # Every other word has to be additive wording ("add tests", "tests please"), so "tests for the parser" is not claimed
+    keywords = data["follow_ups"][kinds[0]]["keywords"]
+    return kinds[0] if all(word in keywords or word in data["follow_up_additive_words"] for word in words) else None
+
+def classify_turn(user_input: str, has_code: bool) -> str:
+    """
+    Work out what kind of task a user's request is, for routing it to a model.
+    
+    Args:
+        user_input: The user's input text
+        has_code: Whether the conversation already has code to refine
+        
+    Returns:
+        One of the task names in data["tasks"]: "new", "refine", "docs" or "tests"
+    """
+    kind = get_follow_up_kind(user_input)
+    if kind:
+        return kind
+    words = re.findall(r"[a-z]+", user_input.lower())
+    if not has_code or (words and words[0] in data["new_function_keywords"]) or re.search(r"\b(new|another|second) function\b", user_input.lower()):
+        return "new"
+    return "refine"
+
 def get_system_message(is_slang: bool = False) -> str:
     if is_slang:
         return data["system_message"]["slang"]
     else:
         return data["system_message"]["normal"]
 
-def main():
+def get_command_name(command: str) -> Optional[str]:
+    """
+    Map a system command word (normal or slang) to its name in data["commands"].
+    
+    Args:
+        command: The command word, without the leading '>'
+        
+    Returns:
+        The command name, or None if it is not a known command
+    """
+    command = command.lower()
+    if command == "quit":
+        return "exit"
+    for name, info in data["commands"].items():
+        if command == name or command == info["slang"]:
+            return name
+    return None
+
+def split_code_version(argument: str) -> Tuple[str, Optional[int]]:
+    """
+    Split the arguments of a >code command into the filename and optional version.
+    
+    Args:
+        argument: Text after the command, e.g. "my_function.py 3"
+        
+    Returns:
+        The filename and the version number (None for the latest code)
+    """
+    argument = argument.strip()
+    filename, _, version = argument.rpartition(" ")
+    if filename.strip() and version.isdigit():
+        return filename.strip(), int(version)
+    return argument, None
+
+def load_batch_jobs(jobs_file: str) -> List[Dict[str, Any]]:
+    """
+    Read a JSONL file of batch jobs.
+    
+    Each line is an object with a "script" list of turns (prompts or '>' commands),
+    an optional "id" and an optional "slang" flag.
+    
+    Args:
+        jobs_file: Path to the JSONL file
+        
+    Returns:
+        The jobs, each with an "id"
+        
+    Raises:
+        ValueError: If a job is not an object, has no script or a turn that is not text,
+            or has an invalid or repeated id
+    """
+    jobs = []
+    ids = {}
+    with open(jobs_file) as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError(f"{jobs_file}:{line_number}: job is not a JSON object")
+            if isinstance(job.get("script"), str):
+                job["script"] = [job["script"]]
+            if not isinstance(job.get("script"), list) or not job["script"]:
+                raise ValueError(f"{jobs_file}:{line_number}: job has no script")
+            for step, turn in enumerate(job["script"], 1):
+                if not isinstance(turn, str) or not turn.strip():
+                    raise ValueError(f"{jobs_file}:{line_number}: turn {step} of the script is not a prompt or command: {turn!r}")
+            job["id"] = str(job.get("id") or f"job-{line_number:05d}")
+            if not is_valid_filename(job["id"]):
+                raise ValueError(f"{jobs_file}:{line_number}: invalid job id {job['id']!r}")
+            # Jobs with the same id would write to the same output directory
+            if job["id"] in ids:
+                raise ValueError(f"{jobs_file}:{line_number}: job id {job['id']!r} is already used on line {ids[job['id']]}")
+            ids[job["id"]] = line_number
+            jobs.append(job)
+    return jobs
+
+def write_json_atomic(filename: str, content: Any):
+    """Write JSON to a file so readers never see a partially written file."""
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as file:
+        json.dump(content, file, indent=2)
+    os.replace(temp_filename, filename)
+
+def run_batch_job(job: Dict[str, Any], job_dir: str, api_key: str, agent_options: Optional[Dict[str, Any]] = None, project_workers: int = 4) -> Dict[str, Any]:
+    """
+    Run one batch job's script in its own FunkyCoder session.
+    
+    Prompts are sent to the agent; '>code', '>save', '>bench', '>lint', '>project', '>reset', '>slang'
+    and '>normal' commands are applied to the session, with filenames placed in the job directory.
+    
+    Args:
+        job: The job to run
+        job_dir: Directory for the job's output files
+        api_key: OpenAI API key
+        agent_options: Extra keyword arguments for FunkyCoder (model, cache, context_budget, ...)
+        project_workers: Functions a '>project' command generates at once
+        
+    Returns:
+        The job's status record
+    """
+    is_slang = bool(job.get("slang", False))
+    agent = FunkyCoder(api_key, get_system_message(is_slang), **dict(agent_options or {}, stream=False, priority="batch", session=job["id"]))
+    status = {"id": job["id"], "status": "running", "turns": 0, "errors": [], "files": []}
+    start = time.perf_counter()
+    for turn in job["script"]:
+        if not turn.startswith(">"):
+            agent.prompt(turn)
+            status["turns"] += 1
+            if agent.last_error:
+                status["errors"].append(agent.last_error)
+                break
+            continue
+        command, _, argument = turn[1:].strip().partition(" ")
+        name = get_command_name(command)
+        filename = os.path.join(job_dir, os.path.basename(argument.strip()))
+        if name == "code" and argument.strip():
+            argument, version = split_code_version(argument)
+            filename = os.path.join(job_dir, os.path.basename(argument))
+            if agent.save_code_to_file(filename, version):
+                status["files"].append(os.path.basename(filename))
+            else:
+                status["errors"].append(f"No code to save for {turn!r}")
+        elif name == "save" and argument.strip():
+            agent.save_to_file(filename)
+            status["files"].append(os.path.basename(filename))
+        elif name == "bench":
+            arguments = parse_bench_arguments(argument)
+            result = agent.benchmark(*arguments[1:]) if arguments else None
+            if result is None:
+                status["errors"].append(f"Nothing to benchmark for {turn!r}" if arguments else f"Malformed {turn!r}")
+                continue
+            status.setdefault("benchmarks", []).append(result._asdict())
+            if not result.ok:
+                status["errors"].append(f"Benchmark failed for {turn!r}")
+            elif arguments[0]:
+                agent.optimize()
+                status["turns"] += 1
+                if agent.last_error:
+                    status["errors"].append(agent.last_error)
+                    break
+        elif name == "lint":
+            version = parse_lint_argument(argument)
+            issues = agent.lint(version) if version is not False else None
+            if issues is None:
+                status["errors"].append(f"Nothing to lint for {turn!r}" if version is not False else f"Malformed {turn!r}")
+                continue
+            status.setdefault("lint", []).append({"version": version, "turn": status["turns"], "issues": [issue._asdict() for issue in issues]})
+        elif name == "project":
+            directory, _, description = argument.strip().partition(" ")
+            if not description.strip():
+                status["errors"].append(f"Malformed {turn!r}")
+                continue
+            try:
+                result = ProjectBuilder(api_key, agent.system_message, agent_options, project_workers).build(description.strip(), os.path.join(job_dir, os.path.basename(directory)))
+            except ValueError as e:
+                status["errors"].append(f"No project plan for {turn!r}: {e}")
+                continue
+            status.setdefault("projects", []).append({
+                "directory": os.path.basename(directory), "plan": [function._asdict() for function in result.plan],
+                "functions": [dict(function._asdict(), code=None, tests=None) for function in result.functions],
+                "seconds": round(result.seconds, 3), "turn_seconds": round(result.turn_seconds, 3), "critical_path": round(result.critical_path, 3)})
+            status["files"] += [os.path.join(os.path.basename(directory), filename) for filename in result.files]
+            status["errors"] += result.errors
+        elif name == "reset":
+            agent.reset_conversation()
+        elif name in ("slang", "normal"):
+            is_slang = name == "slang"
+            agent.set_system_message(get_system_message(is_slang))
+        else:
+            status["errors"].append(f"Unsupported batch command {turn!r}")
+    validation = agent.wait_for_validation()
+    if validation is not None:
+        status["validation"] = {"ok": validation.ok, "stage": validation.stage, "tests_run": validation.tests_run, "output": validation.output, "network_isolated": validation.network_isolated}
+        if not validation.ok:
+            status["errors"].append(f"Validation failed at {validation.stage}")
+    agent.save_to_file(os.path.join(job_dir, "transcript.txt"))
+    status["status"] = "failed" if status["errors"] else "done"
+    status["seconds"] = round(time.perf_counter() - start, 3)
+    return status
+
+def run_batch(jobs_file: str, out_dir: str, api_key: str, concurrency: int = 4, agent_options: Optional[Dict[str, Any]] = None, project_workers: int = 4) -> Dict[str, Any]:
+    """
+    Run every job in a JSONL file through a bounded pool of FunkyCoder sessions.
+    
+    Each job writes its files and a status.json to out_dir/<job id> as soon as it
+    finishes. Jobs whose status is already "done" are skipped, so an interrupted
+    batch can be resumed by running it again.
+    
+    Args:
+        jobs_file: Path to the JSONL file of jobs
+        out_dir: Directory for the results
+        api_key: OpenAI API key
+        concurrency: Number of jobs to run at once
+        agent_options: Extra keyword arguments for every job's FunkyCoder (model, cache, context_budget, ...)
+        project_workers: Functions each '>project' command generates at once
+        
+    Returns:
+        Summary counts and throughput for the run
+    """
+    jobs = load_batch_jobs(jobs_file)
+    pending = []
+    for job in jobs:
+        status_file = os.path.join(out_dir, job["id"], "status.json")
+        if os.path.exists(status_file):
+            with open(status_file) as file:
+                if json.load(file).get("status") == "done":
+                    continue
+        pending.append(job)
+    summary = {"jobs": len(jobs), "skipped": len(jobs) - len(pending), "done": 0, "failed": 0}
+    print(f"Batch: {len(pending)} of {len(jobs)} jobs to run ({summary['skipped']} already done), concurrency {concurrency}")
+
+    def run(job: Dict[str, Any]) -> Dict[str, Any]:
+        job_dir = os.path.join(out_dir, job["id"])
+        os.makedirs(job_dir, exist_ok=True)
+        try:
+            status = run_batch_job(job, job_dir, api_key, agent_options, project_workers)
+        except Exception as e:
+            status = {"id": job["id"], "status": "failed", "errors": [str(e)]}
+        write_json_atomic(os.path.join(job_dir, "status.json"), status)
+        return status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for future in as_completed([executor.submit(run, job) for job in pending]):
+            status = future.result()
+            summary[status["status"]] += 1
+            print(f"[{summary['done'] + summary['failed']}/{len(pending)}] {status['id']}: {status['status']}")
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["jobs_per_minute"] = round((summary["done"] + summary["failed"]) * 60 / elapsed, 2) if elapsed > 0 else 0.0
+    if agent_options and agent_options.get("cache"):
+        summary["cache"] = agent_options["cache"].stats()
+    if agent_options and agent_options.get("validator"):
+        summary["validation"] = agent_options["validator"].stats()
+    if agent_options and agent_options.get("scheduler"):
+        summary["scheduler"] = agent_options["scheduler"].stats()
+    if agent_options and agent_options.get("library"):
+        summary["library"] = agent_options["library"].stats()
+    write_json_atomic(os.path.join(out_dir, "summary.json"), summary)
+    print(f"Batch finished: {summary['done']} done, {summary['failed']} failed, {summary['skipped']} skipped in {elapsed:.1f}s ({summary['jobs_per_minute']} jobs/minute)")
+    return summary
+
+def show_startup_profile(warm_up: threading.Thread):
+    """
+    Print how long startup took, measured from the start of the module import.
+    
+    Args:
+        warm_up: The background LiteLLM warm-up thread, waited for to time it
+    """
+    banner = time.perf_counter() - STARTUP_TIME
+    warm_up.join()
+    ready = time.perf_counter() - STARTUP_TIME
+    print(f"\n[startup] banner shown after {banner * 1000:.1f} ms, LiteLLM imported and warmed up after {ready * 1000:.1f} ms (in the background)")
+
+def offer_library_match(agent: FunkyCoder, user_input: str) -> Tuple[Optional[LibraryMatch], bool]:
+    """
+    Show the library functions similar to a request for a new function and let the user pick one.
+    
+    Args:
+        agent: The agent, with its function library
+        user_input: The user's request
+        
+    Returns:
+        The match to reuse as it is (or None), and whether the request may be sent with a library hint
+    """
+    if classify_turn(user_input, agent.extract_code() is not None) != "new":
+        return None, True
+    matches = agent.find_similar(user_input)
+    if not matches:
+        return None, True
+    print("\nSimilar functions in your library:")
+    for idx, match in enumerate(matches, 1):
+        print(f"  {idx}. {match.signature} ({match.score:.0%} similar) -- written for \"{match.request[:60]}\"")
+    answer = input("Reuse one [number], start from the best match [s], or ignore them [Enter]? ").strip().lower()
+    if answer.isdigit() and 1 <= int(answer) <= len(matches):
+        return matches[int(answer) - 1], False
+    return None, answer == "s"
+
+def parse_bench_arguments(argument: str) -> Optional[Tuple[bool, Optional[List[int]], Optional[str]]]:
+    """
+    Parse the arguments of a >bench command: "[optimize] [SIZE ...] [: EXPRESSION]".
+    
+    Args:
+        argument: Text after the command, e.g. "optimize 1000 10000 : list(range(n))"
+        
+    Returns:
+        Whether to send the results back for optimizing, the sizes (None for automatic ones)
+        and the input expression (None to build inputs from the parameters), or None if malformed
+    """
+    argument, _, inputs = argument.partition(":")
+    words = argument.replace(",", " ").split()
+    optimize = bool(words) and words[0].lower() == "optimize"
+    words = words[1:] if optimize else words
+    if not all(word.replace("_", "").isdigit() and int(word.replace("_", "")) > 0 for word in words):
+        return None
+    return optimize, [int(word.replace("_", "")) for word in words] or None, inputs.strip() or None
+
+def parse_lint_argument(argument: str) -> Union[Optional[int], bool]:
+    """
+    Parse the argument of a '>lint' command.
+    
+    Args:
+        argument: Empty, or a code version number
+        
+    Returns:
+        The version, None for the latest code, or False if the argument is malformed
+    """
+    argument = argument.strip()
+    if not argument:
+        return None
+    return int(argument) if argument.isdigit() else False
+
+def read_typed_line(buffer: List[str], timeout: float) -> Optional[str]:
+    """
+    Read a line typed at the terminal without blocking for longer than timeout.
+    
+    Args:
+        buffer: Characters typed so far on Windows, where the console is read key by key
+        timeout: Seconds to wait for input
+        
+    Returns:
+        The line, without its line ending, or None if no complete line was typed
+    """
+    if os.name == "nt":
+        import msvcrt
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            while msvcrt.kbhit():
+                char = msvcrt.getwche()
+                if char in ("\r", "\n"):
+                    line = "".join(buffer)
+                    buffer.clear()
+                    return line
+                buffer.append(char)
+            time.sleep(0.02)
+        return None
+    ready, _, _ = select.select([sys.stdin], [], [], timeout)
+    return sys.stdin.readline().rstrip("\r\n") if ready else None
+
+def generate_in_background(agent: FunkyCoder, generate: Callable[[], Any]) -> Optional[str]:
+    """
+    Run a turn on a worker thread while watching the keyboard, so that it can be stopped.
+    
+    Pressing Enter, typing >stop or pressing Ctrl-C stops the turn and drops its partial
+    answer; >stop keep keeps it in the conversation. Any other line stops the turn too
+    and is returned, to be sent as the next request. A second Ctrl-C while stopping quits.
+    
+    Args:
+        agent: The agent running the turn
+        generate: Runs the turn and prints its answer
+        
+    Returns:
+        The line typed to replace the turn's request, or None
+    """
+    worker = threading.Thread(target=generate, name="generation", daemon=True)
+    worker.start()
+    watch_keyboard = sys.stdin.isatty()
+    buffer, replacement, stopping = [], None, False
+    while worker.is_alive():
+        try:
+            line = read_typed_line(buffer, 0.1) if watch_keyboard and not stopping else worker.join(0.1)
+        except KeyboardInterrupt:
+            if stopping:
+                raise
+            line = ""
+        if line is None:
+            continue
+        words = line.strip().lower().split()
+        stop_command = bool(words) and get_command_name(words[0].lstrip(">")) == "stop" and words[0].startswith(">")
+        keep = stop_command and words[1:] == ["keep"]
+        if words and not stop_command:
+            replacement = line.strip()
+        stopping = agent.cancel(keep_partial=keep) or stopping
+    worker.join()
+    if agent.last_cancelled:
+        kept = agent.turn_stats and agent.turn_stats[-1].error is None
+        print(f"\n[Stopped; the partial answer was {'kept' if kept else 'dropped'}]")
+    return replacement
+
+def print_answer(agent: FunkyCoder, generate: Callable[..., Optional[str]], stream: bool):
+    """
+    Run a turn and print its answer, as it streams in or once it is complete.
+    
+    Args:
+        agent: The agent running the turn
+        generate: Runs the turn, e.g. agent.prompt with its request bound; called with on_token when streaming
+        stream: Whether to print the answer as it streams in
+    """
+    if not stream:
+        response = generate()
+        if response is not None and not agent.last_cancelled:
+            print(f"\nAgent: {response}")
+        return
+    print("\nAgent: ", end="", flush=True)
+    generate(on_token=print_token)
+    print()
+    if agent.last_time_to_first_token is not None and not agent.last_cancelled:
+        print(f"(first token in {agent.last_time_to_first_token:.2f}s)")
+
+def print_token(token: str):
+    """Print a streamed piece of text without a trailing newline."""
+    print(token, end="", flush=True)
+
+def parse_route(value: str) -> Tuple[str, str]:
+    """
+    Parse a --route argument of the form TASK=MODEL.
+    
+    Args:
+        value: The argument
+        
+    Returns:
+        The task name and the model
+    """
+    task, _, model = value.partition("=")
+    if task not in data["tasks"] or not model:
+        raise argparse.ArgumentTypeError(f"expected TASK=MODEL with TASK one of {', '.join(data['tasks'])}")
+    return task, model
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line options.
+    
+    Args:
+        argv: Arguments to parse (defaults to sys.argv)
+        
+    Returns:
+        The parsed options
+    """
+    parser = argparse.ArgumentParser(description="Funky Coder: generate Python functions with a So-Cal vibe.")
+    parser.add_argument("--model", default="openai/gpt-4o", help="LiteLLM model name (default: openai/gpt-4o)")
+    parser.add_argument("--api-base", metavar="URL", help="send requests to this OpenAI-compatible endpoint instead of the provider default")
+    parser.add_argument("--no-stream", action="store_true", help="wait for the whole response instead of streaming it")
+    parser.add_argument("--cache", metavar="FILE", nargs="?", const=".funky_cache.sqlite", help="reuse responses to identical requests from a disk cache (default file: .funky_cache.sqlite)")
+    parser.add_argument("--cache-max-mb", type=float, default=64, help="size limit of the response cache in MB (default: 64)")
+    parser.add_argument("--cache-ttl-hours", type=float, default=168, help="hours a cached response stays valid (default: 168)")
+    parser.add_argument("--context-budget", type=int, default=16000, help="token budget for each request, prompt plus response; 0 sends the whole history (default: 16000)")
+    parser.add_argument("--metrics-textfile", metavar="FILE", help="write a Prometheus textfile snapshot of the turn stats after every turn")
+    parser.add_argument("--journal", metavar="FILE", help="append-only session journal (default: a new file in .funky_sessions/)")
+    parser.add_argument("--no-journal", action="store_true", help="do not journal the session")
+    parser.add_argument("--fsync", action="store_true", help="force every journal record to disk")
+    parser.add_argument("--resume", metavar="FILE", help="continue the session recorded in a journal")
+    parser.add_argument("--profile-startup", action="store_true", help="report how long startup takes, including the background LiteLLM import")
+    parser.add_argument("--speculate", action="store_true", help="after each turn that produces code, prefetch the documentation and test follow-ups")
+    parser.add_argument("--speculation-budget", type=float, default=0.25, metavar="USD", help="maximum estimated spend on speculative requests (default: 0.25)")
+    parser.add_argument("--deadline", type=float, default=180, help="seconds a turn may take, retries included; 0 for no limit (default: 180)")
+    parser.add_argument("--retries", type=int, default=2, help="retries after rate limits, timeouts and server errors (default: 2)")
+    parser.add_argument("--hedge", action="store_true", help="send a second request when the first is slower than usual to respond")
+    parser.add_argument("--hedge-after", type=float, metavar="SECONDS", help="hedge after this many seconds instead of the p95 of recent turns")
+    parser.add_argument("--route", metavar="TASK=MODEL", type=parse_route, action="append", default=[], help=f"send one kind of task ({', '.join(data['tasks'])}) to another model; can be repeated")
+    parser.add_argument("--fast-model", metavar="MODEL", help="send refinements, docs and tests to this model and keep --model for new functions")
+    parser.add_argument("--diff-edits", action="store_true", help="have refinement and documentation turns send search/replace patches that are applied locally, instead of the whole function")
+    parser.add_argument("--validate", action="store_true", help="compile each new version of the code and run its tests in a sandboxed subprocess, in the background")
+    parser.add_argument("--validate-timeout", type=float, default=10, metavar="SECONDS", help="time limit of each test run (default: 10)")
+    parser.add_argument("--validate-memory-mb", type=int, default=512, help="memory limit of each test run (default: 512)")
+    parser.add_argument("--validate-workers", type=int, default=2, help="test runs at once (default: 2)")
+    parser.add_argument("--lint", action="store_true", help="check each new version of the code for slow patterns (string building in loops, list.pop(0), ...) and report them to the model with the next request")
+    parser.add_argument("--candidates", type=int, default=1, metavar="N", help="generate N answers at once for each prompt and keep the one whose code passes the most tests (default: 1)")
+    parser.add_argument("--library", metavar="FILE", nargs="?", const=".funky_library.sqlite", help="keep every function saved with >code in a local library and look new requests up in it (default file: .funky_library.sqlite)")
+    parser.add_argument("--library-mode", choices=("offer", "hint", "reuse"), default="offer", help="for a close library match: offer it to choose from, send it to the model as a starting point, or reuse it at once; --batch and --serve treat offer as hint (default: offer)")
+    parser.add_argument("--library-threshold", type=float, default=0.5, help="minimum similarity of a library match, from 0 to 1 (default: 0.5)")
+    parser.add_argument("--project-workers", type=int, default=4, metavar="N", help="functions >project generates at once (default: 4)")
+    parser.add_argument("--rpm", type=float, metavar="N", help="requests per minute allowed by the provider; requests beyond it are queued instead of rate limited")
+    parser.add_argument("--tpm", type=float, metavar="N", help="tokens per minute allowed by the provider, prompt plus response; requests beyond it are queued")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="host many sessions behind an HTTP API on this port instead of the interactive prompt")
+    parser.add_argument("--host", default="127.0.0.1", help="interface for --serve (default: 127.0.0.1)")
+    parser.add_argument("--max-active-sessions", type=int, default=1000, help="sessions --serve keeps in memory; the least recently used are paged out to disk (default: 1000)")
+    parser.add_argument("--idle-timeout", type=float, default=600, metavar="SECONDS", help="page out --serve sessions unused for this long (default: 600)")
+    parser.add_argument("--session-max-chars", type=int, default=200000, help="size limit of each --serve session's conversation in memory (default: 200000)")
+    parser.add_argument("--max-candidates", type=int, default=4, metavar="N", help="most candidates a --serve client may ask for in one prompt (default: 4)")
+    parser.add_argument("--batch", metavar="JOBS", help="run a JSONL file of scripted sessions without the interactive prompt")
+    parser.add_argument("--out", metavar="DIR", default="batch_out", help="output directory for --batch (default: batch_out)")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of --batch jobs to run at once (default: 4)")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
     is_slang = False
 
     load_dotenv(override=True)
@@ -607,11 +6171,65 @@ def main():
         print(f"Error: {EXPECTED_API_KEY_NAME} environment variable not set.")
         return
 
+    # Import LiteLLM while the user reads the banner and types the first request
+    warm_up = warm_up_litellm(api_key, args.model, args.api_base)
+
+    cache = None
+    if args.cache:
+        cache = ResponseCache(args.cache, max_bytes=int(args.cache_max_mb * 1024 * 1024), ttl=args.cache_ttl_hours * 3600)
+
+    routes = {task: args.fast_model for task in ("refine", "docs", "tests")} if args.fast_model else {}
+    routes.update(args.route)
+
+    agent_options = {
+        "model": args.model,
+        "api_base": args.api_base,
+        "cache": cache,
+        "context_budget": args.context_budget or None,
+        "deadline": args.deadline or None,
+        "max_retries": args.retries,
+        "hedge": args.hedge,
+        "hedge_after": args.hedge_after,
+        "routes": routes,
+        "edit_mode": args.diff_edits,
+        "candidates": args.candidates,
+        "validator": CodeValidator(args.validate_workers, args.validate_timeout, args.validate_memory_mb) if args.validate else None,
+        "scheduler": RequestScheduler(args.rpm, args.tpm) if args.rpm or args.tpm else None,
+        "library": FunctionLibrary(args.library) if args.library else None,
+        "library_mode": "reuse" if args.library_mode == "reuse" else "hint",
+        "library_threshold": args.library_threshold,
+        "lint": args.lint,
+    }
+
+    if args.batch:
+        try:
+            run_batch(args.batch, args.out, api_key, args.concurrency, agent_options, args.project_workers)
+        except (OSError, ValueError) as e:
+            print(f"Error loading batch jobs: {str(e)}")
+        return
+
+    if args.serve:
+        server = SessionServer(api_key, agent_options=agent_options, max_active=args.max_active_sessions, idle_timeout=args.idle_timeout, max_session_chars=args.session_max_chars, max_candidates=args.max_candidates)
+        try:
+            asyncio.run(server.serve(args.host, args.serve))
+        except KeyboardInterrupt:
+            pass
+        return
+
     system_message = get_system_message(is_slang)
 
     # Create the agent
-    agent = FunkyCoder(api_key, system_message)
+    metrics_hook = None
+    if args.metrics_textfile:
+        metrics_hook = lambda stats: agent.write_metrics_textfile(args.metrics_textfile)
+    agent = FunkyCoder(api_key, system_message, stream=not args.no_stream, metrics_hook=metrics_hook, speculate=args.speculate, speculation_budget=args.speculation_budget, **agent_options)
+    if args.resume:
+        if not agent.resume(args.resume, args.fsync):
+            return
+    elif not args.no_journal:
+        agent.start_journal(args.journal or os.path.join(".funky_sessions", time.strftime("session-%Y%m%d-%H%M%S.jsonl")), args.fsync)
     is_first_user_input = True
+    next_input = None
 
     # Start the conversation
     
@@ -619,8 +6237,19 @@ def main():
         if is_first_user_input:
             show_help(is_slang)
             is_first_user_input = False
+            if args.profile_startup:
+                show_startup_profile(warm_up)
             
-        user_input = input("\nYou: ")
+        if next_input is not None:
+            # Typed while the previous answer was being written, which stopped it
+            user_input, next_input = next_input, None
+            print(f"\nYou: {user_input}")
+        else:
+            try:
+                user_input = input("\nYou: ")
+            except (KeyboardInterrupt, EOFError):
+                print()
+                break
 
         # check for commands
         if user_input.startswith(">"):
@@ -635,8 +6264,56 @@ def main():
                 agent.save_to_file(filename)
                 continue
             elif command.lower().startswith("code ") or command.lower().startswith(data["commands"]["code"]["slang"]+" "):
-                filename = command[5:].strip()
-                agent.save_code_to_file(filename)
+                filename, version = split_code_version(command.split(" ", 1)[1])
+                agent.save_code_to_file(filename, version)
+                continue
+            elif command.lower().startswith("load ") or command.lower().startswith(data["commands"]["load"]["slang"]+" "):
+                filename = command.split(" ", 1)[1].strip()
+                agent.resume(filename, args.fsync)
+                continue
+            elif command.lower() == "stats" or command.lower() == data["commands"]["stats"]["slang"]:
+                agent.show_stats()
+                continue
+            elif get_command_name(command.split(" ", 1)[0]) == "bench":
+                arguments = parse_bench_arguments(command.partition(" ")[2])
+                if arguments is None:
+                    print("Usage: >bench [optimize] [SIZE ...] [: EXPRESSION OF n]")
+                    continue
+                optimize, sizes, inputs = arguments
+                print("Benchmarking in a sandbox...")
+                result = agent.benchmark(sizes, inputs)
+                if result is None:
+                    continue
+                print(format_benchmark(result))
+                if not result.ok or not (optimize or input("\nAsk the model to optimize it with these measurements? [y/N] ").strip().lower() == "y"):
+                    continue
+                next_input = generate_in_background(agent, lambda: print_answer(agent, agent.optimize, not args.no_stream))
+                continue
+            elif get_command_name(command.split(" ", 1)[0]) == "project":
+                directory, _, description = command.partition(" ")[2].strip().partition(" ")
+                if not description.strip():
+                    print("Usage: >project <directory> <description of the module>")
+                    continue
+                try:
+                    result = ProjectBuilder(api_key, agent.system_message, agent_options, args.project_workers).build(description.strip(), directory)
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    continue
+                print(format_project(result))
+                continue
+            elif get_command_name(command.split(" ", 1)[0]) == "lint":
+                version = parse_lint_argument(command.partition(" ")[2])
+                if version is False:
+                    print("Usage: >lint [version]")
+                    continue
+                issues = agent.lint(version)
+                print(format_lint(issues, version) if issues is not None else "No Python code to check, or it does not parse.")
+                continue
+            elif get_command_name(command.split(" ", 1)[0]) == "stop":
+                print("Nothing to stop; an answer can be stopped while it is being written.")
+                continue
+            elif command.lower() == "versions" or command.lower() == data["commands"]["versions"]["slang"]:
+                agent.show_code_versions()
                 continue
             elif command.lower() == "clear" or command.lower() == data["commands"]["clear"]["slang"]:
                 os.system("cls" if os.name == "nt" else "clear")
@@ -655,9 +6332,22 @@ def main():
                 agent.set_system_message(get_system_message(is_slang))
                 continue
         else:
-            response = agent.prompt(user_input)
-            print(f"\nAgent: {response}")
+            use_library = True
+            if args.library_mode == "offer":
+                choice, use_library = offer_library_match(agent, user_input)
+                if choice is not None:
+                    print(f"\nAgent: {agent.reuse_function(user_input, choice)}")
+                    continue
+            generate = lambda **kwargs: agent.prompt(user_input, use_library=use_library, **kwargs)
+            next_input = generate_in_background(agent, lambda: print_answer(agent, generate, not args.no_stream))
     
+    agent.cancel_speculation()
+    if agent_options["library"]:
+        stats = agent_options["library"].stats()
+        print(f"\nLibrary: {stats['entries']} functions, {stats['matches']} of {stats['lookups']} lookups matched")
+    if cache:
+        stats = cache.stats()
+        print(f"\nCache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['bytes']} bytes)")
     print("\n", get_exit_message(is_slang))
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from funky_coder import load_batch_jobs, parse_bench_arguments, parse_lint_argument
+
+
+@pytest.fixture
+def jobs_file(tmp_path):
+    def write(*jobs):
+        path = tmp_path / "jobs.jsonl"
+        path.write_text("\n".join(job if isinstance(job, str) else json.dumps(job) for job in jobs) + "\n")
+        return str(path)
+    return write
+
+
+def test_jobs_get_ids_and_scripts(jobs_file):
+    jobs = load_batch_jobs(jobs_file({"script": ["Write a slugify function", ">code slugify.py"], "slang": True}, "", {"id": "dates", "script": "Parse ISO dates"}))
+    assert [job["id"] for job in jobs] == ["job-00001", "dates"]
+    assert jobs[0]["slang"] is True
+    assert jobs[1]["script"] == ["Parse ISO dates"]
+
+
+@pytest.mark.parametrize("job, message", [
+    ([1, 2], "not a JSON object"),
+    ({"id": "empty"}, "has no script"),
+    ({"script": []}, "has no script"),
+    ({"script": ["ok", {"prompt": "not text"}]}, "turn 2 of the script"),
+    ({"script": ["ok", "   "]}, "turn 2 of the script"),
+    ({"id": "../escape", "script": ["ok"]}, "invalid job id"),
+])
+def test_malformed_jobs_are_rejected(jobs_file, job, message):
+    with pytest.raises(ValueError, match=message):
+        load_batch_jobs(jobs_file(job))
+
+
+def test_repeated_ids_are_rejected(jobs_file):
+    with pytest.raises(ValueError, match=r"jobs.jsonl:3: job id 'a' is already used on line 1"):
+        load_batch_jobs(jobs_file({"id": "a", "script": ["x"]}, {"id": "b", "script": ["y"]}, {"id": "a", "script": ["z"]}))
+
+
+@pytest.mark.parametrize("argument, expected", [
+    ("", (False, None, None)),
+    ("optimize", (True, None, None)),
+    ("1000 10_000, 100000", (False, [1000, 10000, 100000], None)),
+    ("OPTIMIZE 500 : list(range(n))", (True, [500], "list(range(n))")),
+    (": 'a' * n", (False, None, "'a' * n")),
+    ("0", None),
+    ("fast", None),
+    ("100 optimize", None),
+])
+def test_parse_bench_arguments(argument, expected):
+    assert parse_bench_arguments(argument) == expected
+
+
+def test_parse_lint_argument():
+    assert parse_lint_argument("") is None
+    assert parse_lint_argument(" 3 ") == 3
+    assert parse_lint_argument("latest") is False
@@ -0,0 +1,64 @@
+from funky_coder import apply_patch, apply_search_replace, apply_unified_diff, replace_once
+
+CODE = """def area(width, height):
+    return width * height
+
+
+def perimeter(width, height):
+    return 2 * (width + height)
+"""
+
+
+def test_replace_once_exact_match():
+    assert replace_once(CODE, "return width * height", "return float(width * height)") == CODE.replace("width * height", "float(width * height)")
+
+
+def test_replace_once_ignores_trailing_whitespace():
+    changed = replace_once(CODE, "def area(width, height):   \n    return width * height  ", "def area(w, h):\n    return w * h")
+    assert changed.startswith("def area(w, h):\n    return w * h\n")
+    assert "def perimeter(width, height):" in changed
+
+
+def test_replace_once_rejects_missing_and_ambiguous_snippets():
+    assert replace_once(CODE, "return width / height", "") is None
+    # "(width, height):" occurs in both functions
+    assert replace_once(CODE, "(width, height):", "(w, h):") is None
+    assert replace_once(CODE, "   \n", "x") is None
+
+
+def test_apply_search_replace_applies_blocks_in_order():
+    blocks = [
+        ("return width * height", "return round(width * height, 2)"),
+        ("round(width * height, 2)", "round(width * height, 3)"),
+    ]
+    assert "return round(width * height, 3)" in apply_search_replace(CODE, blocks)
+
+
+def test_apply_search_replace_fails_as_a_whole():
+    blocks = [("return width * height", "return 0"), ("no such line", "")]
+    assert apply_search_replace(CODE, blocks) is None
+    assert apply_search_replace(CODE, []) == CODE
+
+
+def test_apply_unified_diff_locates_hunks_by_content():
+    diff = """--- a/shapes.py
++++ b/shapes.py
+@@ -40,2 +40,2 @@
+ def perimeter(width, height):
+-    return 2 * (width + height)
++    return 2 * width + 2 * height
+"""
+    changed = apply_unified_diff(CODE, diff)
+    assert changed.endswith("    return 2 * width + 2 * height\n")
+    assert "return width * height" in changed
+    assert apply_unified_diff(CODE, "no hunks here") is None
+
+
+def test_apply_patch_reports_the_patch_location():
+    response = "Rounded it:\n\n<<<<<<< SEARCH\n    return width * height\n=======\n    return round(width * height)\n>>>>>>> REPLACE\n\nDone."
+    code, start, end, changes = apply_patch(CODE, response)
+    assert "return round(width * height)" in code
+    assert changes == 1
+    assert response[start:end].startswith("<<<<<<< SEARCH")
+    assert response[end:].strip() == "Done."
+    assert apply_patch(CODE, "No patch in this answer.") is None
@@ -0,0 +1,125 @@
+import textwrap
+
+import pytest
+
+from funky_coder import format_lint, lint_code
+
+
+def rules(code):
+    return [(issue.line, issue.rule) for issue in lint_code(textwrap.dedent(code))]
+
+
+@pytest.mark.parametrize("code, expected", [
+    ("""
+     def join(xs):
+         s = ''
+         for x in xs:
+             s += str(x)
+         return s
+     """, [(5, "concat-in-loop")]),
+    ("""
+     def collect(xs):
+         out = []
+         for x in xs:
+             out = out + [x]
+         return out
+     """, [(5, "concat-in-loop")]),
+    ("""
+     def flatten(xss):
+         return sum(xss, [])
+     """, [(3, "concat-in-loop")]),
+    ("""
+     def drain(queue: list):
+         while queue:
+             queue.pop(0)
+     """, [(4, "pop-front")]),
+    ("""
+     import re
+     def matches(xs):
+         return [x for x in xs if re.compile('a+').match(x)]
+     """, [(4, "compile-in-loop")]),
+    ("""
+     import re
+     def matches(x):
+         return re.compile('a+').match(x)
+     """, [(4, "compile-per-call")]),
+    ("""
+     def unique(xs):
+         seen = []
+         for x in xs:
+             if x not in seen:
+                 seen.append(x)
+         return seen
+     """, [(5, "list-membership")]),
+    ("""
+     def counts(xs):
+         items = list(xs)
+         return [items.count(x) for x in items]
+     """, [(4, "scan-in-loop")]),
+    ("""
+     def indexes(n):
+         for i in list(range(n)):
+             print(i)
+     """, [(3, "needless-copy")]),
+    ("""
+     def ordered(xs):
+         return list(sorted(xs))
+     """, [(3, "needless-copy")]),
+    ("""
+     def truthy(xs):
+         return len([x for x in xs if x])
+     """, [(3, "needless-copy")]),
+])
+def test_slow_patterns_are_reported(code, expected):
+    assert rules(code) == expected
+
+
+@pytest.mark.parametrize("code", [
+    # Adding numbers, not strings
+    """
+    def total(xs):
+        s = 0
+        for x in xs:
+            s += x
+        return s
+    """,
+    # A name bound to more than one kind of value is left alone
+    """
+    def mixed(xs):
+        s = ''
+        s = 5
+        for x in xs:
+            s += x
+    """,
+    # Membership in a set is fine
+    """
+    def unique(xs):
+        seen = set()
+        for x in xs:
+            if x in seen:
+                continue
+            seen.add(x)
+    """,
+    # Outside a loop the concatenation runs once
+    """
+    def greet(name):
+        s = 'Hello, '
+        s += name
+        return s
+    """,
+])
+def test_clear_code_is_not_reported(code):
+    assert rules(code) == []
+
+
+def test_unparsable_code_raises():
+    with pytest.raises(SyntaxError):
+        lint_code("def broken(:\n")
+
+
+def test_format_lint():
+    issues = lint_code("def f(xs):\n    s = ''\n    for x in xs:\n        s += x\n    return s\n")
+    report = format_lint(issues, 2)
+    assert report.startswith("Version 2: 1 slow pattern\n")
+    assert "line 4 [concat-in-loop]" in report
+    assert format_lint([]) == "The latest code: no slow patterns found."
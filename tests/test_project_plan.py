@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from funky_coder import parse_project_plan
+
+
+def plan(*modules):
+    return json.dumps({"modules": [{"name": name, "functions": functions} for name, functions in modules]})
+
+
+def function(name, *depends_on):
+    return {"name": name, "signature": f"def {name}(text)", "description": f"{name} the text", "depends_on": list(depends_on)}
+
+
+def test_functions_come_after_their_dependencies():
+    text = plan(("textstats", [function("word_frequencies", "tokenize", "normalize"), function("tokenize", "normalize"), function("normalize")]))
+    functions = parse_project_plan(text)
+    assert [f.name for f in functions] == ["normalize", "tokenize", "word_frequencies"]
+    assert functions[2].depends_on == ("tokenize", "normalize")
+    assert functions[0].signature == "def normalize(text)"
+
+
+def test_plan_in_a_fenced_block_with_prose_around_it():
+    text = "Here is the plan:\n```json\n" + plan(("parsing", [function("parse")])) + "\n```\nLet me know."
+    assert [f.module for f in parse_project_plan(text)] == ["parsing"]
+
+
+def test_repeated_dependencies_are_kept_once():
+    text = plan(("m", [function("a"), function("b", "a", "a")]))
+    assert parse_project_plan(text)[1].depends_on == ("a",)
+
+
+def test_module_names_that_would_be_shadowed_are_renamed():
+    text = plan(("json", [function("load_config")]), ("test_helpers", [function("helper")]))
+    assert [f.module for f in parse_project_plan(text)] == ["json_lib", "test_helpers_lib"]
+
+
+def test_modules_depending_on_each_other_are_merged():
+    text = plan(("first", [function("a"), function("c", "b")]), ("second", [function("b", "a")]))
+    assert {f.module for f in parse_project_plan(text)} == {"first"}
+
+
+@pytest.mark.parametrize("text, message", [
+    ("no json at all", "not valid JSON"),
+    ('{"modules": []}', "has no modules"),
+    (plan(("m", [])), "has no functions"),
+    (plan(("bad-name", [function("a")])), "invalid module name"),
+    (plan(("m", [function("a"), function("a")])), "planned twice"),
+    (plan(("m", [function("a", "missing")])), "not another planned function"),
+    (plan(("m", [function("a", "a")])), "not another planned function"),
+    (plan(("m", [dict(function("a"), depends_on="b")])), "not a list of names"),
+    (plan(("m", [function("a", "b"), function("b", "a")])), "cycle"),
+])
+def test_malformed_plans_are_rejected(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_project_plan(text)
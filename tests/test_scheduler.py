@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from funky_coder import RequestScheduler
+
+
+def test_requests_beyond_the_burst_wait_for_a_refill():
+    # 600 requests a minute with one second of burst: 10 at once, then one every 0.1s
+    scheduler = RequestScheduler(requests_per_minute=600, burst_seconds=1.0)
+    for _ in range(10):
+        assert scheduler.acquire("s", timeout=0.01) < 0.01
+    with pytest.raises(TimeoutError):
+        scheduler.acquire("s", timeout=0.02)
+    started = time.monotonic()
+    scheduler.acquire("s", timeout=1.0)
+    assert 0.02 < time.monotonic() - started < 0.5
+
+
+def test_a_low_limit_still_lets_one_request_through():
+    scheduler = RequestScheduler(requests_per_minute=1)
+    scheduler.acquire("s", timeout=0.01)
+    with pytest.raises(TimeoutError):
+        scheduler.acquire("s", timeout=0.05)
+
+
+def test_settle_refunds_overestimated_tokens():
+    # 100 tokens of burst, refilled at 100 tokens a second
+    scheduler = RequestScheduler(tokens_per_minute=6000, burst_seconds=1.0)
+    scheduler.acquire("s", tokens=100, timeout=0.01)
+    with pytest.raises(TimeoutError):
+        scheduler.acquire("s", tokens=80, timeout=0.01)
+    scheduler.settle(100, 10)
+    scheduler.acquire("s", tokens=80, timeout=0.01)
+
+
+def test_estimate_tokens_counts_prompt_and_every_completion():
+    request = {"messages": [{"role": "user", "content": "x" * 400}], "max_tokens": 50, "n": 3}
+    assert RequestScheduler.estimate_tokens(request) == 100 + 150
+
+
+def test_waiting_is_cancellable():
+    scheduler = RequestScheduler(requests_per_minute=1)
+    scheduler.acquire("s")
+    cancelled = threading.Event()
+    threading.Timer(0.05, cancelled.set).start()
+    with pytest.raises(RuntimeError, match="cancelled"):
+        scheduler.acquire("s", cancelled=cancelled)
+    assert scheduler.stats()["interactive"]["queued"] == 0
+
+
+def test_interactive_requests_go_before_background_ones():
+    scheduler = RequestScheduler(requests_per_minute=1200, burst_seconds=0.05)
+    scheduler.acquire("warm-up")
+    order = []
+
+    def send(session, priority):
+        scheduler.acquire(session, priority, timeout=5.0)
+        order.append(priority)
+
+    threads = [threading.Thread(target=send, args=(f"s{idx}", "background")) for idx in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)
+    threads.append(threading.Thread(target=send, args=("s9", "interactive")))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+    assert order == ["interactive", "background", "background"]
+    stats = scheduler.stats()
+    assert stats["interactive"]["granted"] == 2
+    assert stats["background"]["granted"] == 2
+
+
+def test_aacquire_times_out_without_blocking_the_loop():
+    scheduler = RequestScheduler(requests_per_minute=1)
+
+    async def main():
+        await scheduler.aacquire("s", timeout=0.01)
+        with pytest.raises(TimeoutError):
+            await scheduler.aacquire("s", timeout=0.05)
+
+    asyncio.run(main())
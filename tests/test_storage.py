@@ -0,0 +1,86 @@
+import pytest
+
+import funky_coder
+from funky_coder import MessageStore, ResponseCache
+
+
+def conversation(turns):
+    messages = [{"role": "system", "content": "You write Python functions."}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"Request {turn}: " + "please " * 60})
+        messages.append({"role": "assistant", "content": f"```python\ndef f{turn}():\n    return {turn}\n```\n" + "# note\n" * 50})
+    return messages
+
+
+def test_message_store_round_trips_compressed_messages():
+    messages = conversation(4)
+    store = MessageStore(messages)
+    store.compress(7)
+    usage = store.memory_usage()
+    # Everything before message 7 except the system message is compressed
+    assert usage["compressed_messages"] == 6
+    assert usage["chars"] == sum(len(message["content"]) for message in messages)
+    assert list(store) == messages
+    assert store[1:3] == messages[1:3]
+    assert store[3] == messages[3]
+    assert [store.role(idx) for idx in range(len(store))] == [message["role"] for message in messages]
+    assert [store.length(idx) for idx in range(len(store))] == [len(message["content"]) for message in messages]
+
+
+def test_message_store_edits():
+    store = MessageStore(conversation(2))
+    store.compress(3)
+    del store[1:3]
+    store.append({"role": "user", "content": "one more"})
+    store[0] = {"role": "system", "content": "Be brief."}
+    assert [message["content"] for message in store][0] == "Be brief."
+    assert [message["role"] for message in store] == ["system", "user", "assistant", "user"]
+    assert len(store) == 4
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(funky_coder.time, "time", clock)
+    return clock
+
+
+def test_cache_key_ignores_fields_that_do_not_change_the_response():
+    cache = ResponseCache(":memory:")
+    request = {"model": "openai/gpt-4o", "messages": [{"role": "user", "content": "hi"}], "temperature": 0.7}
+    assert cache.make_key(request) == cache.make_key(dict(request, stream=True, timeout=30))
+    assert cache.make_key(request) != cache.make_key(dict(request, temperature=0.2))
+
+
+def test_cache_entries_expire(clock):
+    cache = ResponseCache(":memory:", ttl=60)
+    cache.put("key", "response")
+    clock.now += 59
+    assert cache.get("key") == "response"
+    clock.now += 2
+    assert cache.get("key") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 0, "bytes": 0}
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = ResponseCache(":memory:", max_bytes=10, ttl=None)
+    cache.put("a", "aaaa")
+    clock.now += 1
+    cache.put("b", "bbbb")
+    clock.now += 1
+    assert cache.get("a") == "aaaa"
+    clock.now += 1
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None